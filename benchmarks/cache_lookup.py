@@ -0,0 +1,51 @@
+#! /usr/bin/python
+# Compares indexed Cache lookups against a linear scan of the cache state
+from __future__ import print_function
+import argparse
+import os
+import shutil
+import sys
+import timeit
+from tempfile import mkdtemp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dwight_chroot.cache import Cache
+
+def _make_key(index):
+    return dict(url="git://server/repo{0}".format(index), commit=None, branch="branch{0}".format(index), tag=None)
+
+def _create_synthetic_cache(num_items):
+    cache = Cache(mkdtemp())
+    with cache._state._transaction() as connection:
+        cache._state._insert_items(connection, [
+            dict(key=_make_key(index), path=os.path.join(cache.root, "items", str(index)), size=1)
+            for index in range(num_items)])
+        cache._state._set_meta(connection, "next_id", num_items)
+    return cache
+
+def _linear_get_path(cache, key):
+    for existing_item in cache._state.get_items():
+        if existing_item["key"] == key:
+            return existing_item["path"]
+    return None
+
+def main(args):
+    cache = _create_synthetic_cache(args.num_items)
+    keys = [_make_key(index) for index in range(0, args.num_items, max(1, args.num_items // args.num_lookups))]
+    try:
+        for name, lookup in [("linear", _linear_get_path), ("indexed", Cache.get_path)]:
+            elapsed = timeit.timeit(lambda: [lookup(cache, key) for key in keys], number=args.repeat)
+            print("{0:>8}: {1:.6f}s per lookup ({2} items)".format(
+                name, elapsed / (args.repeat * len(keys)), args.num_items))
+    finally:
+        shutil.rmtree(cache.root)
+    return 0
+
+parser = argparse.ArgumentParser()
+parser.add_argument("--num-items", type=int, default=10000)
+parser.add_argument("--num-lookups", type=int, default=100)
+parser.add_argument("--repeat", type=int, default=5)
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
@@ -0,0 +1,291 @@
+#! /usr/bin/python
+# Runs the dwight benchmarks, writes the results as JSON and compares them against a stored baseline
+from __future__ import print_function
+import argparse
+from contextlib import contextmanager
+import json
+import os
+import platform
+import shutil
+import sys
+import threading
+import time
+from tempfile import mkdtemp
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+from dwight_chroot.cache import Cache
+from dwight_chroot.config import DwightConfiguration
+from dwight_chroot.python_compat import PY3
+from dwight_chroot.resources import HTTPResource, LocalResource
+from dwight_chroot.timing import Timings
+
+if PY3:
+    from http.server import HTTPServer, SimpleHTTPRequestHandler
+else:
+    from BaseHTTPServer import HTTPServer
+    from SimpleHTTPServer import SimpleHTTPRequestHandler
+
+from cache_lookup import _create_synthetic_cache, _make_key
+
+_DEFAULT_BASELINE_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+_BENCHMARKS = []
+
+def benchmark(name, requires_root=False, **kwargs):
+    def decorator(func):
+        _BENCHMARKS.append(dict(name=name, func=func, requires_root=requires_root, kwargs=kwargs))
+        return func
+    return decorator
+
+def _measure(run, repeat, setup=None, teardown=None):
+    durations = []
+    for _ in range(repeat):
+        state = setup() if setup is not None else None
+        try:
+            start = time.time()
+            run(state)
+            durations.append(time.time() - start)
+        finally:
+            if teardown is not None:
+                teardown(state)
+    return durations
+
+class _BenchmarkEnvironment(object):
+    def __init__(self, cache_path):
+        super(_BenchmarkEnvironment, self).__init__()
+        self.cache = Cache(cache_path)
+        self.config = DwightConfiguration()
+        self.timings = Timings()
+
+################################### Cache ######################################
+
+for _num_items in (100, 1000, 10000):
+    @benchmark("cache.lookup.{0}".format(_num_items), num_items=_num_items)
+    def _benchmark_cache_lookup(args, num_items):
+        cache = _create_synthetic_cache(num_items)
+        keys = [_make_key(index) for index in range(0, num_items, max(1, num_items // 100))]
+        try:
+            return _measure(lambda _: [cache.get_path(key) for key in keys], args.repeat)
+        finally:
+            shutil.rmtree(cache.root)
+
+    @benchmark("cache.load_state.{0}".format(_num_items), num_items=_num_items)
+    def _benchmark_cache_load_state(args, num_items):
+        cache = _create_synthetic_cache(num_items)
+        cache.close()
+        key = _make_key(num_items // 2)
+        def run(_):
+            # the state is only opened by the first lookup
+            loaded_cache = Cache(cache.root)
+            loaded_cache.get_path(key)
+            loaded_cache.close()
+        try:
+            return _measure(run, args.repeat)
+        finally:
+            shutil.rmtree(cache.root)
+
+for _num_files in (1000, 10000):
+    @benchmark("cache.total_size.{0}".format(_num_files), num_files=_num_files)
+    def _benchmark_total_size(args, num_files):
+        cache = Cache(mkdtemp())
+        path = os.path.join(cache.root, "items", "0")
+        for index in range(num_files):
+            directory = os.path.join(path, str(index % 100))
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(os.path.join(directory, str(index)), "wb") as f:
+                f.write(b"x" * (index % 4096))
+        try:
+            return _measure(lambda _: cache._get_path_total_size(path), args.repeat)
+        finally:
+            shutil.rmtree(cache.root)
+
+for _num_items in (100, 1000):
+    @benchmark("cache.cleanup.{0}".format(_num_items), num_items=_num_items)
+    def _benchmark_cleanup(args, num_items):
+        def setup(_=None):
+            cache = Cache(mkdtemp())
+            items = []
+            for index in range(num_items):
+                path = os.path.join(cache.root, "items", str(index))
+                os.makedirs(path)
+                with open(os.path.join(path, "file"), "wb") as f:
+                    f.write(b"x" * 1024)
+                items.append(dict(key=_make_key(index), path=path, size=1024, last_access=index, hits=index % 7))
+            with cache._state._transaction() as connection:
+                cache._state._insert_items(connection, items)
+                cache._state._set_meta(connection, "next_id", num_items)
+            return cache
+        # half of the cache has to be purged
+        return _measure(lambda cache: cache.cleanup(num_items * 1024 // 2, []), args.repeat,
+                        setup=setup, teardown=lambda cache: shutil.rmtree(cache.root))
+
+@benchmark("config.load", num_includes=1000)
+def _benchmark_config_load(args, num_includes):
+    root = mkdtemp()
+    path = os.path.join(root, "config.py")
+    with open(path, "w") as config_file:
+        config_file.write('ROOT_IMAGE = "/image.squashfs"\n')
+        for index in range(num_includes):
+            config_file.write('INCLUDES += [Include("/mnt/{0}", "git://server/repo{0}", branch="b")]\n'.format(index))
+    try:
+        DwightConfiguration(root).load_from_file(path)
+        return _measure(lambda _: DwightConfiguration(root).load_from_file(path), args.repeat)
+    finally:
+        shutil.rmtree(root)
+
+################################## Resources ###################################
+
+@benchmark("resource.local")
+def _benchmark_local_resource(args):
+    env = _BenchmarkEnvironment(mkdtemp())
+    try:
+        return _measure(lambda _: LocalResource(env.cache.root).get_path(env), args.repeat)
+    finally:
+        shutil.rmtree(env.cache.root)
+
+class _QuietHTTPRequestHandler(SimpleHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+@contextmanager
+def _serving_file(size):
+    root = mkdtemp()
+    with open(os.path.join(root, "file"), "wb") as f:
+        f.write(os.urandom(size))
+    old_cwd = os.getcwd()
+    os.chdir(root)
+    server = HTTPServer(("127.0.0.1", 0), _QuietHTTPRequestHandler)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    try:
+        yield "http://127.0.0.1:{0}/file".format(server.server_address[1])
+    finally:
+        server.shutdown()
+        server.server_close()
+        os.chdir(old_cwd)
+        shutil.rmtree(root)
+
+@benchmark("resource.http.cold", size=16 * 1024 * 1024)
+def _benchmark_http_cold(args, size):
+    with _serving_file(size) as url:
+        return _measure(lambda env: HTTPResource(url).get_path(env), args.repeat,
+                        setup=lambda _=None: _BenchmarkEnvironment(mkdtemp()),
+                        teardown=lambda env: shutil.rmtree(env.cache.root))
+
+@benchmark("resource.http.warm", size=16 * 1024 * 1024)
+def _benchmark_http_warm(args, size):
+    with _serving_file(size) as url:
+        env = _BenchmarkEnvironment(mkdtemp())
+        try:
+            HTTPResource(url).get_path(env)
+            return _measure(lambda _: HTTPResource(url).get_path(env), args.repeat)
+        finally:
+            shutil.rmtree(env.cache.root)
+
+################################## End to end ##################################
+
+def _get_chroot_environment(args):
+    from dwight_chroot.environment import Environment
+    env = Environment()
+    env.config["ROOT_IMAGE"] = args.root_image
+    env.config["NUM_LOOP_DEVICES"] = None
+    return env
+
+@benchmark("chroot.cold", requires_root=True)
+def _benchmark_chroot_cold(args):
+    def setup(_=None):
+        env = _get_chroot_environment(args)
+        env.cache = Cache(mkdtemp())
+        return env
+    return _measure(lambda env: env.run_command_in_chroot("true"), args.repeat,
+                    setup=setup, teardown=lambda env: shutil.rmtree(env.cache.root))
+
+@benchmark("chroot.warm", requires_root=True)
+def _benchmark_chroot_warm(args):
+    env = _get_chroot_environment(args)
+    env.cache = Cache(mkdtemp())
+    try:
+        env.run_command_in_chroot("true")
+        return _measure(lambda _: env.run_command_in_chroot("true"), args.repeat)
+    finally:
+        shutil.rmtree(env.cache.root)
+
+#################################### Runner ####################################
+
+def _get_summary(durations):
+    durations = sorted(durations)
+    return dict(
+        min=durations[0],
+        median=durations[len(durations) // 2],
+        mean=sum(durations) / len(durations),
+        repeat=len(durations),
+        )
+
+def run_benchmarks(args):
+    results = {}
+    for bench in _BENCHMARKS:
+        if args.filter and not any(f in bench["name"] for f in args.filter):
+            continue
+        if bench["requires_root"] and (os.getuid() != 0 or args.root_image is None):
+            print("{0:<28} skipped (requires root and --root-image)".format(bench["name"]), file=sys.stderr)
+            continue
+        results[bench["name"]] = _get_summary(bench["func"](args, **bench["kwargs"]))
+        print("{0:<28} {1:.6f}s".format(bench["name"], results[bench["name"]]["median"]), file=sys.stderr)
+    return results
+
+def compare(results, baseline, max_regression):
+    regressions = []
+    for name in sorted(results):
+        if name not in baseline:
+            continue
+        ratio = results[name]["median"] / max(baseline[name]["median"], 1e-9)
+        status = "REGRESSED" if ratio > 1 + max_regression else "ok"
+        print("{0:<28} {1:.6f}s -> {2:.6f}s ({3:+.1%}) {4}".format(
+            name, baseline[name]["median"], results[name]["median"], ratio - 1, status), file=sys.stderr)
+        if status != "ok":
+            regressions.append(name)
+    return regressions
+
+def main(args):
+    report = dict(
+        python=platform.python_version(),
+        platform=platform.platform(),
+        time=time.time(),
+        benchmarks=run_benchmarks(args),
+        )
+    if args.output_path == "-":
+        json.dump(report, sys.stdout, indent=2, sort_keys=True)
+        print()
+    else:
+        with open(args.output_path, "w") as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+    if args.save_baseline:
+        with open(args.baseline_path, "w") as baseline_file:
+            json.dump(report, baseline_file, indent=2, sort_keys=True)
+        return 0
+    if not os.path.exists(args.baseline_path):
+        return 0
+    with open(args.baseline_path) as baseline_file:
+        baseline = json.load(baseline_file)["benchmarks"]
+    return 1 if compare(report["benchmarks"], baseline, args.max_regression) else 0
+
+parser = argparse.ArgumentParser()
+parser.add_argument("-k", dest="filter", action="append", default=[],
+                    help="Only run benchmarks whose name contains this string. Can be specified multiple times")
+parser.add_argument("--repeat", type=int, default=5)
+parser.add_argument("-o", "--output", dest="output_path", default="-",
+                    help="File to which results are written as JSON (default: stdout)")
+parser.add_argument("--baseline", dest="baseline_path", default=_DEFAULT_BASELINE_PATH,
+                    help="Baseline results to compare against")
+parser.add_argument("--save-baseline", action="store_true", default=False,
+                    help="Store the results as the new baseline instead of comparing against it")
+parser.add_argument("--max-regression", type=float, default=0.2,
+                    help="Fail if a benchmark's median is slower than the baseline by more than this fraction")
+parser.add_argument("--root-image", default=None,
+                    help="Root image for the end to end chroot benchmarks (which also require root)")
+
+if __name__ == "__main__":
+    sys.exit(main(parser.parse_args()))
@@ -1,86 +1,521 @@
 from contextlib import contextmanager
+import errno
+import fcntl
+import functools
 import itertools
 import json
 import logging
 import os
-import shutil
+import sqlite3
+import stat
+import threading
+import time
 
 from . import resources
+from .python_compat import iteritems, scandir
 
 _logger = logging.getLogger(__name__)
 
-_STATE_FILE_NAME = ".state.json"
+_STATE_DB_FILE_NAME = ".state.sqlite"
+_JSON_STATE_FILE_NAME = ".state.json"
+_LOCK_FILE_NAME = ".state.lock"
+_BUSY_TIMEOUT = 60
+_TRASH_DIR_NAME = "trash"
+# removing an entry costs IO even if it holds no data
+_MIN_ENTRY_COST = 4096
+
+def _get_last_access(item):
+    return item.get("last_access", 0)
+
+def _get_lru_score(item, now):
+    return _get_last_access(item)
+
+def _get_lfu_score(item, now):
+    return (item.get("hits", 0), _get_last_access(item))
+
+def _get_size_weighted_score(item, now):
+    return -item["size"] * (now - _get_last_access(item) + 1)
+
+EVICTION_POLICIES = {
+    "lru" : _get_lru_score,
+    "lfu" : _get_lfu_score,
+    "size" : _get_size_weighted_score,
+    }
+
+def _iter_directory(path):
+    if scandir is None:
+        for filename in os.listdir(path):
+            entry_path = os.path.join(path, filename)
+            entry_stat = os.lstat(entry_path)
+            yield entry_path, stat.S_ISDIR(entry_stat.st_mode), entry_stat
+        return
+    for entry in scandir(path):
+        if entry.is_dir(follow_symlinks=False):
+            yield entry.path, True, None
+        else:
+            yield entry.path, False, entry.stat(follow_symlinks=False)
+
+def _get_file_fingerprint(path):
+    path_stat = os.stat(path)
+    return "file:{0}:{1}:{2}".format(path_stat.st_ino, path_stat.st_mtime, path_stat.st_size)
+
+def serialize_key(key):
+    return json.dumps(key, sort_keys=True)
+
+def _locked(func):
+    @functools.wraps(func)
+    def new_func(self, *args, **kwargs):
+        with self._state_lock():
+            return func(self, *args, **kwargs)
+    return new_func
+
+def _thread_locked(func):
+    # for reads and single-row updates, which SQLite keeps consistent without the state lock
+    @functools.wraps(func)
+    def new_func(self, *args, **kwargs):
+        with self._lock:
+            return func(self, *args, **kwargs)
+    return new_func
+
+def _open_lock_file(path):
+    fd = os.open(path, os.O_RDONLY | os.O_CREAT, 0o666)
+    fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return fd
+
+class _Throttle(object):
+    def __init__(self, max_bytes_per_second):
+        super(_Throttle, self).__init__()
+        self._max_bytes_per_second = max_bytes_per_second
+        self._start_time = time.time()
+        self._num_bytes = 0
+    def consume(self, num_bytes):
+        if not self._max_bytes_per_second:
+            return
+        self._num_bytes += num_bytes
+        delay = self._start_time + float(self._num_bytes) / self._max_bytes_per_second - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+def _remove_path(path, throttle):
+    # entries are removed one by one, so that the IO can be throttled
+    if not os.path.isdir(path) or os.path.islink(path):
+        throttle.consume(max(os.lstat(path).st_size, _MIN_ENTRY_COST))
+        os.unlink(path)
+        return
+    for dirpath, dirnames, filenames in os.walk(path, topdown=False):
+        for name in filenames + [name for name in dirnames if os.path.islink(os.path.join(dirpath, name))]:
+            entry_path = os.path.join(dirpath, name)
+            throttle.consume(max(os.lstat(entry_path).st_size, _MIN_ENTRY_COST))
+            os.unlink(entry_path)
+        throttle.consume(_MIN_ENTRY_COST)
+        os.rmdir(dirpath)
+
+def _link_replacing(src, dst):
+    temp_path = "{0}.{1}.{2}.tmp".format(dst, os.getpid(), threading.current_thread().ident)
+    os.link(src, temp_path)
+    os.rename(temp_path, dst)
+
+_ITEM_FIELDS = ("key", "path", "size", "fingerprint", "last_access", "last_refresh", "hits")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS items (
+    id INTEGER PRIMARY KEY,
+    key TEXT NOT NULL,
+    path TEXT NOT NULL,
+    size INTEGER,
+    fingerprint TEXT,
+    last_access REAL,
+    last_refresh REAL,
+    hits INTEGER NOT NULL DEFAULT 0
+);
+CREATE INDEX IF NOT EXISTS items_by_key ON items (key);
+CREATE INDEX IF NOT EXISTS items_by_path ON items (path);
+CREATE TABLE IF NOT EXISTS incomplete_paths (key TEXT PRIMARY KEY, path TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS meta (name TEXT PRIMARY KEY, value);
+"""
+
+def _item_to_row(item):
+    return (serialize_key(item["key"]), item["path"], item.get("size"), item.get("fingerprint"),
+            item.get("last_access"), item.get("last_refresh"), item.get("hits", 0))
+
+def _row_to_item(row):
+    returned = dict((name, value) for name, value in zip(_ITEM_FIELDS, row) if value is not None)
+    returned["key"] = json.loads(returned["key"])
+    return returned
+
+class CacheState(object):
+    def __init__(self, path):
+        super(CacheState, self).__init__()
+        self.path = path
+        self._connection = None
+        self._connection_pid = None
+    def _get_connection(self):
+        # connections cannot be used across fork
+        if self._connection is None or self._connection_pid != os.getpid():
+            self._connection = sqlite3.connect(self.path, timeout=_BUSY_TIMEOUT, isolation_level=None, check_same_thread=False)
+            self._connection_pid = os.getpid()
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.executescript(_SCHEMA)
+        return self._connection
+    @contextmanager
+    def _transaction(self):
+        connection = self._get_connection()
+        connection.execute("BEGIN IMMEDIATE")
+        try:
+            yield connection
+        except:
+            connection.execute("ROLLBACK")
+            raise
+        connection.execute("COMMIT")
+    def _get_meta(self, connection, name, default=None):
+        row = connection.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return default if row is None else row[0]
+    def _set_meta(self, connection, name, value):
+        connection.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, value))
+    def get_item_by_key(self, key):
+        return self._get_item("key", serialize_key(key))
+    def get_item_by_path(self, path):
+        return self._get_item("path", path)
+    def _get_item(self, column, value):
+        row = self._get_connection().execute(
+            "SELECT {0} FROM items WHERE {1} = ? ORDER BY id LIMIT 1".format(", ".join(_ITEM_FIELDS), column), (value,)).fetchone()
+        return None if row is None else _row_to_item(row)
+    def get_items(self):
+        return [_row_to_item(row) for row in self._get_connection().execute(
+            "SELECT {0} FROM items ORDER BY id".format(", ".join(_ITEM_FIELDS)))]
+    def get_total_size(self):
+        return self._get_connection().execute("SELECT COALESCE(SUM(size), 0) FROM items").fetchone()[0]
+    def add_item(self, item):
+        with self._transaction() as connection:
+            self._insert_items(connection, [item])
+            connection.execute("DELETE FROM incomplete_paths WHERE key = ?", (serialize_key(item["key"]),))
+    def _insert_items(self, connection, items):
+        connection.executemany("INSERT INTO items ({0}) VALUES ({1})".format(
+            ", ".join(_ITEM_FIELDS), ", ".join("?" for _ in _ITEM_FIELDS)), [_item_to_row(item) for item in items])
+    def update_item(self, path, **fields):
+        assert set(fields) <= set(_ITEM_FIELDS) - set(["key", "path"])
+        names = sorted(fields)
+        self._get_connection().execute("UPDATE items SET {0} WHERE path = ?".format(", ".join("{0} = ?".format(name) for name in names)),
+                                       [fields[name] for name in names] + [path])
+    def record_access(self, path, last_access):
+        self._get_connection().execute(
+            "UPDATE items SET last_access = MAX(COALESCE(last_access, 0), ?), hits = hits + 1 WHERE path = ?", (last_access, path))
+    def remove_items(self, paths):
+        with self._transaction() as connection:
+            connection.executemany("DELETE FROM items WHERE path = ?", [(path,) for path in paths])
+    def allocate_id(self):
+        with self._transaction() as connection:
+            returned = self._get_meta(connection, "next_id", 0)
+            self._set_meta(connection, "next_id", returned + 1)
+        return returned
+    def get_incomplete_path(self, key):
+        row = self._get_connection().execute("SELECT path FROM incomplete_paths WHERE key = ?", (serialize_key(key),)).fetchone()
+        return None if row is None else row[0]
+    def set_incomplete_path(self, key, path):
+        self._get_connection().execute("INSERT OR REPLACE INTO incomplete_paths (key, path) VALUES (?, ?)", (serialize_key(key), path))
+    def migrate_from_json(self, json_path):
+        with open(json_path) as json_file:
+            state = json.load(json_file)
+        with self._transaction() as connection:
+            # the flag is committed along with the items, so the migration is never done twice
+            if self._get_meta(connection, "migrated_from_json"):
+                return False
+            self._insert_items(connection, state.get("items", []))
+            for serialized_key, path in iteritems(state.get("incomplete_paths", {})):
+                connection.execute("INSERT OR REPLACE INTO incomplete_paths (key, path) VALUES (?, ?)", (serialized_key, path))
+            self._set_meta(connection, "next_id", max(state.get("next_id", 0), self._get_meta(connection, "next_id", 0)))
+            self._set_meta(connection, "migrated_from_json", 1)
+        return True
+    def close(self):
+        if self._connection is not None and self._connection_pid == os.getpid():
+            self._connection.close()
+        self._connection = None
 
 class Cache(object):
     def __init__(self, path):
         super(Cache, self).__init__()
         self.root = path
-        self._state_file_path = os.path.join(self.root, _STATE_FILE_NAME)
-        self._load_state()
-    def _load_state(self):
-        if os.path.exists(self._state_file_path):
-            self._load_state_from_file()
-        else:
-            self._load_new_state()
-    def _load_state_from_file(self):
-        with open(self._state_file_path) as state_file:
-            self._state = json.loads(state_file.read())
-    def _save_state_to_file(self):
-        with open(self._state_file_path, "w") as state_file:
-            state_file.write(json.dumps(self._state))
-    def _load_new_state(self):
-        self._state = dict(items = [], next_id=0)
+        self._lock = threading.RLock()
+        self._lock_depth = 0
+        self._lock_fd = None
+        self._pinned_fds = {}
+        self._named_locks = {}
+        if not os.path.isdir(self.root):
+            os.makedirs(self.root)
+        self._state = CacheState(os.path.join(self.root, _STATE_DB_FILE_NAME))
+        with self._state_lock():
+            self._migrate_json_state()
+    @contextmanager
+    def _state_lock(self):
+        with self._lock:
+            if self._lock_depth == 0:
+                self._lock_fd = _open_lock_file(os.path.join(self.root, _LOCK_FILE_NAME))
+                fcntl.flock(self._lock_fd, fcntl.LOCK_EX)
+            self._lock_depth += 1
+            try:
+                yield
+            finally:
+                self._lock_depth -= 1
+                if self._lock_depth == 0:
+                    os.close(self._lock_fd)
+                    self._lock_fd = None
+    def _migrate_json_state(self):
+        json_state_path = os.path.join(self.root, _JSON_STATE_FILE_NAME)
+        if not os.path.exists(json_state_path):
+            return
+        if self._state.migrate_from_json(json_state_path):
+            _logger.info("Migrated cache state from %s", json_state_path)
+        os.rename(json_state_path, json_state_path + ".migrated")
+    @contextmanager
+    def exclusive_lock(self, name):
+        with self._lock:
+            thread_lock = self._named_locks.setdefault(name, threading.Lock())
+        with thread_lock:
+            lock_path = os.path.join(self.root, "locks", "{0}.lock".format(name))
+            lock_fd = self._open_item_lock_file(lock_path)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX)
+                yield
+            finally:
+                os.close(lock_fd)
+    @_thread_locked
     def get_path(self, key):
-        for existing_item in self._state["items"]:
-            if existing_item["key"] == key:
-                return existing_item["path"]
-        return None
-    def create_new_path(self):
+        item = self._state.get_item_by_key(key)
+        if item is None:
+            return None
+        path = item["path"]
+        self._pin(path)
+        # items are removed from the state before their lock is released, so a pinned item still in the state stays
+        if self._state.get_item_by_path(path) is None:
+            self._unpin(path)
+            return None
+        self._state.record_access(path, time.time())
+        return path
+    @_locked
+    def create_new_path(self, key=None):
+        if key is not None:
+            path = self._state.get_incomplete_path(key)
+            if path is not None and os.path.isdir(path) and self._try_pin_exclusively(path):
+                _logger.debug("Reusing incomplete path %s for %r", path, key)
+                return path
         while True:
-            item_id = self._state["next_id"]
-            self._state["next_id"] += 1
-            path = os.path.join(self.root, "items", str(item_id))
+            path = os.path.join(self.root, "items", str(self._state.allocate_id()))
             if not os.path.exists(path):
                 break
         os.makedirs(path)
+        self._pin(path)
+        if key is not None:
+            self._state.set_incomplete_path(key, path)
         return path
-    def register_new_path(self, path, key):
-        self._state["items"].append(dict(
-            key=key, path=path, size=self._get_path_total_size(path)
-            ))
-        self._save_state_to_file()
-    def _get_path_total_size(self, path):
-        return sum(os.path.getsize(os.path.join(p, filename)) 
-                   for p, _, filenames in os.walk(path)
-                   for filename in filenames)
-    def update_path(self, path):
-        for item in self._state["items"]:
-            if item["path"] == path:
-                item["size"] = self._get_path_total_size(path)
-                break
-        else:
+    def register_new_path(self, path, key, fingerprint=None):
+        now = time.time()
+        item = dict(key=key, path=path, last_access=now, last_refresh=now, hits=0)
+        self._update_item_size(item, fingerprint)
+        with self._state_lock():
+            self._pin(path)
+            self._state.add_item(item)
+    def update_path(self, path, fingerprint=None):
+        with self._lock:
+            updated_item = dict(self._get_item_by_path(path))
+        if not self._update_item_size(updated_item, fingerprint):
+            return
+        with self._state_lock():
+            self._get_item_by_path(path)
+            self._state.update_item(path, size=updated_item["size"], fingerprint=updated_item["fingerprint"])
+    @_thread_locked
+    def get_last_refresh(self, path):
+        return self._get_item_by_path(path).get("last_refresh")
+    @_thread_locked
+    def mark_refreshed(self, path):
+        self._get_item_by_path(path)
+        self._state.update_item(path, last_refresh=time.time())
+    def _get_item_by_path(self, path):
+        item = self._state.get_item_by_path(path)
+        if item is None:
             raise LookupError("{0} not found in cache state".format(path))
-    def cleanup(self, max_size, skip_keys):
-        current_size = sum(item["size"] for item in self._state["items"])
-        to_remove = []
-        for index, item in enumerate(self._state["items"]):
+        return item
+    def _update_item_size(self, item, fingerprint):
+        path = item["path"]
+        if fingerprint is None and os.path.isfile(path):
+            fingerprint = _get_file_fingerprint(path)
+        if fingerprint is not None and "size" in item and item.get("fingerprint") == fingerprint:
+            _logger.debug("%s is unchanged (%s), skipping size calculation", path, fingerprint)
+            return False
+        item["size"] = self._get_path_total_size(path)
+        item["fingerprint"] = fingerprint
+        return True
+    def _get_path_total_size(self, path):
+        if not os.path.isdir(path):
+            return os.path.getsize(path)
+        returned = 0
+        seen_inodes = set()
+        directories = [path]
+        while directories:
+            for entry_path, is_dir, entry_stat in _iter_directory(directories.pop()):
+                if is_dir:
+                    directories.append(entry_path)
+                    continue
+                if entry_stat.st_nlink > 1:
+                    if entry_stat.st_ino in seen_inodes:
+                        continue
+                    seen_inodes.add(entry_stat.st_ino)
+                returned += entry_stat.st_size
+        return returned
+    @_locked
+    def cleanup(self, max_size, skip_keys, policy="lru"):
+        if max_size is None or self._state.get_total_size() <= max_size:
+            return
+        items = self._state.get_items()
+        current_size = sum(item["size"] for item in items)
+        skip_keys = set(serialize_key(key) for key in skip_keys)
+        for item in self._get_eviction_order(items, policy):
             if current_size <= max_size:
                 break
-            if item["key"] not in skip_keys:
-                item_size = item["size"]
-                current_size -= item_size
-                to_remove.append((index, item))
+            # items in use by other processes are skipped, and the next candidates evicted instead
+            if serialize_key(item["key"]) not in skip_keys and self._purge_item(item):
+                current_size -= item["size"]
+    def _purge_item(self, item):
+        path = item["path"]
+        self._unpin(path)
+        lock_path = self._get_item_lock_path(path)
+        lock_fd = self._open_item_lock_file(lock_path)
         try:
-            for index, item in reversed(to_remove):
-                _logger.debug("Purging cache item %r", item["key"])
-                path = item["path"]
-                if os.path.isdir(path):
-                    shutil.rmtree(path)
-                else:
-                    os.unlink(path)
-                self._state["items"].pop(index)
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                _logger.debug("Cache item %r is in use by another process, not purging", item["key"])
+                return False
+            _logger.debug("Purging cache item %r", item["key"])
+            self._move_to_trash(self._get_item_root(path))
+            # removed while the lock is held, for lookups pinning the item concurrently to miss it
+            self._state.remove_items([path])
+            os.unlink(lock_path)
+            return True
         finally:
-            self._save_state_to_file()
-            
-        
-
+            os.close(lock_fd)
+    def _move_to_trash(self, path):
+        if not os.path.lexists(path):
+            return
+        trash_path = os.path.join(self.root, _TRASH_DIR_NAME)
+        if not os.path.isdir(trash_path):
+            os.makedirs(trash_path)
+        try:
+            # the space is reclaimed later by reap_trash, off the critical path
+            os.rename(path, os.path.join(trash_path, "{0}.{1}.{2}".format(
+                os.path.basename(path), os.getpid(), threading.current_thread().ident)))
+        except OSError as e:
+            if e.errno != errno.EXDEV:
+                raise
+            _remove_path(path, _Throttle(None))
+    def has_trash(self):
+        trash_path = os.path.join(self.root, _TRASH_DIR_NAME)
+        return os.path.isdir(trash_path) and bool(os.listdir(trash_path))
+    def reap_trash(self, max_bytes_per_second=None):
+        lock_fd = self._open_item_lock_file(os.path.join(self.root, "locks", "reaper.lock"))
+        try:
+            try:
+                fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except (IOError, OSError) as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+                _logger.debug("The trash is already being reaped by another process")
+                return False
+            trash_path = os.path.join(self.root, _TRASH_DIR_NAME)
+            throttle = _Throttle(max_bytes_per_second)
+            for name in os.listdir(trash_path) if os.path.isdir(trash_path) else []:
+                _logger.debug("Reaping %s", name)
+                try:
+                    _remove_path(os.path.join(trash_path, name), throttle)
+                except OSError as e:
+                    _logger.warning("Cannot remove %s from the trash (%s)", name, e)
+            # blobs of purged items lose their last reference once the trash is reaped
+            with self._state_lock():
+                self._purge_unreferenced_blobs()
+            return True
+        finally:
+            os.close(lock_fd)
+    def _get_eviction_order(self, items, policy):
+        get_score = EVICTION_POLICIES[policy]
+        now = time.time()
+        return sorted(items, key=lambda item: get_score(item, now))
+    def _get_item_id(self, path):
+        return os.path.relpath(path, os.path.join(self.root, "items")).split(os.sep)[0]
+    def _get_item_root(self, path):
+        item_id = self._get_item_id(path)
+        if item_id == os.pardir:
+            return path
+        return os.path.join(self.root, "items", item_id)
+    def _get_item_lock_path(self, path):
+        return os.path.join(self.root, "locks", "{0}.lock".format(self._get_item_id(path)))
+    def _pin(self, path):
+        lock_path = self._get_item_lock_path(path)
+        if lock_path in self._pinned_fds:
+            return
+        lock_fd = self._open_item_lock_file(lock_path)
+        fcntl.flock(lock_fd, fcntl.LOCK_SH)
+        self._pinned_fds[lock_path] = lock_fd
+    def _try_pin_exclusively(self, path):
+        lock_path = self._get_item_lock_path(path)
+        if lock_path in self._pinned_fds:
+            return False
+        lock_fd = self._open_item_lock_file(lock_path)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError) as e:
+            os.close(lock_fd)
+            if e.errno not in (errno.EAGAIN, errno.EACCES):
+                raise
+            return False
+        fcntl.flock(lock_fd, fcntl.LOCK_SH)
+        self._pinned_fds[lock_path] = lock_fd
+        return True
+    def _open_item_lock_file(self, lock_path):
+        if not os.path.isdir(os.path.dirname(lock_path)):
+            os.makedirs(os.path.dirname(lock_path))
+        return _open_lock_file(lock_path)
+    def _get_blob_path(self, digest):
+        return os.path.join(self.root, "blobs", "sha256", digest[:2], digest)
+    def has_blob(self, digest):
+        return os.path.isfile(self._get_blob_path(digest))
+    @_locked
+    def link_blob(self, digest, path):
+        blob_path = self._get_blob_path(digest)
+        if not os.path.isfile(blob_path):
+            return False
+        _logger.debug("Linking blob %s to %s", digest, path)
+        _link_replacing(blob_path, path)
+        return True
+    @_locked
+    def add_blob(self, path, digest):
+        blob_path = self._get_blob_path(digest)
+        if os.path.isfile(blob_path):
+            if not os.path.samefile(blob_path, path):
+                _logger.debug("%s has the same contents as blob %s, deduplicating", path, digest)
+                _link_replacing(blob_path, path)
+            return
+        if not os.path.isdir(os.path.dirname(blob_path)):
+            os.makedirs(os.path.dirname(blob_path))
+        _link_replacing(path, blob_path)
+    def _purge_unreferenced_blobs(self):
+        blobs_root = os.path.join(self.root, "blobs")
+        if not os.path.isdir(blobs_root):
+            return
+        for dirpath, _, filenames in os.walk(blobs_root):
+            for filename in filenames:
+                blob_path = os.path.join(dirpath, filename)
+                if os.stat(blob_path).st_nlink == 1:
+                    _logger.debug("Purging unreferenced blob %s", filename)
+                    os.unlink(blob_path)
+    def close(self):
+        with self._lock:
+            for lock_fd in self._pinned_fds.values():
+                os.close(lock_fd)
+            self._pinned_fds.clear()
+            self._state.close()
+    def _unpin(self, path):
+        lock_fd = self._pinned_fds.pop(self._get_item_lock_path(path), None)
+        if lock_fd is not None:
+            os.close(lock_fd)
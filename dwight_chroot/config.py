@@ -1,15 +1,26 @@
 import copy
+import hashlib
+import marshal
 import os
+import threading
 
 from .exceptions import (
     CannotLoadConfiguration,
     InvalidConfiguration,
     NotRootException,
     UnknownConfigurationOptions,
+    UsageException,
     )
+from .cache import EVICTION_POLICIES, serialize_key
 from .include import Include
+from .python_compat import PYTHON_MAGIC, iteritems
+from .resources import RefreshPolicy
+from .staging import STAGE_TYPES
+
+OVERLAY_TYPES = (None, "tmpfs", "persistent")
 
 _USER_CONFIG_FILE_PATH = os.path.expanduser("~/.dwightrc")
+_COMPILED_CONFIG_CACHE_DIR = os.path.expanduser("~/.dwight-cache/compiled_config")
 
 _USER_CONFIG_FILE_TEMPLATE = """# AUTOGENERATED DEFAULT CONFIG
 # ROOT_IMAGE = "/some/path/here"
@@ -24,12 +35,97 @@ _USER_CONFIG_FILE_TEMPLATE = """# AUTOGENERATED DEFAULT CONFIG
 # ENVIRON = {}
 # UID = None # None means taking the uid from SUDO_UID
 # PWD = os.path.abspath(".")
-# NUM_LOOP_DEVICES = 64 # The number of loop to ensure that exist before chrooting
+# NUM_LOOP_DEVICES = 64 # The number of loop to ensure that exist before chrooting (ignored if /dev/loop-control exists)
+# MAX_CACHE_SIZE = None # Maximum size of the cache directory, in bytes
+# CACHE_EVICTION_POLICY = "lru" # One of "lru", "lfu" or "size"
+# CACHE_REAPER_RATE = 64 * 1024 * 1024 # Maximum rate at which evicted items are deleted in the background, in bytes per second
+# NUM_FETCH_WORKERS = 4 # The number of resources to fetch concurrently
+# REFRESH_POLICY = "always" # When to refresh cached resources: "always", "never" or "ttl=<seconds>"
+# OVERLAY = None # Writable layer over the root image: None (read-only), "tmpfs" or "persistent"
+# OVERLAY_NAME = "default" # The name of the persistent overlay to use
+# OFFLINE = False # If True, resources are never fetched or refreshed, and must already be in the cache
+# STAGING_DIR = "/dev/shm/dwight-staging" # Where images included with stage="ram" are copied (should be on tmpfs)
+# MAX_STAGING_SIZE = None # Maximum total size of the images staged in STAGING_DIR, in bytes (default: half of its filesystem)
 """
 
-class DwightConfiguration(object):
+class _CompiledConfigCache(object):
     def __init__(self):
+        super(_CompiledConfigCache, self).__init__()
+        self._lock = threading.Lock()
+        self._code_by_path = {}
+    def get_code(self, path, cache_dir):
+        path = os.path.abspath(path)
+        try:
+            path_stat = os.stat(path)
+        except OSError as e:
+            raise CannotLoadConfiguration("Cannot load configuration from {0} ({1})".format(path, e))
+        signature = (repr(path_stat.st_mtime), path_stat.st_size)
+        with self._lock:
+            cached = self._code_by_path.get(path)
+        if cached is not None and cached[0] == signature:
+            return cached[1]
+        code = None
+        compiled_path = None
+        if cache_dir is not None:
+            compiled_path = os.path.join(cache_dir, "{0}.bin".format(hashlib.sha1(path.encode("utf-8")).hexdigest()))
+            code = self._load_compiled(compiled_path, signature)
+        if code is None:
+            with open(path) as config_file:
+                code = _compile(config_file.read(), path)
+            if compiled_path is not None:
+                self._save_compiled(compiled_path, signature, code)
+        with self._lock:
+            self._code_by_path[path] = (signature, code)
+        return code
+    def _load_compiled(self, compiled_path, signature):
+        try:
+            with open(compiled_path, "rb") as compiled_file:
+                if compiled_file.read(len(PYTHON_MAGIC)) != PYTHON_MAGIC:
+                    return None
+                saved_signature, code = marshal.loads(compiled_file.read())
+        except Exception:
+            return None
+        if tuple(saved_signature) != signature:
+            return None
+        return code
+    def _save_compiled(self, compiled_path, signature, code):
+        temp_path = "{0}.{1}.tmp".format(compiled_path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(compiled_path)):
+                os.makedirs(os.path.dirname(compiled_path))
+            with open(temp_path, "wb") as compiled_file:
+                compiled_file.write(PYTHON_MAGIC)
+                compiled_file.write(marshal.dumps((signature, code)))
+            os.rename(temp_path, compiled_path)
+        except (IOError, OSError):
+            # the compiled code is only an optimization
+            pass
+
+_compiled_config_cache = _CompiledConfigCache()
+
+_SNAPSHOT_PRIMITIVE_TYPES = (bool, int, float, str, type(u""))
+
+def _compile(s, filename="<string>"):
+    try:
+        return compile(s, filename, "exec")
+    except Exception as e:
+        raise CannotLoadConfiguration("Cannot load configuration ({0})".format(e))
+
+def _get_snapshot_value(value):
+    if isinstance(value, Include):
+        return value.to_dict()
+    if isinstance(value, (list, tuple)):
+        return [_get_snapshot_value(item) for item in value]
+    if isinstance(value, dict):
+        return dict((str(key), _get_snapshot_value(item)) for key, item in iteritems(value))
+    if value is None or isinstance(value, _SNAPSHOT_PRIMITIVE_TYPES):
+        return value
+    return repr(value)
+
+class DwightConfiguration(object):
+    def __init__(self, compiled_cache_dir=_COMPILED_CONFIG_CACHE_DIR):
         super(DwightConfiguration, self).__init__()
+        self._compiled_cache_dir = compiled_cache_dir
         self._config = dict(
             ROOT_IMAGE = None,
             INCLUDES = [],
@@ -39,6 +135,15 @@ class DwightConfiguration(object):
             PWD = os.path.abspath("."),
             NUM_LOOP_DEVICES = None,
             MAX_CACHE_SIZE = None,
+            CACHE_EVICTION_POLICY = "lru",
+            CACHE_REAPER_RATE = 64 * 1024 * 1024,
+            NUM_FETCH_WORKERS = 4,
+            REFRESH_POLICY = "always",
+            OVERLAY = None,
+            OVERLAY_NAME = "default",
+            OFFLINE = False,
+            STAGING_DIR = "/dev/shm/dwight-staging",
+            MAX_STAGING_SIZE = None,
             )
         self._known_keys = set(self._config)
     def __getitem__(self, key):
@@ -48,20 +153,28 @@ class DwightConfiguration(object):
             raise UnknownConfigurationOptions("Unknown configuration option: {0!r}".format(key))
         self._config[key] = value
 
+    def copy(self):
+        returned = type(self)(self._compiled_cache_dir)
+        returned._config = dict((key, copy.copy(value)) for key, value in iteritems(self._config))
+        return returned
     def process_user_config_file(self, user_config_file_path=_USER_CONFIG_FILE_PATH):
         if not os.path.isfile(user_config_file_path):
             self._ensure_user_config_file(user_config_file_path)
-        with open(user_config_file_path) as user_config_file:
-            self.load_from_string(user_config_file.read())
+        self.load_from_file(user_config_file_path)
     def _ensure_user_config_file(self, user_config_file_path):
         if not os.path.isdir(os.path.dirname(user_config_file_path)):
             os.makedirs(os.path.dirname(user_config_file_path))
         with open(user_config_file_path, "w") as user_config_file:
             user_config_file.write(_USER_CONFIG_FILE_TEMPLATE)
+    def load_from_file(self, path):
+        self._load_code(_compiled_config_cache.get_code(path, self._compiled_cache_dir))
     def load_from_string(self, s):
-        d = copy.deepcopy(self._config)
+        self._load_code(_compile(s))
+    def _load_code(self, code):
+        # copying the top-level values is enough for statements like INCLUDES += [...] not to modify the current configuration
+        d = dict((key, copy.copy(value)) for key, value in iteritems(self._config))
         try:
-            exec(s, {"Include" : Include}, d)
+            exec(code, {"Include" : Include}, d)
         except Exception as e:
             raise CannotLoadConfiguration("Cannot load configuration ({0})".format(e))
         for key in list(d):
@@ -73,7 +186,25 @@ class DwightConfiguration(object):
         unknown = set(d) - self._known_keys
         if unknown:
             raise UnknownConfigurationOptions("Unknown configuration options: {0}".format(", ".join(map(repr, unknown))))
+    def get_snapshot(self):
+        return _get_snapshot_value(self._config)
+    def get_hash(self):
+        return hashlib.sha1(serialize_key(self.get_snapshot()).encode("utf-8")).hexdigest()
     def check(self):
         if self._config.get("ROOT_IMAGE", None) is None:
             raise InvalidConfiguration("ROOT_IMAGE option is not set")
+        if self._config["CACHE_EVICTION_POLICY"] not in EVICTION_POLICIES:
+            raise InvalidConfiguration("Unknown CACHE_EVICTION_POLICY: {0!r}".format(self._config["CACHE_EVICTION_POLICY"]))
+        try:
+            RefreshPolicy.from_string(self._config["REFRESH_POLICY"])
+        except UsageException as e:
+            raise InvalidConfiguration("Invalid REFRESH_POLICY ({0})".format(e))
+        if self._config["OVERLAY"] not in OVERLAY_TYPES:
+            raise InvalidConfiguration("Unknown OVERLAY: {0!r}".format(self._config["OVERLAY"]))
+        overlay_name = self._config["OVERLAY_NAME"]
+        if not overlay_name or "/" in overlay_name or overlay_name.startswith("."):
+            raise InvalidConfiguration("Invalid OVERLAY_NAME: {0!r}".format(overlay_name))
+        for include in [self._config["ROOT_IMAGE"]] + list(self._config["INCLUDES"]):
+            if isinstance(include, Include) and include.stage not in STAGE_TYPES:
+                raise InvalidConfiguration("Unknown stage for {0}: {1!r}".format(include.dest, include.stage))
 
@@ -0,0 +1,355 @@
+import hashlib
+import json
+import logging
+import os
+import re
+import threading
+import time
+
+from .exceptions import ChecksumMismatch, DownloadFailed
+from .python_compat import httplib, urllib2, urlsplit
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_BUFFER_SIZE = 1024 * 1024
+_SEGMENT_CHUNK_SIZE = 16 * 1024 * 1024
+_PROGRESS_LOG_INTERVAL = 5
+PARTIAL_SUFFIX = ".partial"
+_SEGMENTS_PROGRESS_SUFFIX = ".segments"
+
+def download(url, output_path, buffer_size=None, validators=None, partial_path=None, segments=None, sha256=None):
+    if buffer_size is None:
+        buffer_size = DEFAULT_BUFFER_SIZE
+    if partial_path is None:
+        partial_path = output_path + PARTIAL_SUFFIX
+    if segments is not None and segments > 1:
+        downloader = _SegmentedDownload(url, output_path, partial_path, buffer_size, segments, validators, sha256)
+        try:
+            return downloader.download()
+        except _RangesNotSupported:
+            _logger.debug("Segmented download of %s is not possible, falling back to a single stream", url)
+    return _download_stream(url, output_path, partial_path, buffer_size, validators, sha256)
+
+def get_file_sha256(path, buffer_size=DEFAULT_BUFFER_SIZE):
+    hasher = hashlib.sha256()
+    _update_hash_from_file(hasher, path, buffer_size)
+    return hasher.hexdigest()
+
+def _update_hash_from_file(hasher, path, buffer_size):
+    with open(path, "rb") as f:
+        while True:
+            buff = f.read(buffer_size)
+            if not buff:
+                break
+            hasher.update(buff)
+
+def _verify_checksum(url, partial_path, expected_sha256, actual_sha256):
+    if expected_sha256 is not None and actual_sha256 != expected_sha256.lower():
+        os.unlink(partial_path)
+        raise ChecksumMismatch("Checksum mismatch for {0} (expected sha256 {1}, got {2})".format(
+            url, expected_sha256, actual_sha256))
+
+def _download_stream(url, output_path, partial_path, buffer_size, validators, expected_sha256):
+    progress_path = partial_path + _SEGMENTS_PROGRESS_SUFFIX
+    if os.path.exists(progress_path):
+        _unlink_if_exists(partial_path)
+        os.unlink(progress_path)
+    if validators and os.path.exists(partial_path):
+        os.unlink(partial_path)
+    offset = _get_partial_size(partial_path)
+    try:
+        response = _open_url(url, offset, validators)
+    except _NotModified:
+        _logger.debug("%s was not modified", url)
+        return None
+    if response is None:
+        _logger.debug("Server could not satisfy range for %s, restarting download", url)
+        os.unlink(partial_path)
+        offset = 0
+        response = _open_url(url, offset)
+    try:
+        if offset and _get_response_start_offset(response) != offset:
+            _logger.debug("Server does not support resuming %s, restarting download", url)
+            offset = 0
+        if offset:
+            _logger.info("Resuming %s from byte %s", url, offset)
+        else:
+            _logger.info("Fetching %s", url)
+        total_size = _get_content_length(response)
+        if total_size is not None:
+            total_size += offset
+        hasher = hashlib.sha256()
+        if offset:
+            _update_hash_from_file(hasher, partial_path, buffer_size)
+        with open(partial_path, "ab" if offset else "wb") as output_file:
+            size = _copy_stream(response, output_file, buffer_size, offset, total_size, url, hasher)
+        returned = _get_validators(response)
+    finally:
+        response.close()
+    if total_size is not None and size != total_size:
+        raise DownloadFailed("Download of {0} is incomplete ({1} out of {2} bytes)".format(url, size, total_size))
+    returned["sha256"] = hasher.hexdigest()
+    _verify_checksum(url, partial_path, expected_sha256, returned["sha256"])
+    os.rename(partial_path, output_path)
+    return returned
+
+def _unlink_if_exists(path):
+    if os.path.exists(path):
+        os.unlink(path)
+
+def _get_partial_size(partial_path):
+    if os.path.exists(partial_path):
+        return os.path.getsize(partial_path)
+    return 0
+
+class _NotModified(Exception):
+    pass
+
+def _open_url(url, offset, validators=None):
+    request = urllib2.Request(url)
+    if offset:
+        request.add_header("Range", "bytes={0}-".format(offset))
+    if validators:
+        if validators.get("etag"):
+            request.add_header("If-None-Match", validators["etag"])
+        if validators.get("last_modified"):
+            request.add_header("If-Modified-Since", validators["last_modified"])
+    try:
+        return urllib2.urlopen(request)
+    except urllib2.HTTPError as e:
+        if e.code == 304 and validators:
+            raise _NotModified()
+        if e.code == 416 and offset:
+            return None
+        raise DownloadFailed("Cannot fetch {0} ({1})".format(url, e))
+    except urllib2.URLError as e:
+        raise DownloadFailed("Cannot fetch {0} ({1})".format(url, e))
+
+def _get_validators(response):
+    headers = response.info()
+    return dict(etag=headers.get("ETag"), last_modified=headers.get("Last-Modified"))
+
+def _get_response_start_offset(response):
+    if response.getcode() != 206:
+        return 0
+    match = re.match(r"bytes\s+(\d+)-", response.info().get("Content-Range", ""))
+    if match is None:
+        return 0
+    return int(match.group(1))
+
+def _get_content_length(response):
+    content_length = response.info().get("Content-Length")
+    if content_length is None:
+        return None
+    return int(content_length)
+
+def _copy_stream(response, output_file, buffer_size, offset, total_size, url, hasher):
+    progress = _ProgressLogger(url, offset, total_size)
+    size = offset
+    while True:
+        try:
+            buff = response.read(buffer_size)
+        except (IOError, httplib.HTTPException) as e:
+            raise DownloadFailed("Download of {0} was interrupted after {1} bytes ({2!r})".format(url, size, e))
+        if not buff:
+            break
+        output_file.write(buff)
+        hasher.update(buff)
+        size += len(buff)
+        progress.update(size)
+    progress.finish(size)
+    return size
+
+class _RangesNotSupported(Exception):
+    pass
+
+class _SegmentedDownload(object):
+    def __init__(self, url, output_path, partial_path, buffer_size, num_segments, validators, sha256):
+        super(_SegmentedDownload, self).__init__()
+        self._url = url
+        self._scheme, self._netloc, path, query, _ = urlsplit(url)
+        self._path = path or "/"
+        if query:
+            self._path += "?" + query
+        self._output_path = output_path
+        self._partial_path = partial_path
+        self._progress_path = partial_path + _SEGMENTS_PROGRESS_SUFFIX
+        self._buffer_size = buffer_size
+        self._num_segments = num_segments
+        self._validators = validators
+        self._expected_sha256 = sha256
+        self._lock = threading.Lock()
+        self._chunks = []
+        self._completed_chunks = set()
+        self._errors = []
+    def download(self):
+        if self._scheme not in ("http", "https"):
+            raise _RangesNotSupported()
+        total_size, validators = self._probe()
+        if total_size is None:
+            return None
+        chunk_size = self._prepare_partial_file(total_size, validators)
+        self._chunks = [(start, min(start + chunk_size, total_size) - 1)
+                        for start in range(0, total_size, chunk_size)]
+        remaining = [chunk for chunk in self._chunks if chunk[0] not in self._completed_chunks]
+        if len(remaining) < len(self._chunks):
+            _logger.info("Resuming %s (%s out of %s segments left)", self._url, len(remaining), len(self._chunks))
+        else:
+            _logger.info("Fetching %s using %s connections", self._url, self._num_segments)
+        self._progress = _ProgressLogger(self._url, 0, total_size)
+        self._downloaded_size = total_size - sum(end - start + 1 for start, end in remaining)
+        fd = os.open(self._partial_path, os.O_WRONLY)
+        try:
+            threads = [threading.Thread(target=self._worker, args=(fd, remaining))
+                       for _ in range(min(self._num_segments, len(remaining)))]
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+        finally:
+            os.close(fd)
+        if self._errors:
+            raise self._errors[0]
+        self._progress.finish(total_size)
+        os.unlink(self._progress_path)
+        # segments arrive out of order, so the checksum is computed from the (page-cached) partial file
+        validators["sha256"] = get_file_sha256(self._partial_path, self._buffer_size)
+        _verify_checksum(self._url, self._partial_path, self._expected_sha256, validators["sha256"])
+        os.rename(self._partial_path, self._output_path)
+        return validators
+    def _get_chunk_size(self, total_size):
+        return max(min(_SEGMENT_CHUNK_SIZE, total_size // self._num_segments), 1)
+    def _connect(self):
+        if self._scheme == "https":
+            return httplib.HTTPSConnection(self._netloc)
+        return httplib.HTTPConnection(self._netloc)
+    def _probe(self):
+        headers = {"Range" : "bytes=0-0"}
+        if self._validators:
+            if self._validators.get("etag"):
+                headers["If-None-Match"] = self._validators["etag"]
+            if self._validators.get("last_modified"):
+                headers["If-Modified-Since"] = self._validators["last_modified"]
+        connection = self._connect()
+        try:
+            try:
+                connection.request("GET", self._path, headers=headers)
+                response = connection.getresponse()
+            except (IOError, httplib.HTTPException) as e:
+                raise DownloadFailed("Cannot fetch {0} ({1!r})".format(self._url, e))
+        finally:
+            # the body is never read: a server ignoring the range would send the whole file
+            connection.close()
+        if response.status == 304 and self._validators:
+            _logger.debug("%s was not modified", self._url)
+            return None, None
+        match = re.match(r"bytes\s+0-0/(\d+)$", response.getheader("Content-Range", ""))
+        if response.status != 206 or match is None:
+            raise _RangesNotSupported()
+        validators = dict(etag=response.getheader("ETag"), last_modified=response.getheader("Last-Modified"))
+        return int(match.group(1)), validators
+    def _prepare_partial_file(self, total_size, validators):
+        progress = self._load_progress()
+        if progress is not None and os.path.exists(self._partial_path) and \
+           progress.get("size") == total_size and progress.get("validators") == validators and \
+           progress.get("chunk_size") and not self._validators:
+            chunk_size = progress["chunk_size"]
+            self._completed_chunks = set(progress.get("completed", []))
+        else:
+            chunk_size = self._get_chunk_size(total_size)
+            with open(self._partial_path, "wb") as partial_file:
+                partial_file.truncate(total_size)
+        self._progress_state = dict(size=total_size, validators=validators, chunk_size=chunk_size,
+                                    completed=sorted(self._completed_chunks))
+        self._save_progress()
+        return chunk_size
+    def _load_progress(self):
+        if not os.path.exists(self._progress_path):
+            return None
+        with open(self._progress_path) as progress_file:
+            return json.load(progress_file)
+    def _save_progress(self):
+        temp_path = self._progress_path + ".tmp"
+        with open(temp_path, "w") as progress_file:
+            json.dump(self._progress_state, progress_file)
+        os.rename(temp_path, self._progress_path)
+    def _worker(self, fd, remaining):
+        connection = None
+        try:
+            while not self._errors:
+                with self._lock:
+                    if not remaining:
+                        break
+                    start, end = remaining.pop(0)
+                if connection is None:
+                    connection = self._connect()
+                self._fetch_chunk(connection, fd, start, end)
+                with self._lock:
+                    self._completed_chunks.add(start)
+                    self._progress_state["completed"] = sorted(self._completed_chunks)
+                    self._save_progress()
+        except Exception as e:
+            with self._lock:
+                self._errors.append(e)
+        finally:
+            if connection is not None:
+                connection.close()
+    def _fetch_chunk(self, connection, fd, start, end):
+        try:
+            connection.request("GET", self._path, headers={"Range" : "bytes={0}-{1}".format(start, end)})
+            response = connection.getresponse()
+            if response.status != 206:
+                # the connection is closed by the worker, so the (possibly whole file) body is not read
+                raise DownloadFailed("Unexpected response for range {0}-{1} of {2}: {3}".format(
+                    start, end, self._url, response.status))
+            offset = start
+            while offset <= end:
+                buff = response.read(min(self._buffer_size, end - offset + 1))
+                if not buff:
+                    raise DownloadFailed("Download of {0} was interrupted at byte {1}".format(self._url, offset))
+                _write_at(fd, buff, offset)
+                offset += len(buff)
+                with self._lock:
+                    self._downloaded_size += len(buff)
+                    self._progress.update(self._downloaded_size)
+        except (IOError, httplib.HTTPException) as e:
+            raise DownloadFailed("Download of {0} was interrupted ({1!r})".format(self._url, e))
+
+if hasattr(os, "pwrite"):
+    def _write_at(fd, data, offset):
+        while data:
+            written = os.pwrite(fd, data, offset)
+            data = data[written:]
+            offset += written
+else:
+    _write_lock = threading.Lock()
+    def _write_at(fd, data, offset):
+        with _write_lock:
+            os.lseek(fd, offset, os.SEEK_SET)
+            while data:
+                data = data[os.write(fd, data):]
+
+class _ProgressLogger(object):
+    def __init__(self, url, offset, total_size):
+        super(_ProgressLogger, self).__init__()
+        self._url = url
+        self._offset = offset
+        self._total_size = total_size
+        self._start_time = self._last_log_time = time.time()
+    def update(self, size):
+        now = time.time()
+        if now - self._last_log_time < _PROGRESS_LOG_INTERVAL:
+            return
+        self._last_log_time = now
+        if self._total_size:
+            _logger.info("%s: %s/%s bytes (%d%%) at %s",
+                         self._url, size, self._total_size, 100 * size // self._total_size, self._get_throughput(size, now))
+        else:
+            _logger.info("%s: %s bytes at %s", self._url, size, self._get_throughput(size, now))
+    def finish(self, size):
+        now = time.time()
+        _logger.info("Fetched %s bytes of %s in %.1f seconds (%s)",
+                     size - self._offset, self._url, now - self._start_time, self._get_throughput(size, now))
+    def _get_throughput(self, size, now):
+        elapsed = max(now - self._start_time, 0.001)
+        return "{0:.2f} MB/s".format((size - self._offset) / elapsed / (1024 * 1024))
@@ -1,16 +1,30 @@
+from collections import OrderedDict, deque
+from contextlib import contextmanager
+import json
 import logging
+from multiprocessing.pool import ThreadPool
 import os
+import re
 import string
 import subprocess
 import sys
 import functools
+from tempfile import mkdtemp
+import time
 
-from .cache import Cache
+from .cache import Cache, serialize_key
 from .config import DwightConfiguration
 from .exceptions import NotRootException, CannotMountPath
+from .include import Include
+from .loop_devices import LoopDeviceManager
+from .mounts import MountRoots
 from .platform_utils import (
-    execute_command,
+    MS_BIND,
+    MS_RDONLY,
     execute_command_assert_success,
+    mount,
+    readahead_file,
+    run_detached,
     unshare_mounts,
     unsudo_context,
     get_current_user_shell,
@@ -19,12 +33,43 @@ from .platform_utils import (
     get_sudo_groups,
     )
 from .python_compat import iteritems
-from .resources import Resource, CacheableResource
+from .resources import CacheableResource
+from .staging import StagingArea
+from .timing import Timings, open_pipe
 
 _logger = logging.getLogger(__name__)
 
-_DWIGHT_CACHE_DIR = os.path.expanduser("~/.dwight-cache")
-_ROOT_IMAGE_MOUNT_PATH = os.path.join(_DWIGHT_CACHE_DIR, "mounts", "root_image")
+_ROOT_IMAGE_MOUNT_NAME = "root_image"
+_ROOT_OVERLAY_MOUNT_NAME = "root_overlay"
+_OVERLAY_TMPFS_MOUNT_NAME = "overlay_tmpfs"
+_REAPER_NICENESS = 19
+
+_ENVIRONMENT_VARIABLE_PATTERN = re.compile(r"\$(?:(\w+)|\{(\w+)\})")
+
+def _expand_environment_variables(value, environ):
+    return _ENVIRONMENT_VARIABLE_PATTERN.sub(lambda match: environ.get(match.group(1) or match.group(2), ""), value)
+
+def _get_command_argv(cmd):
+    if isinstance(cmd, (list, tuple)):
+        return list(cmd)
+    return ["/bin/sh", "-c", cmd]
+
+def _get_exit_code(status):
+    if os.WIFSIGNALED(status):
+        # like a shell would report it
+        return 128 + os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def _redirect_output(output_path):
+    with unsudo_context():
+        output_fd = os.open(output_path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+    os.dup2(output_fd, 1)
+    os.dup2(output_fd, 2)
+    os.close(output_fd)
+
+def _reap_cache_trash(cache_root, max_bytes_per_second):
+    os.nice(_REAPER_NICENESS)
+    Cache(cache_root).reap_trash(max_bytes_per_second)
 
 class Environment(object):
     def __init__(self):
@@ -35,59 +80,203 @@ class Environment(object):
         with unsudo_context():
             self.cache = Cache(os.path.expanduser("~/.dwight-cache"))
         self.config = DwightConfiguration()
+        self.loop_devices = LoopDeviceManager()
+        self.mount_roots = MountRoots(os.path.join(self.cache.root, "mounts"))
+        self.timings = Timings()
+        self._timings_fd = None
     ############################################################################
     def run_shell(self):
-        return self.run_command_in_chroot(get_current_user_shell())
+        return self.run_command_in_chroot([get_current_user_shell()])
     def run_command_in_chroot(self, cmd):
+        root_image_path, include_paths = self.prepare()
+        with self.overlay_lock():
+            child_pid = self._fork_child(self._run_command_in_chroot, cmd, root_image_path, include_paths)
+            # the child sends its timings right before executing the command
+            with self.timings.measure("command", command=cmd):
+                return self._wait_for_assembling_child(child_pid)
+    def run_commands_in_chroot(self, cmds, parallelism=1, report_file=sys.stdout, log_dir=None):
+        root_image_path, include_paths = self.prepare()
+        # the output of each command goes to a log of its own, keeping the report parsable
+        with unsudo_context():
+            if log_dir is None:
+                log_dir = mkdtemp(prefix="dwight-batch-")
+            elif not os.path.isdir(log_dir):
+                os.makedirs(log_dir)
+        report_file.flush()
+        with self.overlay_lock():
+            return self._wait_for_assembling_child(self._fork_child(
+                self._run_commands_in_chroot, cmds, root_image_path, include_paths, parallelism, report_file, log_dir))
+    @contextmanager
+    def overlay_lock(self):
+        if self.config["OVERLAY"] != "persistent":
+            yield
+            return
+        # overlayfs doesn't support sharing upper dirs between mounts, so the lock is held until
+        # the environment is gone. The child cannot hold it, as executing the command closes the lock file
+        with self.cache.exclusive_lock("overlay-{0}".format(self.config["OVERLAY_NAME"])):
+            yield
+    def prepare(self):
         if os.getuid() != 0:
             raise NotRootException("Dwight must be run as root")
         self.config.check()
         self._check_num_loop_devices()
-        root_image_path, include_paths = self._fetch_image_and_includes()
-        child_pid = os.fork()
-        if child_pid == 0:
-            self._run_command_in_chroot_as_forked_child(cmd, root_image_path, include_paths)
-        else:
-            return self._wait_for_forked_child(child_pid)
+        return self._fetch_image_and_includes()
+    def assemble(self, root_image_path, include_paths):
+        unshare_mounts()
+        # the mount root is released by the parent, once this process (and its mount namespace) is gone
+        mount_root = self.mount_roots.allocate(self.config.get_hash(), os.getpid())
+        path = self._mount_root_image(root_image_path, mount_root)
+        self._mount_includes(path, include_paths)
+        return path
+    def run_command_in_root_as_forked_child(self, cmd, path, output_path=None):
+        # the timings of this process are recorded by its parent
+        self._timings_fd = None
+        try:
+            if output_path is not None:
+                _redirect_output(output_path)
+            self._run_command_in_root(cmd, path)
+        except Exception:
+            _logger.error("Error occurred running command", exc_info=True)
+        os._exit(-1)
+    def fetch(self, configs=None):
+        if configs is None:
+            configs = [self.config]
+        resources = []
+        for config in configs:
+            config.check()
+            resources.extend(self._get_resources(config))
+        return self._fetch_and_cleanup(resources)
     def _fetch_image_and_includes(self):
+        paths = self._fetch_and_cleanup(self._get_resources(self.config))
+        root_image_path = paths[0]
+        include_paths = list(zip(self.config["INCLUDES"], paths[1:]))
+        return root_image_path, include_paths
+    def _get_resources(self, config):
+        root_image_resource = self._get_root_image_include(config).to_resource()
+        return [root_image_resource] + [include.to_resource() for include in config["INCLUDES"]]
+    def _fetch_and_cleanup(self, resources):
         with unsudo_context():
+            paths = self._fetch_resources(resources)
             used_keys = []
-            root_image_resource = Resource.from_string(self.config["ROOT_IMAGE"])
-            self._update_used_keys(used_keys, root_image_resource)
-            root_image_path = root_image_resource.get_path(self)
-            include_paths = []
-            
-            for include in self.config["INCLUDES"]:
-                _logger.debug("Fetching include %s...", include)
-                include_resource = include.to_resource()
-                self._update_used_keys(used_keys, include_resource)
-                include_paths.append((include, include_resource.get_path(self)))
-        self.cache.cleanup(self.config["MAX_CACHE_SIZE"], used_keys)
-        return root_image_path, include_paths
+            for resource in resources:
+                self._update_used_keys(used_keys, resource)
+            with self.timings.measure("cache.cleanup"):
+                self.cache.cleanup(self.config["MAX_CACHE_SIZE"], used_keys, self.config["CACHE_EVICTION_POLICY"])
+            if self.cache.has_trash():
+                run_detached(_reap_cache_trash, self.cache.root, self.config["CACHE_REAPER_RATE"])
+        return paths
+    def _get_root_image_include(self, config=None):
+        if config is None:
+            config = self.config
+        root_image = config["ROOT_IMAGE"]
+        if isinstance(root_image, Include):
+            return root_image
+        return Include("/", root_image)
+    def _fetch_resources(self, resources):
+        unique_resources = OrderedDict()
+        for resource in resources:
+            unique_resources.setdefault(self._get_resource_fetch_id(resource), resource)
+        num_workers = min(self.config["NUM_FETCH_WORKERS"] or 1, len(unique_resources))
+        if num_workers <= 1:
+            fetched_paths = [self._fetch_resource(resource) for resource in unique_resources.values()]
+        else:
+            _logger.debug("Fetching %s resources using %s workers", len(unique_resources), num_workers)
+            pool = ThreadPool(num_workers)
+            try:
+                fetched_paths = pool.map(self._fetch_resource, list(unique_resources.values()))
+            finally:
+                pool.terminate()
+                pool.join()
+        paths_by_id = dict(zip(unique_resources, fetched_paths))
+        return [paths_by_id[self._get_resource_fetch_id(resource)] for resource in resources]
+    def _fetch_resource(self, resource):
+        _logger.debug("Fetching %s...", resource)
+        return resource.get_path(self)
+    def _get_resource_fetch_id(self, resource):
+        if isinstance(resource, CacheableResource):
+            return serialize_key(resource.get_cache_key())
+        return id(resource)
     def _update_used_keys(self, keys, resource):
         if isinstance(resource, CacheableResource):
-            keys.append(resource.get_cache_key())
-    def _run_command_in_chroot_as_forked_child(self, cmd, root_image_path, include_paths):
-        try:
-            unshare_mounts()
-            path = self._mount_root_image(root_image_path)
-            self._mount_includes(path, include_paths)
+            keys.extend(resource.get_used_cache_keys())
+    def _fork_child(self, func, *args):
+        timings_read_fd, timings_write_fd = open_pipe()
+        child_pid = os.fork()
+        if child_pid == 0:
+            os.close(timings_read_fd)
+            # the parent already has the timings recorded so far
+            self.timings = Timings()
+            self._timings_fd = timings_write_fd
+            exit_code = -1
+            try:
+                exit_code = func(*args)
+            except Exception:
+                _logger.error("Error occurred running command", exc_info=True)
+            finally:
+                try:
+                    self._send_timings()
+                finally:
+                    os._exit(exit_code)
+        os.close(timings_write_fd)
+        self.timings.receive(timings_read_fd)
+        return child_pid
+    def _send_timings(self):
+        if self._timings_fd is not None:
+            self.timings.send(self._timings_fd)
+            self._timings_fd = None
+    def _run_command_in_chroot(self, cmd, root_image_path, include_paths):
+        path = self.assemble(root_image_path, include_paths)
+        self._run_command_in_root(cmd, path)
+    def _run_commands_in_chroot(self, cmds, root_image_path, include_paths, parallelism, report_file, log_dir):
+        path = self.assemble(root_image_path, include_paths)
+        pending = deque(enumerate(cmds))
+        running = {}
+        failed = False
+        while pending or running:
+            while pending and len(running) < max(parallelism, 1):
+                index, cmd = pending.popleft()
+                log_path = os.path.join(log_dir, "{0}.log".format(index))
+                cmd_pid = os.fork()
+                if cmd_pid == 0:
+                    self.run_command_in_root_as_forked_child(cmd, path, log_path)
+                running[cmd_pid] = (index, cmd, log_path, time.time())
+            cmd_pid, status = os.wait()
+            exit_code = _get_exit_code(status)
+            index, cmd, log_path, start_time = running.pop(cmd_pid)
+            self.timings.add("command", start_time, time.time() - start_time, index=index, command=cmd)
+            report_file.write(json.dumps(dict(index=index, command=cmd, exit_code=exit_code, log=log_path)) + "\n")
+            report_file.flush()
+            failed = failed or exit_code != 0
+        return 1 if failed else 0
+    def _run_command_in_root(self, cmd, path):
+        with self.timings.measure("chroot", path=path):
+            environ = self._get_command_environ()
             os.chroot(path)
             self._set_uid_gids()
             self._set_pwd()
-            p = execute_command(
-                "env {env} {cmd}".format(
-                    env=" ".join('{0}="{1}"'.format(key, value) for key, value in iteritems(self.config["ENVIRON"])),
-                    cmd=cmd)
-                    )
-            os._exit(p.wait())
-        except Exception:
-            _logger.error("Error occurred running command", exc_info=True)
-            os._exit(-1)
-    def _wait_for_forked_child(self, child_pid):
-        _, exit_code = os.waitpid(child_pid, 0)
-        exit_code >>= 8
-        _logger.debug("_wait_for_forked_child: child returned %s", exit_code)
+        argv = _get_command_argv(cmd)
+        _logger.debug("Executing %r", argv)
+        self._send_timings()
+        try:
+            os.execvpe(argv[0], argv, environ)
+        except OSError as e:
+            _logger.error("Cannot execute %r (%s)", argv, e)
+            os._exit(127)
+    def _get_command_environ(self):
+        returned = dict(os.environ)
+        for key, value in iteritems(self.config["ENVIRON"]):
+            # references are expanded using the environment dwight runs in, like a shell would
+            returned[key] = _expand_environment_variables(str(value), os.environ)
+        return returned
+    def _wait_for_assembling_child(self, child_pid):
+        try:
+            return self.wait_for_forked_child(child_pid)
+        finally:
+            self.mount_roots.release(self.config.get_hash(), child_pid)
+    def wait_for_forked_child(self, child_pid):
+        _, status = os.waitpid(child_pid, 0)
+        exit_code = _get_exit_code(status)
+        _logger.debug("wait_for_forked_child: child returned %s", exit_code)
         return exit_code
     def _get_host_uid(self):
         uid = self._try_get_sudo_env_var("UID")
@@ -114,17 +303,55 @@ class Environment(object):
         if returned is not None:
             return int(returned)
         return None
-    def _mount_root_image(self, root_image_path):
-        if not os.path.isdir(_ROOT_IMAGE_MOUNT_PATH):
-            with unsudo_context():
-                os.makedirs(_ROOT_IMAGE_MOUNT_PATH)
-        _logger.debug("Mounting base image %r in %r", root_image_path, _ROOT_IMAGE_MOUNT_PATH)
-        self._mount_squashfs(root_image_path, _ROOT_IMAGE_MOUNT_PATH)
-        return _ROOT_IMAGE_MOUNT_PATH
+    def _mount_root_image(self, root_image_path, mount_root):
+        root_image_mount_path = os.path.join(mount_root, _ROOT_IMAGE_MOUNT_NAME)
+        self._ensure_directories(root_image_mount_path)
+        _logger.debug("Mounting base image %r in %r", root_image_path, root_image_mount_path)
+        root_image_path = self._stage_image(root_image_path, self._get_root_image_include().stage)
+        with self.timings.measure("mount", source=root_image_path, mount_point="/"):
+            self._mount_squashfs(root_image_path, root_image_mount_path)
+        if self.config["OVERLAY"] is None:
+            return root_image_mount_path
+        with self.timings.measure("mount.overlay", overlay=self.config["OVERLAY"]):
+            return self._mount_overlay(root_image_mount_path, mount_root)
+    def _mount_overlay(self, lower_path, mount_root):
+        root_overlay_mount_path = os.path.join(mount_root, _ROOT_OVERLAY_MOUNT_NAME)
+        if self.config["OVERLAY"] == "tmpfs":
+            overlay_path = os.path.join(mount_root, _OVERLAY_TMPFS_MOUNT_NAME)
+            self._ensure_directories(overlay_path)
+            mount("tmpfs", overlay_path, "tmpfs")
+        else:
+            # callers hold overlay_lock() while the environment exists
+            overlay_path = os.path.join(self.cache.root, "overlays", self.config["OVERLAY_NAME"])
+        upper_path = os.path.join(overlay_path, "upper")
+        work_path = os.path.join(overlay_path, "work")
+        self._ensure_directories(root_overlay_mount_path)
+        if not os.path.isdir(upper_path):
+            # the upper dir determines the attributes of the chroot's root directory
+            lower_stat = os.stat(lower_path)
+            os.makedirs(upper_path)
+            os.chmod(upper_path, lower_stat.st_mode & 0o7777)
+            os.chown(upper_path, lower_stat.st_uid, lower_stat.st_gid)
+        if not os.path.isdir(work_path):
+            os.makedirs(work_path)
+        _logger.debug("Mounting overlay %r over %r in %r", overlay_path, lower_path, root_overlay_mount_path)
+        options = "lowerdir={0},upperdir={1},workdir={2}".format(lower_path, upper_path, work_path)
+        try:
+            mount("overlay", root_overlay_mount_path, "overlay", 0, options)
+        except (IOError, OSError, NotImplementedError) as e:
+            _logger.debug("Cannot mount overlay natively (%s), falling back to mount command", e)
+            execute_command_assert_success("mount -n -t overlay -o {0} overlay {1}".format(options, root_overlay_mount_path))
+        return root_overlay_mount_path
+    def _ensure_directories(self, *paths):
+        with unsudo_context():
+            for path in paths:
+                if not os.path.isdir(path):
+                    os.makedirs(path)
     def _mount_includes(self, base_path, include_paths):
         for include, path in include_paths:
-            self._mount_path(path, base_path, include.dest)
-    def _mount_path(self, path, base_path, mount_point):
+            with self.timings.measure("mount", source=path, mount_point=include.dest):
+                self._mount_path(path, base_path, include.dest, include.stage)
+    def _mount_path(self, path, base_path, mount_point, stage=None):
         path = os.path.abspath(path)
         if os.path.isabs(mount_point):
             mount_point = os.path.relpath(mount_point, '/')
@@ -132,22 +359,48 @@ class Environment(object):
         if not os.path.exists(path):
             raise CannotMountPath("Cannot mount {0}: does not exist".format(path))
         if os.path.isfile(path) and path.endswith('.squashfs'):
-            return self._mount_squashfs(path, mount_point)
+            return self._mount_squashfs(self._stage_image(path, stage), mount_point)
         return self._bind_mount(path, mount_point)
+    def _stage_image(self, path, stage):
+        if stage is None or not os.path.isfile(path):
+            return path
+        if stage == "readahead":
+            with self.timings.measure("stage.readahead", path=path):
+                try:
+                    readahead_file(path)
+                except (IOError, OSError, NotImplementedError) as e:
+                    _logger.warning("Cannot read ahead %s (%s)", path, e)
+            return path
+        staging_area = StagingArea(self.config["STAGING_DIR"], self.config["MAX_STAGING_SIZE"])
+        start_time = time.time()
+        try:
+            staged_path, hit = staging_area.stage(path)
+        except (IOError, OSError) as e:
+            _logger.warning("Cannot stage %s in %s, mounting it in place (%s)", path, staging_area.path, e)
+            staged_path, hit = None, False
+        self.timings.add("stage.ram", start_time, time.time() - start_time, path=path, hit=hit)
+        _logger.info("Staging %s in RAM: %s", path, "hit" if hit else ("miss" if staged_path else "skipped"))
+        return staged_path or path
     def _mount_squashfs(self, path, mount_point):
         _logger.debug("Mounting squashfs file %r to %s", path, mount_point)
+        try:
+            with self.loop_devices.attach(path) as loop_device_path:
+                mount(loop_device_path, mount_point, "squashfs", MS_RDONLY)
+            return
+        except (IOError, OSError, NotImplementedError) as e:
+            _logger.debug("Cannot mount %r natively (%s), falling back to mount command", path, e)
         execute_command_assert_success("mount -n -t squashfs -o ro,loop {0} {1}".format(path, mount_point))
     def _bind_mount(self, path, mount_point):
         _logger.debug("Mounting (binding) %r to %s", path, mount_point)
+        try:
+            mount(path, mount_point, None, MS_BIND)
+            return
+        except (IOError, OSError, NotImplementedError) as e:
+            _logger.debug("Cannot bind mount %r natively (%s), falling back to mount command", path, e)
         execute_command_assert_success("mount -n --bind {0} {1}".format(path, mount_point))
     def _check_num_loop_devices(self):
-        if self.config["NUM_LOOP_DEVICES"] is None:
-            return
-        with open("/proc/cmdline") as cmdline_file:
-            if "max_loop" in cmdline_file.read():
-                _logger.warning("max_loop was detected in /proc/cmdline. NUM_LOOP_DEVICES is ignored")
-                return
-        for i in range(self.config["NUM_LOOP_DEVICES"]):
-            loop_device_path = "/dev/loop{0}".format(i)
-            if not os.path.exists(loop_device_path):
-                execute_command_assert_success("mknod -m660 {0} b 7 {1}".format(loop_device_path, i))
+        if self.loop_devices.supports_dynamic_allocation():
+            _logger.debug("Loop devices are allocated on demand, NUM_LOOP_DEVICES is ignored")
+        elif self.config["NUM_LOOP_DEVICES"] is not None:
+            self.loop_devices.ensure_devices(self.config["NUM_LOOP_DEVICES"])
+        self.loop_devices.report_pressure()
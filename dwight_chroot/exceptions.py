@@ -27,3 +27,15 @@ class RuntimeDwightException(DwightException):
 
 class CannotMountPath(RuntimeDwightException):
     pass
+
+class AttachFailed(RuntimeDwightException):
+    pass
+
+class CacheMiss(RuntimeDwightException):
+    pass
+
+class DownloadFailed(RuntimeDwightException):
+    pass
+
+class ChecksumMismatch(DownloadFailed):
+    pass
@@ -1,12 +1,24 @@
 import os
-from .resources import Resource
+from .resources import LocalResource, Resource
 
 class Include(object):
-    def __init__(self, dest, source, **kwargs):
+    def __init__(self, dest, source, stage=None, **kwargs):
         super(Include, self).__init__()
         self.dest = os.path.abspath(dest)
         self.source = source
+        self.stage = stage
         self.kwargs = kwargs
+    def to_dict(self):
+        source = self.source
+        if Resource.get_resource_type_from_string(source) is LocalResource:
+            source = os.path.abspath(source)
+        returned = dict(dest=self.dest, source=source, kwargs=self.kwargs)
+        if self.stage is not None:
+            returned.update(stage=self.stage)
+        return returned
+    @classmethod
+    def from_dict(cls, d):
+        return cls(d["dest"], d["source"], stage=d.get("stage"), **d["kwargs"])
     def to_resource(self):
         return Resource.get_resource_type_from_string(self.source)(self.source, **self.kwargs)
     def __repr__(self):
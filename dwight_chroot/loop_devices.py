@@ -0,0 +1,84 @@
+from collections import namedtuple
+from contextlib import contextmanager
+import logging
+import os
+import re
+
+from .platform_utils import (
+    attached_loop_device,
+    execute_command_assert_success,
+    make_block_device,
+    )
+
+_logger = logging.getLogger(__name__)
+
+LOOP_MAJOR = 7
+_LOOP_CONTROL_PATH = "/dev/loop-control"
+_SYS_BLOCK_PATH = "/sys/block"
+_MAX_LOOP_PARAMETER_PATH = "/sys/module/loop/parameters/max_loop"
+_HIGH_PRESSURE_RATIO = 0.8
+
+LoopDeviceUsage = namedtuple("LoopDeviceUsage", ["in_use", "existing", "limit"])
+
+class LoopDeviceManager(object):
+    def __init__(self, loop_control_path=_LOOP_CONTROL_PATH, sys_block_path=_SYS_BLOCK_PATH,
+                 max_loop_parameter_path=_MAX_LOOP_PARAMETER_PATH):
+        super(LoopDeviceManager, self).__init__()
+        self._loop_control_path = loop_control_path
+        self._sys_block_path = sys_block_path
+        self._max_loop_parameter_path = max_loop_parameter_path
+    def supports_dynamic_allocation(self):
+        return os.path.exists(self._loop_control_path)
+    @contextmanager
+    def attach(self, path):
+        attached = False
+        try:
+            with attached_loop_device(path) as loop_device_path:
+                attached = True
+                yield loop_device_path
+        except (IOError, OSError):
+            if not attached:
+                self.report_pressure()
+            raise
+    def ensure_devices(self, num_devices):
+        with open("/proc/cmdline") as cmdline_file:
+            if "max_loop" in cmdline_file.read():
+                _logger.warning("max_loop was detected in /proc/cmdline. NUM_LOOP_DEVICES is ignored")
+                return
+        for i in range(num_devices):
+            loop_device_path = "/dev/loop{0}".format(i)
+            if not os.path.exists(loop_device_path):
+                self._create_device(loop_device_path, i)
+    def _create_device(self, loop_device_path, index):
+        try:
+            make_block_device(loop_device_path, LOOP_MAJOR, index)
+            return
+        except (IOError, OSError, NotImplementedError) as e:
+            _logger.debug("Cannot create %s natively (%s), falling back to mknod command", loop_device_path, e)
+        execute_command_assert_success("mknod -m660 {0} b {1} {2}".format(loop_device_path, LOOP_MAJOR, index))
+    def get_usage(self):
+        in_use = existing = 0
+        if os.path.isdir(self._sys_block_path):
+            for name in os.listdir(self._sys_block_path):
+                if not re.match(r"^loop\d+$", name):
+                    continue
+                existing += 1
+                if os.path.exists(os.path.join(self._sys_block_path, name, "loop", "backing_file")):
+                    in_use += 1
+        return LoopDeviceUsage(in_use=in_use, existing=existing, limit=self._get_limit(existing))
+    def _get_limit(self, existing):
+        if self.supports_dynamic_allocation():
+            # loop-control can add devices beyond max_loop, which only applies to those created at boot
+            return None
+        try:
+            with open(self._max_loop_parameter_path) as max_loop_file:
+                limit = int(max_loop_file.read().strip())
+        except (IOError, OSError, ValueError):
+            limit = 0
+        return limit or existing
+    def report_pressure(self):
+        usage = self.get_usage()
+        _logger.debug("Loop devices: %s in use, %s existing, limit %s", usage.in_use, usage.existing, usage.limit)
+        if usage.limit and usage.in_use >= usage.limit * _HIGH_PRESSURE_RATIO:
+            _logger.warning("%s out of %s loop devices are in use", usage.in_use, usage.limit)
+        return usage
@@ -0,0 +1,88 @@
+from collections import namedtuple
+import errno
+import logging
+import os
+import re
+
+from .platform_utils import unsudo_context
+
+_logger = logging.getLogger(__name__)
+
+_CONFIG_HASH_LENGTH = 12
+_MOUNT_ROOT_NAME_PATTERN = re.compile(r"^([0-9a-f]+)-(\d+)$")
+
+ActiveEnvironment = namedtuple("ActiveEnvironment", ["config_hash", "pid", "path", "mounts"])
+Mount = namedtuple("Mount", ["mount_point", "source", "fstype"])
+
+class MountRoots(object):
+    def __init__(self, path):
+        super(MountRoots, self).__init__()
+        self.path = path
+    def get_path(self, config_hash, pid):
+        return os.path.join(self.path, "{0}-{1}".format(config_hash[:_CONFIG_HASH_LENGTH], pid))
+    def allocate(self, config_hash, pid):
+        self.cleanup_stale()
+        returned = self.get_path(config_hash, pid)
+        with unsudo_context():
+            if not os.path.isdir(returned):
+                os.makedirs(returned)
+        return returned
+    def release(self, config_hash, pid):
+        path = self.get_path(config_hash, pid)
+        if os.path.isdir(path):
+            self._remove(path)
+    def _remove(self, path):
+        # only empty directories are removed, so nothing still mounted below the path can be harmed
+        try:
+            for name in os.listdir(path):
+                os.rmdir(os.path.join(path, name))
+            os.rmdir(path)
+        except OSError as e:
+            _logger.warning("Cannot remove mount root %s (%s)", path, e)
+    def cleanup_stale(self):
+        for config_hash, pid, path in self._iter_mount_roots():
+            if not _is_alive(pid):
+                _logger.debug("Removing stale mount root %s", path)
+                self._remove(path)
+    def list_active(self):
+        returned = []
+        for config_hash, pid, path in self._iter_mount_roots():
+            if _is_alive(pid):
+                returned.append(ActiveEnvironment(config_hash=config_hash, pid=pid, path=path, mounts=_get_mounts(pid, path)))
+        return returned
+    def _iter_mount_roots(self):
+        if not os.path.isdir(self.path):
+            return
+        for name in sorted(os.listdir(self.path)):
+            match = _MOUNT_ROOT_NAME_PATTERN.match(name)
+            if match is not None:
+                yield match.group(1), int(match.group(2)), os.path.join(self.path, name)
+
+def _is_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except OSError as e:
+        return e.errno != errno.ESRCH
+    return True
+
+def _get_mounts(pid, path):
+    try:
+        # mount points are relative to the root of the process, which is the environment itself once chrooted
+        root = os.readlink("/proc/{0}/root".format(pid))
+        with open("/proc/{0}/mountinfo".format(pid)) as mountinfo_file:
+            lines = mountinfo_file.readlines()
+    except (IOError, OSError) as e:
+        _logger.debug("Cannot get the mounts of %s (%s)", pid, e)
+        return []
+    returned = []
+    for line in lines:
+        fields = line.split()
+        separator_index = fields.index("-")
+        mount_point = os.path.normpath(os.path.join(root, _unescape(fields[4]).lstrip("/")))
+        if mount_point == path or mount_point.startswith(path + os.sep):
+            returned.append(Mount(mount_point=mount_point, source=_unescape(fields[separator_index + 2]),
+                                  fstype=fields[separator_index + 1]))
+    return returned
+
+def _unescape(mountinfo_field):
+    return re.sub(r"\\([0-7]{3})", lambda match: chr(int(match.group(1), 8)), mountinfo_field)
@@ -1,11 +1,13 @@
 import ctypes
 from contextlib import contextmanager
 import errno
+import fcntl
 import logging
 import os
 import platform
 import pwd
 import grp
+import stat
 import subprocess
 from .exceptions import CommandFailed
 
@@ -60,19 +62,177 @@ def get_groups_by_uid(uid):
     gids = [g.gr_gid for g in grp.getgrall() if username in g.gr_mem]
     return gids
 
+CLONE_NEWNS = 131072
+MS_RDONLY = 1
+MS_BIND = 4096
+MS_REC = 16384
+MS_PRIVATE = 262144
+
 if platform.system() == "Linux":
-    CLONE_NEWNS = 131072
-    _libc = ctypes.CDLL("libc.so.6")
+    _LOOP_MAJOR = 7
+    _LOOP_SET_FD = 0x4C00
+    _LOOP_CLR_FD = 0x4C01
+    _LOOP_SET_STATUS64 = 0x4C04
+    _LOOP_CTL_GET_FREE = 0x4C82
+    _LO_FLAGS_AUTOCLEAR = 4
+    _LO_NAME_SIZE = 64
+    _POSIX_FADV_WILLNEED = 3
+    _libc = ctypes.CDLL("libc.so.6", use_errno=True)
+    _libc.mount.argtypes = [ctypes.c_char_p, ctypes.c_char_p, ctypes.c_char_p, ctypes.c_ulong, ctypes.c_char_p]
+    _libc.posix_fadvise64.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_int]
+    class _LoopInfo64(ctypes.Structure):
+        _fields_ = [
+            ("lo_device", ctypes.c_uint64),
+            ("lo_inode", ctypes.c_uint64),
+            ("lo_rdevice", ctypes.c_uint64),
+            ("lo_offset", ctypes.c_uint64),
+            ("lo_sizelimit", ctypes.c_uint64),
+            ("lo_number", ctypes.c_uint32),
+            ("lo_encrypt_type", ctypes.c_uint32),
+            ("lo_encrypt_key_size", ctypes.c_uint32),
+            ("lo_flags", ctypes.c_uint32),
+            ("lo_file_name", ctypes.c_char * _LO_NAME_SIZE),
+            ("lo_crypt_name", ctypes.c_char * _LO_NAME_SIZE),
+            ("lo_encrypt_key", ctypes.c_char * 32),
+            ("lo_init", ctypes.c_uint64 * 2),
+            ]
+    def _raise_errno(description):
+        errno_val = ctypes.get_errno()
+        raise OSError(errno_val, "{0} failed (errno={1} ({2}))".format(
+            description, errno_val, errno.errorcode.get(errno_val, "?")))
     def unshare_mounts():
         return_value = _libc.unshare(CLONE_NEWNS)
         if 0 != return_value:
-            errno_val = ctypes.get_errno()
-            raise OSError("unshare() called failed (errno={0} ({1}))".format(
-                errno_val, errno.errorcode.get(errno_val, "?")
-                ))
+            _raise_errno("unshare()")
+        # otherwise mounts made in the new namespace can propagate back to the host
+        mount("none", "/", None, MS_REC | MS_PRIVATE)
+    def enter_mount_namespace(namespace_path):
+        namespace_fd = os.open(namespace_path, os.O_RDONLY)
+        try:
+            if 0 != _libc.setns(namespace_fd, CLONE_NEWNS):
+                _raise_errno("setns({0!r})".format(namespace_path))
+        finally:
+            os.close(namespace_fd)
+    def mount(source, target, fstype=None, flags=0, data=None):
+        _logger.debug("mount(%r, %r, %r, %s, %r)", source, target, fstype, flags, data)
+        if 0 != _libc.mount(_encode(source), _encode(target), _encode(fstype), flags, _encode(data)):
+            _raise_errno("mount({0!r}, {1!r})".format(source, target))
+    def make_block_device(path, major, minor, mode=0o660):
+        os.mknod(path, mode | stat.S_IFBLK, os.makedev(major, minor))
+    def readahead_file(path):
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            # posix_fadvise returns the error instead of setting errno
+            return_value = _libc.posix_fadvise64(fd, 0, 0, _POSIX_FADV_WILLNEED)
+            if 0 != return_value:
+                raise OSError(return_value, "posix_fadvise({0!r}) failed ({1})".format(path, os.strerror(return_value)))
+        finally:
+            os.close(fd)
+    @contextmanager
+    def attached_loop_device(path):
+        backing_fd = os.open(path, os.O_RDONLY)
+        try:
+            loop_fd, loop_device_path = _attach_free_loop_device(backing_fd)
+        finally:
+            os.close(backing_fd)
+        try:
+            info = _LoopInfo64()
+            info.lo_flags = _LO_FLAGS_AUTOCLEAR
+            info.lo_file_name = _encode(path)[-(_LO_NAME_SIZE - 1):]
+            fcntl.ioctl(loop_fd, _LOOP_SET_STATUS64, info)
+        except:
+            fcntl.ioctl(loop_fd, _LOOP_CLR_FD, 0)
+            os.close(loop_fd)
+            raise
+        try:
+            yield loop_device_path
+        finally:
+            os.close(loop_fd)
+    def _attach_free_loop_device(backing_fd):
+        control_fd = os.open("/dev/loop-control", os.O_RDWR)
+        try:
+            while True:
+                loop_number = fcntl.ioctl(control_fd, _LOOP_CTL_GET_FREE)
+                loop_device_path = "/dev/loop{0}".format(loop_number)
+                if not os.path.exists(loop_device_path):
+                    make_block_device(loop_device_path, _LOOP_MAJOR, loop_number)
+                loop_fd = os.open(loop_device_path, os.O_RDONLY)
+                try:
+                    fcntl.ioctl(loop_fd, _LOOP_SET_FD, backing_fd)
+                except (IOError, OSError) as e:
+                    os.close(loop_fd)
+                    if e.errno != errno.EBUSY:
+                        raise
+                    _logger.debug("%s was taken by someone else, retrying", loop_device_path)
+                    continue
+                _logger.debug("Attached %s", loop_device_path)
+                return loop_fd, loop_device_path
+        finally:
+            os.close(control_fd)
 else:
     def unshare_mounts():
         raise NotImplementedError("Only supported on Linux") 
+    def enter_mount_namespace(namespace_path):
+        raise NotImplementedError("Only supported on Linux")
+    def mount(source, target, fstype=None, flags=0, data=None):
+        raise NotImplementedError("Only supported on Linux")
+    def make_block_device(path, major, minor, mode=0o660):
+        raise NotImplementedError("Only supported on Linux")
+    def readahead_file(path):
+        raise NotImplementedError("Only supported on Linux")
+    def attached_loop_device(path):
+        raise NotImplementedError("Only supported on Linux")
+
+def _encode(s):
+    if s is None or isinstance(s, bytes):
+        return s
+    return s.encode("utf-8")
+
+def run_detached(func, *args):
+    child_pid = os.fork()
+    if child_pid != 0:
+        os.waitpid(child_pid, 0)
+        return
+    exit_code = 0
+    try:
+        os.setsid()
+        # the grandchild is reparented to init, so nobody has to wait for it
+        if os.fork() == 0:
+            _detach_from_parent()
+            _drop_privileges()
+            func(*args)
+    except Exception:
+        exit_code = 1
+    finally:
+        os._exit(exit_code)
+
+def _drop_privileges():
+    # unsudo_context only changes the effective ids, which a process running on its own could regain
+    sudo_uid = get_sudo_uid()
+    sudo_gid = get_sudo_gid()
+    if os.getuid() != 0 or sudo_uid is None:
+        return
+    os.seteuid(0)
+    if sudo_gid is not None:
+        os.setgroups(get_sudo_groups())
+        os.setgid(sudo_gid)
+    os.setuid(sudo_uid)
+
+def _detach_from_parent():
+    null_fd = os.open(os.devnull, os.O_RDWR)
+    for fd in (0, 1, 2):
+        os.dup2(null_fd, fd)
+    try:
+        fds = [int(name) for name in os.listdir("/proc/self/fd")]
+    except OSError:
+        fds = range(3, 1024)
+    # otherwise pipes and locks held by the parent stay open as long as this process runs
+    for fd in fds:
+        if fd > 2:
+            try:
+                os.close(fd)
+            except OSError:
+                pass
 
 @contextmanager
 def unsudo_context():
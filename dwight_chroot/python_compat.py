@@ -3,10 +3,20 @@ import platform
 PY3 = (platform.python_version() >= '3')
 
 if PY3:
-    import urllib as urllib2
+    import http.client as httplib
+    import urllib.request as urllib2
     from urllib.parse import urlsplit
+    from importlib.util import MAGIC_NUMBER as PYTHON_MAGIC
     iteritems = dict.items
 else:
+    import httplib
     import urllib2
     from urlparse import urlsplit
+    import imp
+    PYTHON_MAGIC = imp.get_magic()
     iteritems = dict.iteritems
+
+try:
+    from os import scandir
+except ImportError:
+    scandir = None
@@ -1,18 +1,24 @@
+import binascii
 import functools
+import glob
+import hashlib
+import json
 import logging
 import os
 import shutil
+import subprocess
+import time
 
-from .python_compat import (
-    urllib2,
-    urlsplit,
-    )
+from .python_compat import urlsplit
 
-from .exceptions import UsageException
-from .platform_utils import execute_command_assert_success
+from .downloads import download, PARTIAL_SUFFIX
+from .exceptions import CacheMiss, UsageException
+from .platform_utils import execute_command, execute_command_assert_success
 
 _logger = logging.getLogger(__name__)
 
+_HTTP_METADATA_FILE_NAME = ".http_metadata.json"
+
 class Resource(object):
     @classmethod
     def get_resource_type_from_string(cls, s):
@@ -39,30 +45,92 @@ class LocalResource(Resource):
 class FetchedResource(Resource):
     pass
 
+class RefreshPolicy(object):
+    def __init__(self, ttl):
+        super(RefreshPolicy, self).__init__()
+        self.ttl = ttl
+    @classmethod
+    def from_string(cls, s):
+        if s == "always":
+            return cls(0)
+        if s in ("never", "offline"):
+            return cls(None)
+        if s.startswith("ttl="):
+            try:
+                return cls(float(s[len("ttl="):]))
+            except ValueError:
+                pass
+        raise UsageException("Invalid refresh policy: {0!r} (expected 'always', 'never' or 'ttl=<seconds>')".format(s))
+    def should_refresh(self, last_refresh, now):
+        if self.ttl is None:
+            return False
+        if last_refresh is None:
+            return True
+        return now - last_refresh >= self.ttl
+
 class CacheableResource(FetchedResource):
+    def __init__(self, refresh=None):
+        super(CacheableResource, self).__init__()
+        self.refresh_policy = RefreshPolicy.from_string(refresh) if refresh is not None else None
     def get_path(self, env):
         key = self.get_cache_key()
         path = env.cache.get_path(key)
         if path is None:
-            path = env.cache.create_new_path()
-            fetch_result = self.fetch(path)
+            if env.config["OFFLINE"] and not self.can_fetch_offline(env):
+                raise CacheMiss("{0!r} is not in the cache, and cannot be fetched while offline".format(key))
+            path = env.cache.create_new_path(key)
+            with env.timings.measure("resource.fetch", key=key):
+                fetch_result = self.fetch(path)
             if fetch_result:
                 path = fetch_result
-            env.cache.register_new_path(path, key)
+            with env.timings.measure("cache.size", key=key):
+                env.cache.register_new_path(path, key, self.get_fingerprint(path))
+        elif not self.is_usable(path):
+            if env.config["OFFLINE"]:
+                raise CacheMiss("{0!r} cannot be used anymore, and cannot be fetched again while offline".format(key))
+            _logger.debug("%s cannot be used anymore, fetching it again", path)
+            with env.timings.measure("resource.fetch", key=key):
+                self.fetch(path)
+            env.cache.mark_refreshed(path)
+            with env.timings.measure("cache.size", key=key):
+                env.cache.update_path(path, self.get_fingerprint(path))
         else:
-            self.refresh(path)
-            env.cache.update_path(path)
+            if self._should_refresh(env, path):
+                with env.timings.measure("resource.refresh", key=key):
+                    self.refresh(path)
+                env.cache.mark_refreshed(path)
+            with env.timings.measure("cache.size", key=key):
+                env.cache.update_path(path, self.get_fingerprint(path))
         return path
+    def _should_refresh(self, env, path):
+        if env.config["OFFLINE"]:
+            _logger.debug("Not refreshing %s (offline)", path)
+            return False
+        policy = self.refresh_policy
+        if policy is None:
+            policy = RefreshPolicy.from_string(env.config["REFRESH_POLICY"])
+        if policy.should_refresh(env.cache.get_last_refresh(path), time.time()):
+            return True
+        _logger.debug("Not refreshing %s (refresh policy)", path)
+        return False
     def get_cache_key(self):
         raise NotImplementedError() # pragma: no cover
+    def get_used_cache_keys(self):
+        return [self.get_cache_key()]
+    def is_usable(self, path):
+        return True
+    def can_fetch_offline(self, env):
+        return False
+    def get_fingerprint(self, path):
+        return None
     def fetch(self, path):
         raise NotImplementedError() # pragma: no cover
     def refresh(self, path):
         raise NotImplementedError() # pragma: no cover
 
 class DVCSResource(CacheableResource):
-    def __init__(self, repo_url, commit=None, branch=None, tag=None):
-        super(DVCSResource, self).__init__()
+    def __init__(self, repo_url, commit=None, branch=None, tag=None, refresh=None):
+        super(DVCSResource, self).__init__(refresh=refresh)
         self.repo_url = repo_url
         self.commit = commit
         self.branch = branch
@@ -80,6 +148,10 @@ class DVCSResource(CacheableResource):
     def refresh(self, path):
         if self._needs_pull:
             self._pull(path)
+        elif self.commit is not None:
+            self._verify_commit(path)
+    def _verify_commit(self, path):
+        pass
 
 class MercurialResource(DVCSResource):
     def __init__(self, *args, **kwargs):
@@ -103,47 +175,233 @@ class MercurialResource(DVCSResource):
         execute_command_assert_success(cmd, unsudo=True)
     def _pull(self, path):
         execute_command_assert_success("hg pull", cwd=path, unsudo=True)
+    def get_fingerprint(self, path):
+        try:
+            with open(os.path.join(path, ".hg", "dirstate"), "rb") as dirstate_file:
+                parents = dirstate_file.read(40)
+        except (IOError, OSError):
+            return None
+        return "hg:" + binascii.hexlify(parents).decode("ascii")
 
 class GitResource(DVCSResource):
+    def __init__(self, repo_url, commit=None, branch=None, tag=None, refresh=None, depth=None, filter=None):
+        super(GitResource, self).__init__(repo_url, commit=commit, branch=branch, tag=tag, refresh=refresh)
+        self.depth = depth
+        self.filter = filter
+        self._cache = None
+    def get_path(self, env):
+        self._cache = env.cache
+        return super(GitResource, self).get_path(env)
+    def get_cache_key(self):
+        returned = super(GitResource, self).get_cache_key()
+        if self.depth is not None:
+            returned.update(depth=self.depth)
+        if self.filter is not None:
+            returned.update(filter=self.filter)
+        return returned
+    def get_mirror_cache_key(self):
+        return dict(url=self.repo_url, mirror=True)
+    def get_used_cache_keys(self):
+        returned = super(GitResource, self).get_used_cache_keys()
+        if self._uses_mirror():
+            returned.append(self.get_mirror_cache_key())
+        return returned
+    def is_usable(self, path):
+        # clones share the objects of their mirror, and are useless once it gets evicted from the cache
+        return all(os.path.isdir(objects_path) for objects_path in self._get_alternates(path))
+    def _uses_mirror(self):
+        return self.depth is None and self.filter is None
     def _clone(self, path):
-        execute_command_assert_success("git clone {0} {1}".format(self.repo_url, path), unsudo=True)
-        if self.branch:
-            execute_command_assert_success(
-                "git checkout -b {0} origin/{0}".format(self.branch),
-                cwd=path,
-                unsudo=True,
-                )
-        if self.commit or self.tag:
-            execute_command_assert_success(
-                "git checkout {0}".format(self.commit or self.tag),
-                cwd=path,
-                unsudo=True,
-                )
+        if self._uses_mirror():
+            self._clone_from_mirror(path)
+        elif self.commit:
+            self._fetch_commit_directly(path)
+        else:
+            self._clone_directly(path)
+    def _clone_from_mirror(self, path):
+        mirror_path = self._update_mirror(self.commit)
+        execute_command_assert_success("git clone --shared {0} {1} {2}".format(
+            self._get_ref_clone_args(), mirror_path, path), unsudo=True)
+        if self.commit:
+            execute_command_assert_success("git checkout {0}".format(self.commit), cwd=path, unsudo=True)
+    def _clone_directly(self, path):
+        execute_command_assert_success("git clone {0} {1} {2} {3}".format(
+            self._get_shallow_args(), self._get_ref_clone_args(), self.repo_url, path), unsudo=True)
+    def _fetch_commit_directly(self, path):
+        execute_command_assert_success("git init -q {0}".format(path), unsudo=True)
+        execute_command_assert_success("git remote add origin {0}".format(self.repo_url), cwd=path, unsudo=True)
+        execute_command_assert_success("git fetch {0} origin {1}".format(
+            self._get_shallow_args(), self.commit), cwd=path, unsudo=True)
+        execute_command_assert_success("git checkout -q FETCH_HEAD", cwd=path, unsudo=True)
+    def _get_ref_clone_args(self):
+        if self.branch or self.tag:
+            return "--branch {0}".format(self.branch or self.tag)
+        return ""
+    def _get_shallow_args(self):
+        returned = []
+        if self.depth is not None:
+            returned.append("--depth {0}".format(self.depth))
+        if self.filter is not None:
+            returned.append("--filter={0}".format(self.filter))
+        return " ".join(returned)
+    def _get_mirror_lock(self):
+        url_hash = hashlib.sha1(self.repo_url.encode("utf-8")).hexdigest()
+        return self._cache.exclusive_lock("git-mirror-" + url_hash)
+    def _create_mirror(self):
+        key = self.get_mirror_cache_key()
+        mirror_path = self._cache.create_new_path(key)
+        _logger.debug("Creating mirror of %s in %s", self.repo_url, mirror_path)
+        shutil.rmtree(mirror_path)
+        execute_command_assert_success("git clone -q --mirror {0} {1}".format(self.repo_url, mirror_path), unsudo=True)
+        # clones borrow objects from the mirror, which must never be removed once unreferenced
+        execute_command_assert_success("git config gc.auto 0", cwd=mirror_path, unsudo=True)
+        execute_command_assert_success("git config gc.pruneExpire never", cwd=mirror_path, unsudo=True)
+        self._cache.register_new_path(mirror_path, key)
+        return mirror_path
+    def _update_mirror(self, commit=None):
+        # without a commit, the mirror is fetched to get the latest refs
+        started = time.time()
+        with self._get_mirror_lock():
+            mirror_path = self._cache.get_path(self.get_mirror_cache_key())
+            if mirror_path is None:
+                mirror_path = self._create_mirror()
+            elif (commit is None or not _git_has_commit(mirror_path, commit)) and not self._mirror_fetched_since(mirror_path, started):
+                execute_command_assert_success("git fetch -q --prune origin", cwd=mirror_path, unsudo=True)
+                self._cache.update_path(mirror_path)
+        return mirror_path
+    def _mirror_fetched_since(self, mirror_path, timestamp):
+        fetch_head_path = os.path.join(mirror_path, "FETCH_HEAD")
+        return os.path.exists(fetch_head_path) and os.path.getmtime(fetch_head_path) >= timestamp
     def _pull(self, path):
+        if self._is_mirror_clone(path):
+            self._update_mirror()
         execute_command_assert_success(
             "git pull",
             cwd=path,
             unsudo=True,
             )
+    def _is_mirror_clone(self, path):
+        return os.path.exists(os.path.join(path, ".git", "objects", "info", "alternates"))
+    def _get_alternates(self, path):
+        try:
+            with open(os.path.join(path, ".git", "objects", "info", "alternates")) as alternates_file:
+                return [line.strip() for line in alternates_file if line.strip()]
+        except (IOError, OSError):
+            return []
+    def _verify_commit(self, path):
+        head = _get_git_head(os.path.join(path, ".git"))
+        if head is not None and head.startswith(self.commit):
+            return
+        _logger.warning("%s is not checked out at %s as expected, restoring", path, self.commit)
+        if not _git_has_commit(path, self.commit):
+            if self._is_mirror_clone(path):
+                self._update_mirror(self.commit)
+            execute_command_assert_success("git fetch {0} origin {1}".format(
+                self._get_shallow_args(), self.commit), cwd=path, unsudo=True)
+        execute_command_assert_success("git checkout -q {0}".format(self.commit), cwd=path, unsudo=True)
+    def get_fingerprint(self, path):
+        try:
+            head = _get_git_head(os.path.join(path, ".git"))
+        except (IOError, OSError):
+            return None
+        if head is None:
+            return None
+        return "git:" + head
 
 class HTTPResource(CacheableResource):
-    def __init__(self, url):
-        super(HTTPResource, self).__init__()
+    def __init__(self, url, buffer_size=None, ttl=None, segments=None, sha256=None, refresh=None):
+        if ttl is not None and refresh is None:
+            refresh = "ttl={0}".format(ttl)
+        super(HTTPResource, self).__init__(refresh=refresh)
         self.url = url
+        self.buffer_size = buffer_size
+        self.segments = segments
+        self.sha256 = sha256.lower() if sha256 is not None else None
         self._filename = self._deduce_output_file_name(url)
+        self._cache = None
+    def get_path(self, env):
+        self._cache = env.cache
+        return super(HTTPResource, self).get_path(env)
     def get_cache_key(self):
+        if self.sha256 is not None:
+            return dict(sha256=self.sha256)
         return self.url
+    def can_fetch_offline(self, env):
+        # the contents might still be in the cache for another URL or key
+        return self.sha256 is not None and env.cache.has_blob(self.sha256)
     def refresh(self, path):
-        pass
+        if self.sha256 is not None:
+            return
+        metadata = self._load_metadata(path)
+        validators = dict((name, metadata.get(name)) for name in ("etag", "last_modified") if metadata.get(name))
+        if not validators:
+            _logger.debug("No validators stored for %s, cannot revalidate", self.url)
+            return
+        partial_path = "{0}.{1}{2}".format(path, os.getpid(), PARTIAL_SUFFIX)
+        try:
+            new_validators = download(self.url, path, buffer_size=self.buffer_size, validators=validators,
+                                      partial_path=partial_path, segments=self.segments)
+        finally:
+            for leftover_path in glob.glob(partial_path + "*"):
+                os.unlink(leftover_path)
+        if new_validators is not None:
+            _logger.info("Fetched updated version of %s", self.url)
+            self._cache.add_blob(path, new_validators["sha256"])
+            metadata.update(new_validators)
+            self._save_metadata(path, metadata)
     def fetch(self, path):
         output_path = os.path.join(path, self._filename)
-        _logger.info("Fetching %s", self.url)
-        with open(output_path, "w") as output_file:
-            shutil.copyfileobj(urllib2.urlopen(self.url), output_file)
+        if self.sha256 is not None and self._cache.link_blob(self.sha256, output_path):
+            _logger.info("%s found in cache by checksum, not fetching", self.url)
+            metadata = dict(sha256=self.sha256)
+        else:
+            metadata = download(self.url, output_path, buffer_size=self.buffer_size,
+                                segments=self.segments, sha256=self.sha256)
+            self._cache.add_blob(output_path, metadata["sha256"])
+        self._save_metadata(output_path, metadata)
         return output_path
+    def _get_metadata_path(self, path):
+        return os.path.join(os.path.dirname(path), _HTTP_METADATA_FILE_NAME)
+    def _load_metadata(self, path):
+        metadata_path = self._get_metadata_path(path)
+        if not os.path.exists(metadata_path):
+            return {}
+        with open(metadata_path) as metadata_file:
+            return json.load(metadata_file)
+    def _save_metadata(self, path, metadata):
+        metadata_path = self._get_metadata_path(path)
+        temp_path = "{0}.{1}.tmp".format(metadata_path, os.getpid())
+        with open(temp_path, "w") as metadata_file:
+            json.dump(metadata, metadata_file)
+        os.rename(temp_path, metadata_path)
     def _deduce_output_file_name(self, url):
         _, _, path, _, _ = urlsplit(url)
         name = path.split("/")[-1]
         if not name:
             name = "file"
         return name
+
+def _git_has_commit(repo_path, commit):
+    if not os.path.isdir(repo_path):
+        return False
+    return execute_command("git cat-file -e {0}^{{commit}}".format(commit), cwd=repo_path,
+                           stderr=subprocess.PIPE).returncode == 0
+
+def _get_git_head(git_dir):
+    with open(os.path.join(git_dir, "HEAD")) as head_file:
+        head = head_file.read().strip()
+    if not head.startswith("ref: "):
+        return head
+    ref = head[len("ref: "):]
+    ref_path = os.path.join(git_dir, *ref.split("/"))
+    if os.path.isfile(ref_path):
+        with open(ref_path) as ref_file:
+            return ref_file.read().strip()
+    packed_refs_path = os.path.join(git_dir, "packed-refs")
+    if os.path.isfile(packed_refs_path):
+        with open(packed_refs_path) as packed_refs_file:
+            for line in packed_refs_file:
+                parts = line.split()
+                if len(parts) == 2 and parts[1] == ref:
+                    return parts[0]
+    return None
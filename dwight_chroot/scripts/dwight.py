@@ -1,11 +1,16 @@
 #! /usr/bin/python
 from __future__ import print_function
 import argparse
+from contextlib import contextmanager
+import json
 import logging
+import signal
 import sys
 from ..environment import Environment
-from ..exceptions import UsageException
+from ..exceptions import CacheMiss, ConfigurationException, UsageException
 from ..platform_utils import unsudo_context
+from ..server import DEFAULT_SOCKET_PATH, Server, run_command_attached
+from ..timing import TIMING_FORMATS
 
 #################################### Actions ###################################
 
@@ -13,16 +18,68 @@ def _run_shell(env, args):
     return env.run_shell()
 
 def _run_cmd(env, args):
-    return env.run_command_in_chroot(args.cmd)
+    if not args.cmd:
+        raise UsageException("No command specified")
+    # a single argument is a shell command line, several are the argv of the command
+    cmd = args.cmd[0] if len(args.cmd) == 1 else args.cmd
+    if args.attach:
+        return run_command_attached(env, cmd, args.socket_path)
+    return env.run_command_in_chroot(cmd)
+
+def _run_batch(env, args):
+    with _open_or_std(args.commands_file, "r", sys.stdin) as commands_file:
+        cmds = [line.strip() for line in commands_file]
+    cmds = [cmd for cmd in cmds if cmd and not cmd.startswith("#")]
+    with _open_or_std(args.output_file, "w", sys.stdout) as output_file:
+        return env.run_commands_in_chroot(cmds, args.parallelism, output_file, args.log_dir)
+
+@contextmanager
+def _open_or_std(path, mode, std_file):
+    if path == "-":
+        yield std_file
+    else:
+        with open(path, mode) as f:
+            yield f
+
+def _fetch(env, args):
+    configs = []
+    for config_file_path in args.fetch_config_files:
+        config = env.config.copy()
+        with unsudo_context():
+            config.load_from_file(config_file_path)
+        configs.append(config)
+    env.fetch(configs or None)
+    return 0
+
+def _list(env, args):
+    for active_environment in env.mount_roots.list_active():
+        print(json.dumps(dict(
+            pid=active_environment.pid,
+            config_hash=active_environment.config_hash,
+            path=active_environment.path,
+            mounts=[mount._asdict() for mount in active_environment.mounts],
+            )))
+    return 0
+
+def _serve(env, args):
+    server = Server(env, args.socket_path)
+    signal.signal(signal.SIGTERM, server.handle_stop_signal)
+    server.serve_forever()
     
 ################################## Boilerplate #################################
 
 parser = argparse.ArgumentParser(usage="%(prog)s [options] action [action options/args]")
-parser.add_argument("-c", "--config-file", dest="config_files", type=open, action="append", default=[])
+parser.add_argument("-c", "--config-file", dest="config_files", action="append", default=[])
 parser.add_argument("-e", "--exclude-dwightrc", dest="load_user_config", action="store_false", default=True,
                     help="Don't use the default configuration file in ~/.dwightrc")
 parser.add_argument("-v", action="append_const", const=1, dest="verbosity", default=[], 
                     help="Be more verbose. Can be specified multiple times to increase verbosity further")
+parser.add_argument("--timings", dest="timings_path", default=None,
+                    help="Write the duration of each phase of the run to this file")
+parser.add_argument("--timings-format", dest="timings_format", choices=TIMING_FORMATS, default="json",
+                    help="Format of the timings file (json or chrome trace events)")
+parser.add_argument("--offline", action="store_true", default=False,
+                    help="Don't fetch or refresh resources, failing if they are not in the cache")
 subparsers = parser.add_subparsers(help="Action to be taken")
 
 shell_command_parser = subparsers.add_parser("shell", help="Run a shell inside the chrooted environment")
@@ -30,21 +87,54 @@ shell_command_parser.set_defaults(action=_run_shell)
 
 cmd_command_parser = subparsers.add_parser("cmd", help="Run a command inside the chrooted environment")
 cmd_command_parser.set_defaults(action=_run_cmd)
-cmd_command_parser.add_argument("cmd")
+cmd_command_parser.add_argument("--attach", action="store_true", default=False,
+                                help="Run the command in the environment kept by `dwight serve`")
+cmd_command_parser.add_argument("--socket", dest="socket_path", default=DEFAULT_SOCKET_PATH)
+cmd_command_parser.add_argument("cmd", nargs=argparse.REMAINDER,
+                                help="Command line to run through the shell, or the command and its arguments")
+
+batch_command_parser = subparsers.add_parser("batch", help="Run a list of commands inside the same chrooted environment")
+batch_command_parser.set_defaults(action=_run_batch)
+batch_command_parser.add_argument("-j", "--parallel", dest="parallelism", type=int, default=1,
+                                  help="Number of commands to run concurrently")
+batch_command_parser.add_argument("-o", "--output", dest="output_file", default="-",
+                                  help="File to which exit codes are written as JSON lines (default: stdout)")
+batch_command_parser.add_argument("-L", "--log-dir", dest="log_dir", default=None,
+                                  help="Directory to which the output of each command is written (default: a new temporary directory)")
+batch_command_parser.add_argument("commands_file", nargs="?", default="-",
+                                  help="File containing one command per line (default: stdin)")
+
+fetch_command_parser = subparsers.add_parser("fetch", help="Fetch the root image and includes into the cache, without chrooting")
+fetch_command_parser.set_defaults(action=_fetch)
+fetch_command_parser.add_argument("fetch_config_files", nargs="*", metavar="config_file",
+                                  help="Configuration files to fetch resources for (default: the loaded configuration)")
+
+list_command_parser = subparsers.add_parser("list", help="List the environments currently assembled and their mounts")
+list_command_parser.set_defaults(action=_list)
+
+serve_command_parser = subparsers.add_parser("serve", help="Keep the chrooted environment mounted for `cmd --attach`")
+serve_command_parser.set_defaults(action=_serve)
+serve_command_parser.add_argument("--socket", dest="socket_path", default=DEFAULT_SOCKET_PATH)
 
 def main(args):
     env = Environment()
 
-    with unsudo_context():
-        if args.load_user_config:
-            env.config.process_user_config_file()
-        for config_file in args.config_files:
-            env.config.load_from_string(config_file.read())
     try:
+        with unsudo_context(), env.timings.measure("config.load"):
+            if args.load_user_config:
+                env.config.process_user_config_file()
+            for config_file_path in args.config_files:
+                env.config.load_from_file(config_file_path)
+        if args.offline:
+            env.config["OFFLINE"] = True
         return args.action(env, args)
-    except UsageException as e:
+    except (UsageException, ConfigurationException, CacheMiss) as e:
         print(str(e), file=sys.stderr)
         return -1
+    finally:
+        if args.timings_path is not None:
+            with unsudo_context():
+                env.timings.save(args.timings_path, args.timings_format)
 
 def _configure_logging(args):
     verbosity_level = len(args.verbosity)
@@ -0,0 +1,219 @@
+import errno
+import hashlib
+import json
+import logging
+import os
+import socket
+import sys
+
+from .cache import serialize_key
+from .exceptions import AttachFailed, NotRootException
+from .include import Include
+from .platform_utils import enter_mount_namespace
+
+_logger = logging.getLogger(__name__)
+
+DEFAULT_SOCKET_PATH = os.path.expanduser("~/.dwight-cache/serve.sock")
+_ACK_TIMEOUT = 30
+
+def get_mount_spec(config):
+    snapshot = config.get_snapshot()
+    root_image = snapshot["ROOT_IMAGE"]
+    if not isinstance(root_image, dict):
+        root_image = Include("/", root_image).to_dict()
+    return dict(root_image=root_image, includes=snapshot["INCLUDES"])
+
+def get_mount_spec_hash(spec):
+    return hashlib.sha1(serialize_key(spec).encode("utf-8")).hexdigest()
+
+class _NamespaceHolder(object):
+    def __init__(self, env):
+        super(_NamespaceHolder, self).__init__()
+        self._env = env
+        self._pid = None
+        self._lifetime_fd = None
+        self._config_hash = None
+        self.root_path = None
+    def start(self, fds_to_close_in_child=()):
+        root_image_path, include_paths = self._env.prepare()
+        self._config_hash = self._env.config.get_hash()
+        status_read_fd, status_write_fd = os.pipe()
+        lifetime_read_fd, lifetime_write_fd = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            self._hold_namespace(root_image_path, include_paths, status_write_fd, lifetime_read_fd,
+                                 [status_read_fd, lifetime_write_fd] + list(fds_to_close_in_child))
+        os.close(status_write_fd)
+        os.close(lifetime_read_fd)
+        self._pid = pid
+        self._lifetime_fd = lifetime_write_fd
+        with os.fdopen(status_read_fd, "rb") as status_file:
+            status = json.loads(status_file.readline().decode("utf-8") or "{}")
+        if "root" not in status:
+            self.stop()
+            raise AttachFailed("Cannot assemble the environment ({0})".format(status.get("error", "unknown error")))
+        self.root_path = status["root"]
+    def _hold_namespace(self, root_image_path, include_paths, status_fd, lifetime_fd, fds_to_close):
+        try:
+            for fd in fds_to_close:
+                os.close(fd)
+            with self._env.overlay_lock():
+                try:
+                    status = dict(root=self._env.assemble(root_image_path, include_paths))
+                except Exception as e:
+                    _logger.error("Error occurred assembling environment", exc_info=True)
+                    status = dict(error=str(e))
+                os.write(status_fd, (json.dumps(status) + "\n").encode("utf-8"))
+                os.close(status_fd)
+                if "root" in status:
+                    # the namespace stays alive until the server closes its end of the pipe
+                    while os.read(lifetime_fd, 1):
+                        pass
+        finally:
+            os._exit(0)
+    def get_lifetime_fd(self):
+        return self._lifetime_fd
+    def get_namespace_path(self):
+        return "/proc/{0}/ns/mnt".format(self._pid)
+    def stop(self):
+        if self._pid is None:
+            return
+        os.close(self._lifetime_fd)
+        os.waitpid(self._pid, 0)
+        self._env.mount_roots.release(self._config_hash, self._pid)
+        self._pid = self._lifetime_fd = None
+
+class Server(object):
+    def __init__(self, env, socket_path=DEFAULT_SOCKET_PATH):
+        super(Server, self).__init__()
+        self._env = env
+        self._socket_path = socket_path
+        self._socket = None
+        self._connection = None
+        self._holder = None
+        self._spec_hash = None
+        self._stop_requested = False
+    def start(self):
+        if os.getuid() != 0:
+            raise NotRootException("Dwight must be run as root")
+        self._env.config.check()
+        self._ensure_holder(get_mount_spec(self._env.config))
+        if not os.path.isdir(os.path.dirname(self._socket_path)):
+            os.makedirs(os.path.dirname(self._socket_path))
+        try:
+            os.unlink(self._socket_path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self._socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self._socket.bind(self._socket_path)
+        os.chmod(self._socket_path, 0o600)
+        self._socket.listen(128)
+        _logger.info("Listening on %s", self._socket_path)
+    def serve_forever(self):
+        self.start()
+        try:
+            while not self._stop_requested:
+                self.handle_request()
+        finally:
+            self.stop()
+    def handle_stop_signal(self, signum, frame):
+        # an exception raised in the middle of socket IO can get lost, so requests are completed first
+        if self._connection is not None:
+            self._stop_requested = True
+        else:
+            sys.exit(0)
+    def handle_request(self):
+        self._connection, _ = self._socket.accept()
+        try:
+            self._connection.settimeout(_ACK_TIMEOUT)
+            self._handle_connection(self._connection)
+        except Exception:
+            _logger.error("Error occurred handling request", exc_info=True)
+        finally:
+            self._connection.close()
+            self._connection = None
+    def _handle_connection(self, connection):
+        connection_file = connection.makefile("rwb")
+        try:
+            request = json.loads(connection_file.readline().decode("utf-8"))
+            try:
+                self._ensure_holder(request["spec"], request["spec_hash"])
+                reply = dict(namespace=self._holder.get_namespace_path(), root=self._holder.root_path)
+            except Exception as e:
+                _logger.error("Cannot prepare environment", exc_info=True)
+                reply = dict(error=str(e))
+            connection_file.write((json.dumps(reply) + "\n").encode("utf-8"))
+            connection_file.flush()
+            if "error" not in reply:
+                # don't replace the namespace before the client has entered it
+                connection_file.readline()
+        finally:
+            connection_file.close()
+    def _ensure_holder(self, spec, spec_hash=None):
+        if spec_hash is None:
+            spec_hash = get_mount_spec_hash(spec)
+        if self._holder is not None and spec_hash == self._spec_hash:
+            return
+        _logger.info("Configuration changed (%s), assembling environment", spec_hash)
+        self._env.config["ROOT_IMAGE"] = Include.from_dict(spec["root_image"])
+        self._env.config["INCLUDES"] = [Include.from_dict(include_spec) for include_spec in spec["includes"]]
+        if self._env.config["OVERLAY"] == "persistent":
+            # the new holder would wait for the previous one to release the overlay
+            self._stop_holder()
+        holder = _NamespaceHolder(self._env)
+        holder.start(fds_to_close_in_child=self._get_inherited_fds())
+        self._stop_holder()
+        self._holder = holder
+        self._spec_hash = spec_hash
+    def _get_inherited_fds(self):
+        returned = [sock.fileno() for sock in (self._socket, self._connection) if sock is not None]
+        if self._holder is not None:
+            # otherwise the new holder keeps the previous one alive
+            returned.append(self._holder.get_lifetime_fd())
+        return returned
+    def _stop_holder(self):
+        if self._holder is not None:
+            self._holder.stop()
+            self._holder = None
+    def stop(self):
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+            os.unlink(self._socket_path)
+        self._stop_holder()
+
+def run_command_attached(env, cmd, socket_path=DEFAULT_SOCKET_PATH):
+    if os.getuid() != 0:
+        raise NotRootException("Dwight must be run as root")
+    env.config.check()
+    spec = get_mount_spec(env.config)
+    connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        connection.connect(socket_path)
+    except socket.error as e:
+        connection.close()
+        raise AttachFailed("Cannot connect to {0} ({1})".format(socket_path, e))
+    connection_file = connection.makefile("rwb")
+    try:
+        connection_file.write((json.dumps(dict(spec=spec, spec_hash=get_mount_spec_hash(spec))) + "\n").encode("utf-8"))
+        connection_file.flush()
+        reply = json.loads(connection_file.readline().decode("utf-8") or "{}")
+        if "root" not in reply:
+            raise AttachFailed("Cannot attach to environment ({0})".format(reply.get("error", "connection closed")))
+        child_pid = os.fork()
+        if child_pid == 0:
+            try:
+                enter_mount_namespace(reply["namespace"])
+                connection_file.write(b"entered\n")
+                connection_file.flush()
+                connection_file.close()
+                connection.close()
+            except Exception:
+                _logger.error("Cannot enter environment", exc_info=True)
+                os._exit(-1)
+            env.run_command_in_root_as_forked_child(cmd, reply["root"])
+    finally:
+        connection_file.close()
+        connection.close()
+    return env.wait_for_forked_child(child_pid)
@@ -0,0 +1,114 @@
+from contextlib import contextmanager
+import errno
+import fcntl
+import hashlib
+import logging
+import os
+import shutil
+
+_logger = logging.getLogger(__name__)
+
+STAGE_TYPES = (None, "readahead", "ram")
+
+_LOCK_FILE_NAME = ".lock"
+_STAGED_FILE_SUFFIX = ".squashfs"
+_SIGNATURE_FILE_SUFFIX = ".signature"
+# without an explicit limit, staged images may use up to this fraction of the filesystem holding them
+_DEFAULT_MAX_SIZE_FRACTION = 0.5
+
+class StagingArea(object):
+    def __init__(self, path, max_size=None):
+        super(StagingArea, self).__init__()
+        self.path = path
+        self.max_size = max_size
+    def stage(self, path):
+        # returns the path of the staged copy (None if it cannot be staged), and whether it was already staged
+        path_stat = os.stat(path)
+        # a single copy is kept per image, replaced whenever the image changes
+        staged_path = os.path.join(self.path, _get_staged_file_name(path))
+        signature = _get_signature(path, path_stat)
+        with self._lock():
+            if os.path.exists(staged_path) and _read_signature(staged_path) == signature:
+                # the modification time of staged images is their last use, for eviction
+                os.utime(staged_path, None)
+                return staged_path, True
+            _remove_staged(staged_path)
+            max_size = self._get_max_size()
+            if max_size is not None and path_stat.st_size > max_size:
+                _logger.debug("%s is larger than the staging area (%s bytes)", path, max_size)
+                return None, False
+            self._evict(path_stat.st_size, max_size)
+            temp_path = "{0}.{1}.tmp".format(staged_path, os.getpid())
+            try:
+                shutil.copyfile(path, temp_path)
+                os.rename(temp_path, staged_path)
+                _write_signature(staged_path, signature)
+            except:
+                _remove_if_exists(temp_path)
+                _remove_staged(staged_path)
+                raise
+        return staged_path, False
+    def get_staged_paths(self):
+        if not os.path.isdir(self.path):
+            return []
+        returned = [os.path.join(self.path, name) for name in os.listdir(self.path) if name.endswith(_STAGED_FILE_SUFFIX)]
+        return sorted(returned, key=lambda staged_path: os.stat(staged_path).st_mtime)
+    def _get_max_size(self):
+        if self.max_size is not None:
+            return self.max_size
+        try:
+            fs_stat = os.statvfs(self.path)
+        except (AttributeError, OSError):
+            return None
+        return int(fs_stat.f_blocks * fs_stat.f_frsize * _DEFAULT_MAX_SIZE_FRACTION)
+    def _evict(self, needed_size, max_size):
+        if max_size is None:
+            return
+        staged = [(staged_path, os.stat(staged_path).st_size) for staged_path in self.get_staged_paths()]
+        total_size = sum(size for _, size in staged)
+        # images still mounted keep their memory until they are unmounted
+        while staged and total_size + needed_size > max_size:
+            staged_path, size = staged.pop(0)
+            _logger.debug("Evicting %s from the staging area", staged_path)
+            _remove_staged(staged_path)
+            total_size -= size
+    @contextmanager
+    def _lock(self):
+        if not os.path.isdir(self.path):
+            os.makedirs(self.path, 0o700)
+        lock_fd = os.open(os.path.join(self.path, _LOCK_FILE_NAME), os.O_RDONLY | os.O_CREAT, 0o600)
+        try:
+            fcntl.flock(lock_fd, fcntl.LOCK_EX)
+            yield
+        finally:
+            os.close(lock_fd)
+
+def _get_staged_file_name(path):
+    return hashlib.sha1(os.path.realpath(path).encode("utf-8")).hexdigest() + _STAGED_FILE_SUFFIX
+
+def _get_signature(path, path_stat):
+    return "{0}:{1}:{2}".format(path_stat.st_ino, path_stat.st_mtime, path_stat.st_size)
+
+def _read_signature(staged_path):
+    try:
+        with open(staged_path + _SIGNATURE_FILE_SUFFIX) as signature_file:
+            return signature_file.read()
+    except (IOError, OSError):
+        return None
+
+def _write_signature(staged_path, signature):
+    temp_path = "{0}{1}.{2}.tmp".format(staged_path, _SIGNATURE_FILE_SUFFIX, os.getpid())
+    with open(temp_path, "w") as signature_file:
+        signature_file.write(signature)
+    os.rename(temp_path, staged_path + _SIGNATURE_FILE_SUFFIX)
+
+def _remove_staged(staged_path):
+    _remove_if_exists(staged_path)
+    _remove_if_exists(staged_path + _SIGNATURE_FILE_SUFFIX)
+
+def _remove_if_exists(path):
+    try:
+        os.unlink(path)
+    except OSError as e:
+        if e.errno != errno.ENOENT:
+            raise
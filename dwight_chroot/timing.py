@@ -0,0 +1,64 @@
+from contextlib import contextmanager
+import fcntl
+import json
+import os
+import threading
+import time
+
+TIMING_FORMATS = ("json", "chrome")
+
+class Timings(object):
+    def __init__(self):
+        super(Timings, self).__init__()
+        self._lock = threading.Lock()
+        self._records = []
+    @contextmanager
+    def measure(self, name, **args):
+        start = time.time()
+        try:
+            yield
+        finally:
+            self.add(name, start, time.time() - start, **args)
+    def add(self, name, start, duration, **args):
+        record = dict(name=name, start=start, duration=duration, pid=os.getpid(),
+                      thread=threading.current_thread().ident, args=args)
+        with self._lock:
+            self._records.append(record)
+    def get_records(self):
+        with self._lock:
+            return sorted(self._records, key=lambda record: record["start"])
+    def send(self, fd):
+        with os.fdopen(fd, "wb") as f:
+            f.write(json.dumps(self.get_records()).encode("utf-8"))
+    def receive(self, fd):
+        with os.fdopen(fd, "rb") as f:
+            data = f.read()
+        if not data:
+            return
+        records = json.loads(data.decode("utf-8"))
+        with self._lock:
+            self._records.extend(records)
+    def to_json(self):
+        return dict(timings=self.get_records())
+    def to_chrome_trace(self):
+        events = []
+        for record in self.get_records():
+            events.append(dict(
+                name=record["name"], ph="X", pid=record["pid"], tid=record["thread"],
+                ts=int(record["start"] * 1000000), dur=int(record["duration"] * 1000000),
+                args=record["args"],
+                ))
+        return dict(traceEvents=events, displayTimeUnit="ms")
+    def save(self, path, format="json"):
+        if format == "chrome":
+            report = self.to_chrome_trace()
+        else:
+            report = self.to_json()
+        with open(path, "w") as report_file:
+            json.dump(report, report_file, indent=2)
+
+def open_pipe():
+    returned = os.pipe()
+    for fd in returned:
+        fcntl.fcntl(fd, fcntl.F_SETFD, fcntl.fcntl(fd, fcntl.F_GETFD) | fcntl.FD_CLOEXEC)
+    return returned
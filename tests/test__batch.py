@@ -0,0 +1,49 @@
+import json
+import os
+import platform
+import time
+from tempfile import mkdtemp
+from .test_utils import EnvironmentTestCase, use_host_root_as_root_image
+from dwight_chroot.include import Include
+
+class BatchTest(EnvironmentTestCase):
+    def setUp(self):
+        super(BatchTest, self).setUp()
+        if os.getuid() != 0:
+            self.skipTest("Not root")
+        if platform.system() != "Linux":
+            self.skipTest("Not linux")
+        use_host_root_as_root_image(self.environment)
+        self.dest = mkdtemp()
+        self.source = mkdtemp()
+        open(os.path.join(self.source, "file"), "w").close()
+        self.environment.config["INCLUDES"] = [Include(self.dest, self.source)]
+        self.report_path = os.path.join(mkdtemp(), "report.jsonl")
+        self.log_dir = os.path.join(mkdtemp(), "logs")
+    def test__sequential(self):
+        cmds = ["test -f {0}/file".format(self.dest), "test -f {0}/other_file".format(self.dest), "true"]
+        self.assertEquals(self.run_batch(cmds), 1)
+        self.assertEquals(self.get_report(), [
+            dict(index=0, command=cmds[0], exit_code=0, log=os.path.join(self.log_dir, "0.log")),
+            dict(index=1, command=cmds[1], exit_code=1, log=os.path.join(self.log_dir, "1.log")),
+            dict(index=2, command=cmds[2], exit_code=0, log=os.path.join(self.log_dir, "2.log")),
+            ])
+    def test__output_kept_out_of_report(self):
+        self.assertEquals(self.run_batch(["echo out; echo err >&2", "echo other"]), 0)
+        self.assertEquals([record["index"] for record in self.get_report()], [0, 1])
+        with open(os.path.join(self.log_dir, "0.log")) as log_file:
+            self.assertEquals(log_file.read(), "out\nerr\n")
+        with open(os.path.join(self.log_dir, "1.log")) as log_file:
+            self.assertEquals(log_file.read(), "other\n")
+    def test__parallel(self):
+        cmds = ["sleep 0.5"] * 4
+        start_time = time.time()
+        self.assertEquals(self.run_batch(cmds, parallelism=4), 0)
+        self.assertLess(time.time() - start_time, 1.5)
+        self.assertEquals(sorted(record["index"] for record in self.get_report()), [0, 1, 2, 3])
+    def run_batch(self, cmds, parallelism=1):
+        with open(self.report_path, "w") as report_file:
+            return self.environment.run_commands_in_chroot(cmds, parallelism, report_file, self.log_dir)
+    def get_report(self):
+        with open(self.report_path) as report_file:
+            return [json.loads(line) for line in report_file]
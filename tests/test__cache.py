@@ -1,14 +1,27 @@
 import copy
+import json
+import multiprocessing
 import os
 import shutil
+import threading
+import time
 from tempfile import mkdtemp
 from .test_utils import TestCase
 from dwight_chroot.cache import Cache
+from dwight_chroot.config import DwightConfiguration
+from dwight_chroot.environment import Environment
+from dwight_chroot.platform_utils import run_detached
 from dwight_chroot.resources import CacheableResource
+from dwight_chroot.timing import Timings
+
+def _write_ids(path):
+    with open(path + ".tmp", "w") as ids_file:
+        json.dump(dict(uids=os.getresuid(), gids=os.getresgid()), ids_file)
+    os.rename(path + ".tmp", path)
 
 class DummyCachedItem(CacheableResource):
-    def __init__(self, key, src_path):
-        super(DummyCachedItem, self).__init__()
+    def __init__(self, key, src_path, refresh=None):
+        super(DummyCachedItem, self).__init__(refresh=refresh)
         self.key = key
         self.src_path = src_path
         self.refresh_count = 0
@@ -21,11 +34,24 @@ class DummyCachedItem(CacheableResource):
         shutil.rmtree(path)
         shutil.copytree(self.src_path, path)
 
+class FingerprintedDummyCachedItem(DummyCachedItem):
+    fingerprint = "fingerprint"
+    def get_fingerprint(self, path):
+        return self.fingerprint
+
+def _register_items_in_separate_process(cache_path, process_index, num_items):
+    cache = Cache(cache_path)
+    for i in range(num_items):
+        path = cache.create_new_path()
+        cache.register_new_path(path, dict(process=process_index, item=i))
+
 class DummyEnvironment(object):
     def __init__(self):
         super(DummyEnvironment, self).__init__()
         self.cache = Cache(mkdtemp())
-        
+        self.config = DwightConfiguration()
+        self.timings = Timings()
+
 class CacheTest(TestCase):
     def setUp(self):
         super(CacheTest, self).setUp()
@@ -46,11 +72,49 @@ class CacheTest(TestCase):
         new_path = self.item.get_path(self.env)
         self.assertEquals(self.item.refresh_count, 1)
         self.assertEquals(new_path, old_path)
+    def test__refresh_policy_never(self):
+        self.env.config["REFRESH_POLICY"] = "never"
+        self.item.get_path(self.env)
+        self.item.get_path(self.env)
+        self.assertEquals(self.item.refresh_count, 0)
+    def test__refresh_policy_ttl(self):
+        self.env.config["REFRESH_POLICY"] = "ttl=1000"
+        path = self.item.get_path(self.env)
+        self.item.get_path(self.env)
+        self.assertEquals(self.item.refresh_count, 0)
+        self.env.cache._state.update_item(path, last_refresh=self.env.cache.get_last_refresh(path) - 2000)
+        self.item.get_path(self.env)
+        self.assertEquals(self.item.refresh_count, 1)
+        self.env.cache = Cache(self.env.cache.root)
+        self.item.get_path(self.env)
+        self.assertEquals(self.item.refresh_count, 1)
+    def test__per_resource_refresh_policy(self):
+        self.env.config["REFRESH_POLICY"] = "never"
+        item = DummyCachedItem(dict(a=3), self.src_path, refresh="always")
+        item.get_path(self.env)
+        item.get_path(self.env)
+        self.assertEquals(item.refresh_count, 1)
     def test__saving_and_reloading(self):
         path = self.test__fetching_from_scratch()
-        old_state = copy.deepcopy(self.env.cache._state)
+        old_items = copy.deepcopy(self.env.cache._state.get_items())
         self.env.cache = Cache(self.env.cache.root)
-        self.assertEquals(self.env.cache._state, old_state)
+        self.assertEquals(self.env.cache._state.get_items(), old_items)
+    def test__migration_from_json_state(self):
+        root = mkdtemp()
+        item_path = os.path.join(root, "items", "3")
+        os.makedirs(item_path)
+        with open(os.path.join(root, ".state.json"), "w") as state_file:
+            json.dump(dict(next_id=4, items=[dict(key=dict(url="a"), path=item_path, size=10, last_access=1, hits=2)],
+                           incomplete_paths={}), state_file)
+        cache = Cache(root)
+        self.assertEquals(cache.get_path(dict(url="a")), item_path)
+        self.assertEquals(cache.create_new_path(), os.path.join(root, "items", "4"))
+        self.assertFalse(os.path.exists(os.path.join(root, ".state.json")))
+        self.assertEquals([item["hits"] for item in Cache(root)._state.get_items()], [3])
+    def test__accesses_visible_to_other_instances(self):
+        path = self.item.get_path(self.env)
+        self.env.cache.get_path(self.item.get_cache_key())
+        self.assertEquals(Cache(self.env.cache.root)._state.get_item_by_path(path)["hits"], 1)
     def test__new_item_on_already_existing_directory(self):
         os.makedirs(os.path.join(self.env.cache.root, "items", "0"))
         self.assertEquals(self.env.cache.create_new_path(), os.path.join(self.env.cache.root, "items", "1"))
@@ -67,11 +131,224 @@ class CacheTest(TestCase):
         self.assertFalse(os.path.exists(p1))
         self.assertTrue(os.path.exists(p2))
         self.assertTrue(os.path.exists(p3))
+    def test__cleanup_moves_items_to_trash(self):
+        cache = Cache(mkdtemp())
+        p1 = self._create_cache_item(cache, 1, 1000)
+        cache.cleanup(10, [])
+        self.assertFalse(os.path.exists(p1))
+        self.assertIsNone(cache.get_path(1))
+        self.assertTrue(cache.has_trash())
+        self.assertTrue(cache.reap_trash())
+        self.assertFalse(cache.has_trash())
+    def test__reaping_throttled(self):
+        cache = Cache(mkdtemp())
+        for key in range(3):
+            self._create_cache_item(cache, key, 10000)
+        cache.cleanup(0, [])
+        start_time = time.time()
+        cache.reap_trash(max_bytes_per_second=100000)
+        self.assertGreaterEqual(time.time() - start_time, 0.3)
+        self.assertFalse(cache.has_trash())
+    def test__single_reaper(self):
+        cache = Cache(mkdtemp())
+        self._create_cache_item(cache, 1, 1000)
+        cache.cleanup(0, [])
+        with cache.exclusive_lock("reaper"):
+            self.assertFalse(Cache(cache.root).reap_trash())
+        self.assertTrue(cache.has_trash())
+    def test__background_reaper(self):
+        path = self.env.cache.create_new_path()
+        shutil.copytree(self.src_path, os.path.join(path, "contents"))
+        self.env.cache._move_to_trash(path)
+        self.assertTrue(self.env.cache.has_trash())
+        env = Environment()
+        env.cache = self.env.cache
+        env._fetch_and_cleanup([])
+        deadline = time.time() + 10
+        while self.env.cache.has_trash() and time.time() < deadline:
+            time.sleep(0.05)
+        self.assertFalse(self.env.cache.has_trash())
+    def test__detached_process_drops_privileges(self):
+        if os.getuid() != 0:
+            self.skipTest("Not root")
+        directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        os.chmod(directory, 0o777)
+        ids_path = os.path.join(directory, "ids")
+        for name in ("SUDO_UID", "SUDO_GID"):
+            self.addCleanup(os.environ.pop, name)
+            os.environ[name] = "65534"
+        run_detached(_write_ids, ids_path)
+        deadline = time.time() + 10
+        while not os.path.exists(ids_path) and time.time() < deadline:
+            time.sleep(0.05)
+        with open(ids_path) as ids_file:
+            self.assertEquals(json.load(ids_file), dict(uids=[65534] * 3, gids=[65534] * 3))
     def test__cleanup_used_keys(self):
         cache = Cache(mkdtemp())
         p1 = self._create_cache_item(cache, 1, 1000)
         cache.cleanup(10, skip_keys=[1])
         self.assertTrue(os.path.exists(p1))
+    def test__cleanup_lru(self):
+        cache = Cache(mkdtemp())
+        p1 = self._create_cache_item(cache, 1, 1000)
+        p2 = self._create_cache_item(cache, 2, 1000)
+        cache.get_path(1)
+        p3 = self._create_cache_item(cache, 3, 1000)
+        cache.cleanup(2000, [], policy="lru")
+        self.assertTrue(os.path.exists(p1))
+        self.assertFalse(os.path.exists(p2))
+        self.assertTrue(os.path.exists(p3))
+    def test__cleanup_lfu(self):
+        cache = Cache(mkdtemp())
+        p1 = self._create_cache_item(cache, 1, 1000)
+        p2 = self._create_cache_item(cache, 2, 1000)
+        for i in range(3):
+            cache.get_path(1)
+        cache.get_path(2)
+        p3 = self._create_cache_item(cache, 3, 1000)
+        cache.cleanup(2000, [], policy="lfu")
+        self.assertTrue(os.path.exists(p1))
+        self.assertTrue(os.path.exists(p2))
+        self.assertFalse(os.path.exists(p3))
+    def test__cleanup_size_weighted(self):
+        cache = Cache(mkdtemp())
+        p1 = self._create_cache_item(cache, 1, 1000)
+        p2 = self._create_cache_item(cache, 2, 5000)
+        p3 = self._create_cache_item(cache, 3, 1000)
+        cache.cleanup(5000, [], policy="size")
+        self.assertTrue(os.path.exists(p1))
+        self.assertFalse(os.path.exists(p2))
+        self.assertTrue(os.path.exists(p3))
+    def test__cleanup_without_max_size(self):
+        cache = Cache(mkdtemp())
+        p1 = self._create_cache_item(cache, 1, 1000)
+        cache.cleanup(None, [])
+        self.assertTrue(os.path.exists(p1))
+    def test__concurrent_processes(self):
+        num_processes = 4
+        num_items = 20
+        processes = [multiprocessing.Process(target=_register_items_in_separate_process,
+                                             args=(self.env.cache.root, process_index, num_items))
+                     for process_index in range(num_processes)]
+        for process in processes:
+            process.start()
+        for process in processes:
+            process.join()
+            self.assertEquals(process.exitcode, 0)
+        cache = Cache(self.env.cache.root)
+        paths = set()
+        for process_index in range(num_processes):
+            for i in range(num_items):
+                path = cache.get_path(dict(process=process_index, item=i))
+                self.assertIsNotNone(path)
+                paths.add(path)
+        self.assertEquals(len(paths), num_processes * num_items)
+    def test__state_changes_visible_to_other_instances(self):
+        other_cache = Cache(self.env.cache.root)
+        path = self.item.get_path(self.env)
+        self.assertEquals(other_cache.get_path(self.item.get_cache_key()), path)
+    def test__cleanup_skips_items_in_use_by_others(self):
+        cache = Cache(mkdtemp())
+        p1 = self._create_cache_item(cache, 1, 1000)
+        p2 = self._create_cache_item(cache, 2, 1000)
+        other_cache = Cache(cache.root)
+        other_cache.get_path(1)
+        cache.cleanup(10, [])
+        self.assertTrue(os.path.exists(p1))
+        self.assertFalse(os.path.exists(p2))
+        self.assertEquals(other_cache.get_path(1), os.path.dirname(p1))
+        self.assertIsNone(other_cache.get_path(2))
+    def test__cleanup_evicts_next_item_when_victim_in_use(self):
+        cache = Cache(mkdtemp())
+        p1 = self._create_cache_item(cache, 1, 1000)
+        p2 = self._create_cache_item(cache, 2, 1000)
+        p3 = self._create_cache_item(cache, 3, 1000)
+        other_cache = Cache(cache.root)
+        other_cache.get_path(1)
+        # the item in use stays the least recently used one
+        cache.get_path(2)
+        cache.get_path(3)
+        cache.cleanup(2000, [], policy="lru")
+        self.assertTrue(os.path.exists(p1))
+        self.assertFalse(os.path.exists(p2))
+        self.assertTrue(os.path.exists(p3))
+    def test__lookups_do_not_wait_for_state_lock(self):
+        cache = Cache(mkdtemp())
+        path = os.path.dirname(self._create_cache_item(cache, 1, 1000))
+        results = []
+        def look_up():
+            results.append(cache.get_path(1))
+            results.append(cache.get_last_refresh(path) is not None)
+        with Cache(cache.root)._state_lock():
+            lookup_thread = threading.Thread(target=look_up)
+            lookup_thread.daemon = True
+            lookup_thread.start()
+            lookup_thread.join(10)
+        self.assertEquals(results, [path, True])
+    def test__lookup_misses_item_purged_before_pin(self):
+        cache = Cache(mkdtemp())
+        self._create_cache_item(cache, 1, 1000)
+        cache.close()
+        other_cache = Cache(cache.root)
+        pin = cache._pin
+        def pin_after_purge(path):
+            other_cache.cleanup(0, [])
+            pin(path)
+        cache._pin = pin_after_purge
+        self.assertIsNone(cache.get_path(1))
+    def test__lookup_after_cleanup_and_reload(self):
+        cache = Cache(mkdtemp())
+        p1 = self._create_cache_item(cache, dict(url="a", branch=None), 1000)
+        p2 = self._create_cache_item(cache, dict(branch=None, url="b"), 1000)
+        self.assertEquals(cache.get_path(dict(url="a", branch=None)), os.path.dirname(p1))
+        self.assertEquals(cache.get_path(dict(url="b", branch=None)), os.path.dirname(p2))
+        cache.cleanup(1000, [])
+        self.assertIsNone(cache.get_path(dict(url="a", branch=None)))
+        cache = Cache(cache.root)
+        self.assertIsNone(cache.get_path(dict(url="a", branch=None)))
+        self.assertEquals(cache.get_path(dict(url="b", branch=None)), os.path.dirname(p2))
+        cache.update_path(os.path.dirname(p2))
+        with self.assertRaises(LookupError):
+            cache.update_path(os.path.dirname(p1))
+    def test__size_not_recalculated_for_unchanged_fingerprint(self):
+        item = FingerprintedDummyCachedItem(dict(a=2), self.src_path)
+        path = item.get_path(self.env)
+        self.assertEquals(self._get_item_size(path), 5)
+        with open(os.path.join(path, "otherfile.txt"), "w") as f:
+            f.write("hello")
+        item.get_path(self.env)
+        self.assertEquals(self._get_item_size(path), 5)
+        item.fingerprint = "other_fingerprint"
+        item.get_path(self.env)
+        self.assertEquals(self._get_item_size(path), 10)
+    def test__size_recalculated_without_fingerprint(self):
+        path = self.item.get_path(self.env)
+        with open(os.path.join(path, "otherfile.txt"), "w") as f:
+            f.write("hello")
+        self.item.get_path(self.env)
+        self.assertEquals(self._get_item_size(path), 10)
+    def test__file_item_size(self):
+        file_path = os.path.join(self.env.cache.create_new_path(), "file")
+        with open(file_path, "wb") as f:
+            f.write("\x00".encode("utf-8") * 1000)
+        self.env.cache.register_new_path(file_path, "file_key")
+        self.assertEquals(self._get_item_size(file_path), 1000)
+        with open(file_path, "ab") as f:
+            f.write("\x00".encode("utf-8") * 1000)
+        self.env.cache.update_path(file_path)
+        self.assertEquals(self._get_item_size(file_path), 2000)
+    def test__hardlinks_counted_once(self):
+        path = self.env.cache.create_new_path()
+        with open(os.path.join(path, "file"), "wb") as f:
+            f.write("\x00".encode("utf-8") * 1000)
+        os.link(os.path.join(path, "file"), os.path.join(path, "link"))
+        os.makedirs(os.path.join(path, "subdir"))
+        os.link(os.path.join(path, "file"), os.path.join(path, "subdir", "link"))
+        self.env.cache.register_new_path(path, "hardlinks_key")
+        self.assertEquals(self._get_item_size(path), 1000)
+    def _get_item_size(self, path):
+        return self.env.cache._state.get_item_by_path(path)["size"]
     def _create_cache_item(self, cache, key, size):
         root_path = cache.create_new_path()
         p = cache.create_new_path()
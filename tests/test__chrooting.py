@@ -53,6 +53,8 @@ class ChrootingTestCase(EnvironmentTestCase):
     def test__pwd(self):
         self.assertChrootOutput("pwd", self.environment.config["PWD"] + "\n")
     def test__num_loop_devices(self):
+        if self.environment.loop_devices.supports_dynamic_allocation():
+            self.skipTest("Loop devices are allocated on demand")
         self.environment.config["NUM_LOOP_DEVICES"] = 20
         for loop_device in self.get_all_loop_devices():
             os.unlink(loop_device)
@@ -1,6 +1,7 @@
 from .test_utils import EnvironmentTestCase
 import os
 from tempfile import mkdtemp
+from dwight_chroot.config import DwightConfiguration, _compiled_config_cache
 from dwight_chroot.exceptions import (
     CannotLoadConfiguration,
     InvalidConfiguration,
@@ -19,10 +20,34 @@ class ConfigurationLoadingTest(EnvironmentTestCase):
     def test__base_image_required(self):
         with self.assertRaisesRegexp(InvalidConfiguration, "ROOT_IMAGE option is not set"):
             self.environment.config.check()
+    def test__unknown_eviction_policy(self):
+        self.environment.config["ROOT_IMAGE"] = "a"
+        self.environment.config["CACHE_EVICTION_POLICY"] = "random"
+        with self.assertRaisesRegexp(InvalidConfiguration, "CACHE_EVICTION_POLICY"):
+            self.environment.config.check()
+    def test__invalid_refresh_policy(self):
+        self.environment.config["ROOT_IMAGE"] = "a"
+        self.environment.config["REFRESH_POLICY"] = "ttl=soon"
+        with self.assertRaisesRegexp(InvalidConfiguration, "REFRESH_POLICY"):
+            self.environment.config.check()
+    def test__invalid_overlay(self):
+        for option, value in [("OVERLAY", "upper"), ("OVERLAY_NAME", "../a"), ("OVERLAY_NAME", "")]:
+            config = type(self.environment.config)()
+            config["ROOT_IMAGE"] = "a"
+            config[option] = value
+            with self.assertRaisesRegexp(InvalidConfiguration, option):
+                config.check()
     def test__configuration_defaults(self):
         self.environment.config.load_from_string('ROOT_IMAGE="a"')
         self.assertEquals(self.environment.config["INCLUDES"], [])
         self.assertEquals(self.environment.config["ENVIRON"], {})
+    def test__root_image_include(self):
+        self.environment.config.load_from_string('ROOT_IMAGE = Include("/", "http://server/image.squashfs", sha256="ab")')
+        resource = self.environment._get_root_image_include().to_resource()
+        self.assertEquals(resource.url, "http://server/image.squashfs")
+        self.assertEquals(resource.sha256, "ab")
+        self.environment.config["ROOT_IMAGE"] = "/path/to/image.squashfs"
+        self.assertEquals(self.environment._get_root_image_include().source, "/path/to/image.squashfs")
     def test__getitem_setitem(self):
         self.environment.config["ROOT_IMAGE"] = "a"
         self.assertEquals(self.environment.config["ROOT_IMAGE"], "a")
@@ -56,3 +81,50 @@ INCLUDES += [Include("/b", "/x")]
                           ["/a", "/b"])
         
     
+
+class CompiledConfigurationTest(EnvironmentTestCase):
+    def setUp(self):
+        super(CompiledConfigurationTest, self).setUp()
+        self.compiled_cache_dir = mkdtemp()
+        self.path = os.path.join(mkdtemp(), "config.py")
+        self.write_config('ROOT_IMAGE = "a"\nINCLUDES += [Include("/a", "relative/path")]')
+    def write_config(self, source, mtime=1000):
+        with open(self.path, "w") as f:
+            f.write(source)
+        os.utime(self.path, (mtime, mtime))
+    def get_config(self):
+        returned = DwightConfiguration(self.compiled_cache_dir)
+        returned.load_from_file(self.path)
+        return returned
+    def test__compiled_code_saved(self):
+        config = self.get_config()
+        self.assertEquals(config["ROOT_IMAGE"], "a")
+        self.assertEquals(len(os.listdir(self.compiled_cache_dir)), 1)
+    def test__compiled_code_reused(self):
+        self.get_config()
+        _compiled_config_cache._code_by_path.clear()
+        [compiled_path] = [os.path.join(self.compiled_cache_dir, filename) for filename in os.listdir(self.compiled_cache_dir)]
+        mtime = os.path.getmtime(compiled_path)
+        self.assertEquals(self.get_config()["ROOT_IMAGE"], "a")
+        self.assertEquals(os.path.getmtime(compiled_path), mtime)
+    def test__modified_file_reloaded(self):
+        self.get_config()
+        self.write_config('ROOT_IMAGE = "b"', mtime=2000)
+        self.assertEquals(self.get_config()["ROOT_IMAGE"], "b")
+    def test__failed_load_keeps_configuration(self):
+        config = self.get_config()
+        with self.assertRaises(CannotLoadConfiguration):
+            config.load_from_string('INCLUDES += [Include("/b", "/x")]\nraise Exception()')
+        self.assertEquals(len(config["INCLUDES"]), 1)
+    def test__missing_file(self):
+        with self.assertRaises(CannotLoadConfiguration):
+            DwightConfiguration(self.compiled_cache_dir).load_from_file(self.path + ".missing")
+    def test__snapshot(self):
+        snapshot = self.get_config().get_snapshot()
+        self.assertEquals(snapshot["ROOT_IMAGE"], "a")
+        self.assertEquals(snapshot["INCLUDES"], [dict(dest="/a", source=os.path.abspath("relative/path"), kwargs={})])
+    def test__hash(self):
+        config = self.get_config()
+        self.assertEquals(config.get_hash(), self.get_config().get_hash())
+        config["ENVIRON"] = dict(A="b")
+        self.assertNotEquals(config.get_hash(), self.get_config().get_hash())
@@ -0,0 +1,41 @@
+import os
+import platform
+import shutil
+from tempfile import mkdtemp
+from .test_utils import EnvironmentTestCase, use_host_root_as_root_image
+
+class ExecutingTest(EnvironmentTestCase):
+    def setUp(self):
+        super(ExecutingTest, self).setUp()
+        if os.getuid() != 0:
+            self.skipTest("Not root")
+        if platform.system() != "Linux":
+            self.skipTest("Not linux")
+        use_host_root_as_root_image(self.environment)
+        self.directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+        self.output_path = os.path.join(self.directory, "output")
+    def test__exit_code(self):
+        self.assertEquals(self.environment.run_command_in_chroot("exit 7"), 7)
+        self.assertEquals(self.environment.run_command_in_chroot(["false"]), 1)
+    def test__killed_by_signal(self):
+        self.assertEquals(self.environment.run_command_in_chroot(["sh", "-c", "kill -9 $$"]), 128 + 9)
+    def test__command_not_found(self):
+        self.assertEquals(self.environment.run_command_in_chroot(["/nonexistent/command"]), 127)
+    def test__argv(self):
+        self.environment.run_command_in_chroot(
+            ["sh", "-c", 'printf "%s\\n" "$@" > {0}'.format(self.output_path), "sh", "a b", "$HOME", "'\""])
+        self.assertEquals(self.get_output(), "a b\n$HOME\n'\"\n")
+    def test__environ(self):
+        os.environ["DWIGHT_TEST_VARIABLE"] = "value"
+        self.addCleanup(os.environ.pop, "DWIGHT_TEST_VARIABLE")
+        self.environment.config["ENVIRON"] = dict(
+            EXPANDED="${DWIGHT_TEST_VARIABLE}:$DWIGHT_TEST_VARIABLE:$DWIGHT_TEST_UNSET_VARIABLE",
+            QUOTED='say "hello" $',
+            )
+        self.environment.run_command_in_chroot(
+            ["sh", "-c", 'printf "%s\\n" "$EXPANDED" "$QUOTED" > {0}'.format(self.output_path)])
+        self.assertEquals(self.get_output(), 'value:value:\nsay "hello" $\n')
+    def get_output(self):
+        with open(self.output_path) as output_file:
+            return output_file.read()
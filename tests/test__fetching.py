@@ -0,0 +1,82 @@
+import os
+import threading
+import time
+from tempfile import mkdtemp
+from .test_utils import EnvironmentTestCase, serving_directory
+from .test__cache import DummyCachedItem
+from dwight_chroot.cache import Cache
+from dwight_chroot.exceptions import CacheMiss
+from dwight_chroot.include import Include
+from dwight_chroot.resources import LocalResource
+
+class SlowCachedItem(DummyCachedItem):
+    fetch_count = 0
+    fetch_count_lock = threading.Lock()
+    def fetch(self, path):
+        time.sleep(0.1)
+        with self.fetch_count_lock:
+            SlowCachedItem.fetch_count += 1
+        return super(SlowCachedItem, self).fetch(path)
+
+class ConcurrentFetchingTest(EnvironmentTestCase):
+    def setUp(self):
+        super(ConcurrentFetchingTest, self).setUp()
+        self.environment.cache = Cache(mkdtemp())
+        self.src_path = mkdtemp()
+        with open(os.path.join(self.src_path, "somefile.txt"), "w") as f:
+            f.write("hello")
+        SlowCachedItem.fetch_count = 0
+    def test__fetch_order_preserved(self):
+        self.environment.config["NUM_FETCH_WORKERS"] = 4
+        resources = [SlowCachedItem(i, self.src_path) for i in range(8)]
+        local = LocalResource("/some/local/path")
+        start_time = time.time()
+        paths = self.environment._fetch_resources(resources + [local])
+        self.assertLess(time.time() - start_time, 0.1 * len(resources))
+        self.assertEquals(paths[-1], "/some/local/path")
+        for resource, path in zip(resources, paths):
+            self.assertEquals(self.environment.cache.get_path(resource.get_cache_key()), path)
+        self.assertEquals(len(set(paths)), len(paths))
+    def test__identical_keys_fetched_once(self):
+        self.environment.config["NUM_FETCH_WORKERS"] = 4
+        resources = [SlowCachedItem(dict(url="same"), self.src_path) for i in range(4)]
+        paths = self.environment._fetch_resources(resources)
+        self.assertEquals(SlowCachedItem.fetch_count, 1)
+        self.assertEquals(len(set(paths)), 1)
+        self.assertEquals(len(self.environment.cache._state.get_items()), 1)
+    def test__sequential_fetching(self):
+        self.environment.config["NUM_FETCH_WORKERS"] = 1
+        resources = [SlowCachedItem(i, self.src_path) for i in range(3)]
+        paths = self.environment._fetch_resources(resources)
+        self.assertEquals(SlowCachedItem.fetch_count, 3)
+        self.assertEquals(len(set(paths)), 3)
+
+class PrefetchTest(EnvironmentTestCase):
+    def setUp(self):
+        super(PrefetchTest, self).setUp()
+        self.environment.cache = Cache(mkdtemp())
+        self.root = mkdtemp()
+        for filename in ["image.squashfs", "a", "b"]:
+            with open(os.path.join(self.root, filename), "w") as f:
+                f.write(filename)
+    def get_config(self, server, *filenames):
+        returned = self.environment.config.copy()
+        returned["ROOT_IMAGE"] = server.url + "/image.squashfs"
+        returned["INCLUDES"] = [Include("/" + filename, server.url + "/" + filename) for filename in filenames]
+        return returned
+    def test__fetch_multiple_configs(self):
+        with serving_directory(self.root) as server:
+            paths = self.environment.fetch([self.get_config(server, "a"), self.get_config(server, "b")])
+            self.assertEquals(len(server.requests), 3)
+        self.assertEquals(len(set(paths)), 3)
+        self.assertEquals(len(self.environment.cache._state.get_items()), 3)
+    def test__offline(self):
+        with serving_directory(self.root) as server:
+            self.environment.fetch([self.get_config(server, "a")])
+            num_requests = len(server.requests)
+            self.environment.config["OFFLINE"] = True
+            self.environment.fetch([self.get_config(server, "a")])
+            self.assertEquals(len(server.requests), num_requests)
+            with self.assertRaises(CacheMiss):
+                self.environment.fetch([self.get_config(server, "b")])
+            self.assertEquals(len(server.requests), num_requests)
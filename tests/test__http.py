@@ -0,0 +1,221 @@
+import hashlib
+import os
+import shutil
+from tempfile import mkdtemp
+from .test_utils import TestCase, serving_directory
+from .test__cache import DummyEnvironment
+from dwight_chroot.cache import Cache
+from dwight_chroot import downloads
+from dwight_chroot.downloads import download
+from dwight_chroot.exceptions import CacheMiss, ChecksumMismatch, DownloadFailed
+from dwight_chroot.resources import HTTPResource
+
+class DownloadTestBase(TestCase):
+    def setUp(self):
+        super(DownloadTestBase, self).setUp()
+        self.served_path = mkdtemp()
+        self.data = os.urandom(100000)
+        with open(os.path.join(self.served_path, "image.squashfs"), "wb") as f:
+            f.write(self.data)
+        self.output_path = os.path.join(mkdtemp(), "image.squashfs")
+        self.partial_path = self.output_path + ".partial"
+    def assertDownloaded(self):
+        self.assertFalse(os.path.exists(self.partial_path))
+        with open(self.output_path, "rb") as f:
+            self.assertEquals(f.read(), self.data)
+
+class HTTPDownloadTest(DownloadTestBase):
+    def test__download(self):
+        with serving_directory(self.served_path) as server:
+            download(server.url + "/image.squashfs", self.output_path, buffer_size=1000)
+        self.assertDownloaded()
+    def test__interrupted_download_is_resumed(self):
+        with serving_directory(self.served_path) as server:
+            server.fail_after = 30000
+            with self.assertRaises(DownloadFailed):
+                download(server.url + "/image.squashfs", self.output_path)
+            self.assertFalse(os.path.exists(self.output_path))
+            self.assertEquals(os.path.getsize(self.partial_path), 30000)
+            server.fail_after = None
+            download(server.url + "/image.squashfs", self.output_path)
+            self.assertEquals(server.requests[-1].headers.get("Range"), "bytes=30000-")
+        self.assertDownloaded()
+    def test__resume_without_range_support(self):
+        with open(self.partial_path, "wb") as f:
+            f.write("garbage".encode("utf-8"))
+        with serving_directory(self.served_path, support_ranges=False) as server:
+            download(server.url + "/image.squashfs", self.output_path)
+        self.assertDownloaded()
+    def test__resume_of_complete_partial_file(self):
+        with open(self.partial_path, "wb") as f:
+            f.write(self.data)
+        with serving_directory(self.served_path) as server:
+            download(server.url + "/image.squashfs", self.output_path)
+        self.assertDownloaded()
+    def test__missing_file(self):
+        with serving_directory(self.served_path) as server:
+            with self.assertRaises(DownloadFailed):
+                download(server.url + "/nonexistent.squashfs", self.output_path)
+    def test__http_resource_resumes_in_same_cache_path(self):
+        env = DummyEnvironment()
+        with serving_directory(self.served_path) as server:
+            resource = HTTPResource(server.url + "/image.squashfs")
+            server.fail_after = 30000
+            with self.assertRaises(DownloadFailed):
+                resource.get_path(env)
+            self.assertIsNone(env.cache.get_path(resource.get_cache_key()))
+            server.fail_after = None
+            env.cache.close()
+            env.cache = Cache(env.cache.root)
+            path = resource.get_path(env)
+            self.assertEquals(server.requests[-1].headers.get("Range"), "bytes=30000-")
+        with open(path, "rb") as f:
+            self.assertEquals(f.read(), self.data)
+
+class SegmentedDownloadTest(DownloadTestBase):
+    def setUp(self):
+        super(SegmentedDownloadTest, self).setUp()
+        self.addCleanup(setattr, downloads, "_SEGMENT_CHUNK_SIZE", downloads._SEGMENT_CHUNK_SIZE)
+        downloads._SEGMENT_CHUNK_SIZE = 10000
+    def test__segmented_download(self):
+        with serving_directory(self.served_path) as server:
+            download(server.url + "/image.squashfs", self.output_path, segments=3)
+            range_requests = [request for request in server.requests if request.headers.get("Range") != "bytes=0-0"]
+            self.assertEquals(len(range_requests), 10)
+            self.assertLessEqual(len(set(request.client_address for request in range_requests)), 3)
+        self.assertDownloaded()
+    def test__fallback_without_range_support(self):
+        # large enough for the body not to fit in the socket buffers when the probe doesn't read it
+        self.data = os.urandom(32 * 1024 * 1024)
+        with open(os.path.join(self.served_path, "image.squashfs"), "wb") as f:
+            f.write(self.data)
+        with serving_directory(self.served_path, support_ranges=False) as server:
+            download(server.url + "/image.squashfs", self.output_path, segments=3)
+            self.assertEquals(server.completed_responses, [("/image.squashfs", len(self.data))])
+        self.assertDownloaded()
+    def test__interrupted_segmented_download_is_resumed(self):
+        with serving_directory(self.served_path) as server:
+            server.fail_after = 55000
+            with self.assertRaises(DownloadFailed):
+                download(server.url + "/image.squashfs", self.output_path, segments=3)
+            self.assertFalse(os.path.exists(self.output_path))
+            server.fail_after = None
+            num_requests = len(server.requests)
+            download(server.url + "/image.squashfs", self.output_path, segments=3)
+            resumed_ranges = [request.headers.get("Range") for request in server.requests[num_requests:]]
+        self.assertIn("bytes=50000-59999", resumed_ranges)
+        self.assertNotIn("bytes=0-9999", resumed_ranges)
+        self.assertLess(len(resumed_ranges), 10)
+        self.assertDownloaded()
+    def test__segmented_resource(self):
+        env = DummyEnvironment()
+        with serving_directory(self.served_path) as server:
+            path = HTTPResource(server.url + "/image.squashfs", segments=4).get_path(env)
+        with open(path, "rb") as f:
+            self.assertEquals(f.read(), self.data)
+
+class HTTPRevalidationTest(TestCase):
+    def setUp(self):
+        super(HTTPRevalidationTest, self).setUp()
+        self.served_path = mkdtemp()
+        self.env = DummyEnvironment()
+        self._write_served_file("first version", 1000000000)
+    def test__not_modified(self):
+        with serving_directory(self.served_path) as server:
+            resource = HTTPResource(server.url + "/image.squashfs")
+            path = resource.get_path(self.env)
+            resource.get_path(self.env)
+            self.assertEquals(len(server.requests), 2)
+            self.assertIsNotNone(server.requests[-1].headers.get("If-None-Match"))
+        self.assertFileContents(path, "first version")
+    def test__modified(self):
+        with serving_directory(self.served_path) as server:
+            resource = HTTPResource(server.url + "/image.squashfs")
+            path = resource.get_path(self.env)
+            self._write_served_file("second version", 1000000100)
+            self.assertEquals(resource.get_path(self.env), path)
+        self.assertFileContents(path, "second version")
+        self.assertEquals(self.env.cache._state.get_item_by_path(path)["size"], len("second version"))
+    def test__ttl(self):
+        with serving_directory(self.served_path) as server:
+            resource = HTTPResource(server.url + "/image.squashfs", ttl=1000)
+            path = resource.get_path(self.env)
+            self._write_served_file("second version", 1000000100)
+            resource.get_path(self.env)
+            self.assertEquals(len(server.requests), 1)
+        self.assertFileContents(path, "first version")
+    def test__no_validators(self):
+        with serving_directory(self.served_path, send_validators=False) as server:
+            resource = HTTPResource(server.url + "/image.squashfs")
+            path = resource.get_path(self.env)
+            self._write_served_file("second version", 1000000100)
+            resource.get_path(self.env)
+            self.assertEquals(len(server.requests), 1)
+        self.assertFileContents(path, "first version")
+    def _write_served_file(self, contents, mtime):
+        path = os.path.join(self.served_path, "image.squashfs")
+        with open(path, "w") as f:
+            f.write(contents)
+        os.utime(path, (mtime, mtime))
+    def assertFileContents(self, path, contents):
+        with open(path) as f:
+            self.assertEquals(f.read(), contents)
+
+class ChecksumTest(DownloadTestBase):
+    def setUp(self):
+        super(ChecksumTest, self).setUp()
+        self.env = DummyEnvironment()
+        self.sha256 = hashlib.sha256(self.data).hexdigest()
+        shutil.copy(os.path.join(self.served_path, "image.squashfs"), os.path.join(self.served_path, "copy.squashfs"))
+    def test__checksum_verified(self):
+        for segments in (None, 3):
+            with serving_directory(self.served_path) as server:
+                result = download(server.url + "/image.squashfs", self.output_path, segments=segments, sha256=self.sha256)
+            self.assertEquals(result["sha256"], self.sha256)
+            self.assertDownloaded()
+    def test__checksum_mismatch(self):
+        for segments in (None, 3):
+            with serving_directory(self.served_path) as server:
+                with self.assertRaises(ChecksumMismatch):
+                    download(server.url + "/image.squashfs", self.output_path, segments=segments, sha256="0" * 64)
+            self.assertFalse(os.path.exists(self.output_path))
+            self.assertFalse(os.path.exists(self.partial_path))
+    def test__checksum_of_resumed_download(self):
+        with serving_directory(self.served_path) as server:
+            server.fail_after = 30000
+            with self.assertRaises(DownloadFailed):
+                download(server.url + "/image.squashfs", self.output_path)
+            server.fail_after = None
+            result = download(server.url + "/image.squashfs", self.output_path, sha256=self.sha256)
+        self.assertEquals(result["sha256"], self.sha256)
+    def test__identical_content_deduplicated(self):
+        with serving_directory(self.served_path) as server:
+            first_path = HTTPResource(server.url + "/image.squashfs").get_path(self.env)
+            second_path = HTTPResource(server.url + "/copy.squashfs").get_path(self.env)
+        self.assertNotEquals(first_path, second_path)
+        self.assertTrue(os.path.samefile(first_path, second_path))
+    def test__known_checksum_served_from_cache(self):
+        with serving_directory(self.served_path) as server:
+            first_path = HTTPResource(server.url + "/image.squashfs").get_path(self.env)
+            url = server.url + "/copy.squashfs"
+        path = HTTPResource(url, sha256=self.sha256.upper()).get_path(self.env)
+        self.assertTrue(os.path.samefile(first_path, path))
+        self.assertEquals(HTTPResource("http://other.server/image.squashfs", sha256=self.sha256).get_path(self.env), path)
+    def test__known_checksum_served_from_cache_while_offline(self):
+        with serving_directory(self.served_path) as server:
+            first_path = HTTPResource(server.url + "/image.squashfs").get_path(self.env)
+        self.env.config["OFFLINE"] = True
+        path = HTTPResource("http://other.server/image.squashfs", sha256=self.sha256).get_path(self.env)
+        self.assertTrue(os.path.samefile(first_path, path))
+        with self.assertRaises(CacheMiss):
+            HTTPResource("http://other.server/image.squashfs", sha256="0" * 64).get_path(self.env)
+    def test__unreferenced_blobs_purged(self):
+        with serving_directory(self.served_path) as server:
+            path = HTTPResource(server.url + "/image.squashfs").get_path(self.env)
+        blob_path = self.env.cache._get_blob_path(self.sha256)
+        self.assertTrue(os.path.samefile(blob_path, path))
+        self.env.cache.cleanup(0, [])
+        self.assertFalse(os.path.exists(path))
+        self.assertTrue(os.path.exists(blob_path))
+        self.assertTrue(self.env.cache.reap_trash())
+        self.assertFalse(os.path.exists(blob_path))
@@ -0,0 +1,188 @@
+import logging
+import os
+import platform
+import shutil
+import subprocess
+import threading
+import time
+from tempfile import mkdtemp
+from unittest import TestCase
+from .test_utils import EnvironmentTestCase, use_host_root_as_root_image
+from dwight_chroot.loop_devices import LoopDeviceManager, LoopDeviceUsage
+from dwight_chroot.mounts import MountRoots
+from dwight_chroot.platform_utils import MS_RDONLY, attached_loop_device, mount, unshare_mounts
+
+class NativeMountingTest(EnvironmentTestCase):
+    def setUp(self):
+        super(NativeMountingTest, self).setUp()
+        if os.getuid() != 0:
+            self.skipTest("Not root")
+        if platform.system() != "Linux":
+            self.skipTest("Not linux")
+        self.mount_point = mkdtemp()
+    def test__bind_mount(self):
+        source = mkdtemp()
+        with open(os.path.join(source, "file"), "w") as f:
+            f.write("hello")
+        self.assertEquals(self.run_in_mount_namespace(
+            lambda: self.environment._bind_mount(source, self.mount_point),
+            lambda: os.listdir(self.mount_point) == ["file"]), 0)
+        self.assertEquals(os.listdir(self.mount_point), [])
+    def test__loop_mount(self):
+        image_path = os.path.join(mkdtemp(), "image.ext2")
+        with open(image_path, "wb") as f:
+            f.truncate(1024 * 1024)
+        try:
+            subprocess.check_call(["mkfs.ext2", "-q", "-F", image_path])
+        except (OSError, subprocess.CalledProcessError):
+            self.skipTest("mkfs.ext2 is not available")
+        def do_mount():
+            with attached_loop_device(image_path) as loop_device_path:
+                mount(loop_device_path, self.mount_point, "ext2", MS_RDONLY)
+        self.assertEquals(self.run_in_mount_namespace(
+            do_mount, lambda: "lost+found" in os.listdir(self.mount_point)), 0)
+    def test__mount_failure(self):
+        with self.assertRaises(OSError):
+            mount("/nonexistent/path", self.mount_point, None, 0)
+    def run_in_mount_namespace(self, func, check):
+        child_pid = os.fork()
+        if child_pid == 0:
+            try:
+                unshare_mounts()
+                func()
+                os._exit(0 if check() else 1)
+            except:
+                os._exit(2)
+        _, status = os.waitpid(child_pid, 0)
+        return status >> 8
+
+class LoopDeviceUsageTest(TestCase):
+    def setUp(self):
+        super(LoopDeviceUsageTest, self).setUp()
+        self.root = mkdtemp()
+        self.sys_block_path = os.path.join(self.root, "block")
+        self.max_loop_path = os.path.join(self.root, "max_loop")
+        os.makedirs(self.sys_block_path)
+        os.makedirs(os.path.join(self.sys_block_path, "sda"))
+        for index, in_use in enumerate([True, True, False, True]):
+            os.makedirs(os.path.join(self.sys_block_path, "loop{0}".format(index), "loop"))
+            if in_use:
+                open(os.path.join(self.sys_block_path, "loop{0}".format(index), "loop", "backing_file"), "w").close()
+    def get_manager(self, loop_control_path):
+        return LoopDeviceManager(loop_control_path, self.sys_block_path, self.max_loop_path)
+    def test__dynamic_allocation_is_unlimited(self):
+        manager = self.get_manager(self.max_loop_path)
+        with open(self.max_loop_path, "w") as f:
+            f.write("4\n")
+        self.assertTrue(manager.supports_dynamic_allocation())
+        self.assertEquals(manager.get_usage(), LoopDeviceUsage(in_use=3, existing=4, limit=None))
+    def test__static_allocation_limit(self):
+        manager = self.get_manager(os.path.join(self.root, "nonexistent"))
+        self.assertFalse(manager.supports_dynamic_allocation())
+        self.assertEquals(manager.get_usage().limit, 4)
+        with open(self.max_loop_path, "w") as f:
+            f.write("16\n")
+        self.assertEquals(manager.get_usage(), LoopDeviceUsage(in_use=3, existing=4, limit=16))
+    def test__pressure_warning(self):
+        manager = self.get_manager(os.path.join(self.root, "nonexistent"))
+        open(os.path.join(self.sys_block_path, "loop2", "loop", "backing_file"), "w").close()
+        records = []
+        handler = logging.Handler(logging.WARNING)
+        handler.emit = records.append
+        logger = logging.getLogger("dwight_chroot.loop_devices")
+        logger.addHandler(handler)
+        try:
+            self.assertEquals(manager.report_pressure(), LoopDeviceUsage(in_use=4, existing=4, limit=4))
+        finally:
+            logger.removeHandler(handler)
+        self.assertEquals(len(records), 1)
+
+class LoopDeviceAttachTest(TestCase):
+    def setUp(self):
+        super(LoopDeviceAttachTest, self).setUp()
+        if os.getuid() != 0:
+            self.skipTest("Not root")
+        if platform.system() != "Linux":
+            self.skipTest("Not linux")
+        self.manager = LoopDeviceManager()
+        if not self.manager.supports_dynamic_allocation():
+            self.skipTest("/dev/loop-control is not available")
+        self.image_path = os.path.join(mkdtemp(), "image")
+        with open(self.image_path, "wb") as f:
+            f.truncate(1024 * 1024)
+    def test__attach_is_released_automatically(self):
+        with self.manager.attach(self.image_path) as first, self.manager.attach(self.image_path) as second:
+            self.assertNotEquals(first, second)
+            self.assertEquals(self.get_backing_file(first), self.image_path)
+        self.assertIsNone(self.get_backing_file(first))
+        self.assertIsNone(self.get_backing_file(second))
+    def get_backing_file(self, loop_device_path):
+        path = os.path.join("/sys/block", os.path.basename(loop_device_path), "loop", "backing_file")
+        if not os.path.exists(path):
+            return None
+        with open(path) as f:
+            return f.read().strip()
+
+class MountRootsTest(TestCase):
+    def setUp(self):
+        super(MountRootsTest, self).setUp()
+        self.mount_roots = MountRoots(mkdtemp())
+        self.addCleanup(shutil.rmtree, self.mount_roots.path)
+    def test__allocate_and_release(self):
+        path = self.mount_roots.allocate("0123456789abcdef", os.getpid())
+        self.assertEquals(path, os.path.join(self.mount_roots.path, "0123456789ab-{0}".format(os.getpid())))
+        os.mkdir(os.path.join(path, "root_image"))
+        self.assertEquals([environment.path for environment in self.mount_roots.list_active()], [path])
+        self.mount_roots.release("0123456789abcdef", os.getpid())
+        self.assertEquals(os.listdir(self.mount_roots.path), [])
+    def test__release_keeps_contents(self):
+        path = self.mount_roots.allocate("0123456789abcdef", os.getpid())
+        os.mkdir(os.path.join(path, "root_image"))
+        open(os.path.join(path, "root_image", "file"), "w").close()
+        self.mount_roots.release("0123456789abcdef", os.getpid())
+        self.assertTrue(os.path.exists(os.path.join(path, "root_image", "file")))
+    def test__stale_mount_roots_removed(self):
+        dead_pid = os.fork()
+        if dead_pid == 0:
+            os._exit(0)
+        os.waitpid(dead_pid, 0)
+        stale_path = self.mount_roots.allocate("aaaa", dead_pid)
+        os.mkdir(os.path.join(stale_path, "root_image"))
+        self.assertEquals(self.mount_roots.list_active(), [])
+        path = self.mount_roots.allocate("bbbb", os.getpid())
+        self.assertEquals(os.listdir(self.mount_roots.path), [os.path.basename(path)])
+
+class ConcurrentEnvironmentsTest(EnvironmentTestCase):
+    def setUp(self):
+        super(ConcurrentEnvironmentsTest, self).setUp()
+        if os.getuid() != 0:
+            self.skipTest("Not root")
+        if platform.system() != "Linux":
+            self.skipTest("Not linux")
+        use_host_root_as_root_image(self.environment)
+        self.environment.mount_roots = MountRoots(mkdtemp())
+        self.addCleanup(shutil.rmtree, self.environment.mount_roots.path)
+        self.directory = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory)
+    def test__concurrent_environments_listed(self):
+        fifo_path = os.path.join(self.directory, "fifo")
+        os.mkfifo(fifo_path)
+        # each command blocks until the fifo is written to
+        threads = [threading.Thread(target=self.environment.run_command_in_chroot, args=(["cat", fifo_path],))
+                   for _ in range(2)]
+        for thread in threads:
+            thread.start()
+        deadline = time.time() + 10
+        while len(self.get_active_root_image_mounts()) < 2 and time.time() < deadline:
+            time.sleep(0.05)
+        root_image_mounts = self.get_active_root_image_mounts()
+        with open(fifo_path, "w") as fifo:
+            fifo.write("done\n")
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(set(root_image_mounts)), 2)
+        self.assertEquals(self.environment.mount_roots.list_active(), [])
+        self.assertEquals(os.listdir(self.environment.mount_roots.path), [])
+    def get_active_root_image_mounts(self):
+        return [mount.mount_point for environment in self.environment.mount_roots.list_active()
+                for mount in environment.mounts if mount.mount_point.endswith("/root_image")]
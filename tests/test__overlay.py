@@ -0,0 +1,51 @@
+import os
+import platform
+import shutil
+import threading
+import time
+from tempfile import mkdtemp
+from .test_utils import EnvironmentTestCase, use_host_root_as_root_image
+
+class OverlayTest(EnvironmentTestCase):
+    def setUp(self):
+        super(OverlayTest, self).setUp()
+        if os.getuid() != 0:
+            self.skipTest("Not root")
+        if platform.system() != "Linux":
+            self.skipTest("Not linux")
+        use_host_root_as_root_image(self.environment)
+        self.path = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.path)
+        self.overlay_name = os.path.basename(self.path)
+        self.addCleanup(shutil.rmtree, os.path.join(self.environment.cache.root, "overlays", self.overlay_name), True)
+        self.environment.config["OVERLAY_NAME"] = self.overlay_name
+    def test__tmpfs(self):
+        self.environment.config["OVERLAY"] = "tmpfs"
+        self.assertEquals(self.run_command("touch {0}/file && test -f {0}/file".format(self.path)), 0)
+        self.assertEquals(os.listdir(self.path), [])
+        self.assertEquals(self.run_command("test -f {0}/file".format(self.path)), 1)
+    def test__persistent(self):
+        self.environment.config["OVERLAY"] = "persistent"
+        self.assertEquals(self.run_command("touch {0}/file".format(self.path)), 0)
+        self.assertEquals(os.listdir(self.path), [])
+        self.assertEquals(self.run_command("test -f {0}/file".format(self.path)), 0)
+        self.environment.config["OVERLAY_NAME"] += "-other"
+        self.addCleanup(shutil.rmtree, os.path.join(self.environment.cache.root, "overlays", self.environment.config["OVERLAY_NAME"]), True)
+        self.assertEquals(self.run_command("test -f {0}/file".format(self.path)), 1)
+    def test__persistent_runs_do_not_overlap(self):
+        self.environment.config["OVERLAY"] = "persistent"
+        intervals = []
+        def run():
+            start_time = time.time()
+            self.assertEquals(self.run_command("sleep 0.5"), 0)
+            intervals.append((start_time, time.time()))
+        threads = [threading.Thread(target=run) for _ in range(2)]
+        start_time = time.time()
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEquals(len(intervals), 2)
+        self.assertGreaterEqual(time.time() - start_time, 1.0)
+    def run_command(self, cmd):
+        return self.environment.run_command_in_chroot("sh -c '{0}'".format(cmd))
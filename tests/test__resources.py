@@ -1,6 +1,10 @@
 from .test_utils import TestCase
+from .test__cache import DummyEnvironment
 import functools
 import itertools
+import os
+import subprocess
+from tempfile import mkdtemp
 from dwight_chroot import resources
 from dwight_chroot.exceptions import UsageException
 
@@ -30,3 +34,116 @@ class DVCSResourceTest(TestCase):
                 else:
                     with self.assertRaises(UsageException):
                         r()
+
+class GitFingerprintTest(TestCase):
+    def setUp(self):
+        super(GitFingerprintTest, self).setUp()
+        self.path = mkdtemp()
+        self.resource = resources.GitResource("git://server/repo")
+        try:
+            self._git("init", "-q")
+        except OSError:
+            self.skipTest("git is not installed")
+    def test__fingerprint_follows_head(self):
+        self.assertIsNone(self.resource.get_fingerprint(self.path))
+        first_commit = self._commit("first")
+        self.assertEquals(self.resource.get_fingerprint(self.path), "git:" + first_commit)
+        second_commit = self._commit("second")
+        self.assertEquals(self.resource.get_fingerprint(self.path), "git:" + second_commit)
+        self._git("pack-refs", "--all")
+        self.assertEquals(self.resource.get_fingerprint(self.path), "git:" + second_commit)
+        self._git("checkout", "-q", first_commit)
+        self.assertEquals(self.resource.get_fingerprint(self.path), "git:" + first_commit)
+    def test__not_a_repository(self):
+        self.assertIsNone(self.resource.get_fingerprint(mkdtemp()))
+    def _commit(self, message):
+        self._git("-c", "user.name=a", "-c", "user.email=a@b", "commit", "-q", "--allow-empty", "-m", message)
+        return self._git("rev-parse", "HEAD").strip()
+    def _git(self, *args):
+        return subprocess.check_output(("git",) + args, cwd=self.path).decode("ascii")
+
+class GitMirrorTest(TestCase):
+    def setUp(self):
+        super(GitMirrorTest, self).setUp()
+        self.env = DummyEnvironment()
+        self.upstream = mkdtemp()
+        try:
+            self._git(self.upstream, "init", "-q", "-b", "master")
+        except OSError:
+            self.skipTest("git is not installed")
+        self.first_commit = self._commit("first")
+        self._git(self.upstream, "tag", "v1")
+        self._git(self.upstream, "checkout", "-q", "-b", "feature")
+        self.feature_commit = self._commit("feature")
+        self._git(self.upstream, "checkout", "-q", "master")
+        self.second_commit = self._commit("second")
+    def test__refs_share_a_single_mirror(self):
+        paths = [resources.GitResource(self.upstream, **kwargs).get_path(self.env)
+                 for kwargs in (dict(), dict(branch="feature"), dict(tag="v1"), dict(commit=self.first_commit))]
+        mirror_path = self.env.cache.get_path(dict(url=self.upstream, mirror=True))
+        self.assertEquals([self._get_head(path) for path in paths],
+                          [self.second_commit, self.feature_commit, self.first_commit, self.first_commit])
+        for path in paths:
+            with open(os.path.join(path, ".git", "objects", "info", "alternates")) as alternates_file:
+                self.assertEquals(alternates_file.read().strip(), os.path.join(mirror_path, "objects"))
+    def test__mirror_is_a_cache_item(self):
+        resource = resources.GitResource(self.upstream)
+        resource.get_path(self.env)
+        mirror_key = resource.get_mirror_cache_key()
+        self.assertIn(mirror_key, resource.get_used_cache_keys())
+        mirror_path = self.env.cache.get_path(mirror_key)
+        self.assertGreater(self.env.cache._get_item_by_path(mirror_path)["size"], 0)
+        self.assertEquals(self._git(mirror_path, "config", "gc.auto").strip(), "0")
+        self.assertEquals(self._git(mirror_path, "config", "gc.pruneExpire").strip(), "never")
+    def test__clone_fetched_again_after_mirror_eviction(self):
+        resource = resources.GitResource(self.upstream, branch="feature")
+        path = resource.get_path(self.env)
+        self.env.cache.cleanup(0, [resource.get_cache_key()])
+        self.assertIsNone(self.env.cache.get_path(resource.get_mirror_cache_key()))
+        self.assertFalse(resource.is_usable(path))
+        self.assertEquals(resource.get_path(self.env), path)
+        self.assertTrue(resource.is_usable(path))
+        self.assertEquals(self._get_head(path), self.feature_commit)
+    def test__pull_through_mirror(self):
+        resource = resources.GitResource(self.upstream, branch="feature")
+        path = resource.get_path(self.env)
+        self._git(self.upstream, "checkout", "-q", "feature")
+        new_commit = self._commit("new feature")
+        self.assertEquals(resource.get_path(self.env), path)
+        self.assertEquals(self._get_head(path), new_commit)
+    def test__new_commit_fetched_into_existing_mirror(self):
+        resources.GitResource(self.upstream).get_path(self.env)
+        new_commit = self._commit("third")
+        path = resources.GitResource(self.upstream, commit=new_commit).get_path(self.env)
+        self.assertEquals(self._get_head(path), new_commit)
+    def test__shallow_clone(self):
+        path = resources.GitResource("file://" + self.upstream, depth=1).get_path(self.env)
+        self.assertTrue(os.path.exists(os.path.join(path, ".git", "shallow")))
+        self.assertEquals(self._get_head(path), self.second_commit)
+        self.assertIsNone(self.env.cache.get_path(dict(url="file://" + self.upstream, mirror=True)))
+    def test__shallow_commit(self):
+        path = resources.GitResource("file://" + self.upstream, commit=self.first_commit, depth=1).get_path(self.env)
+        self.assertTrue(os.path.exists(os.path.join(path, ".git", "shallow")))
+        self.assertEquals(self._get_head(path), self.first_commit)
+    def test__pinned_commit_verified_locally(self):
+        resource = resources.GitResource(self.upstream, commit=self.first_commit)
+        path = resource.get_path(self.env)
+        self._git(path, "checkout", "-q", self.second_commit)
+        self.assertEquals(resource.get_path(self.env), path)
+        self.assertEquals(self._get_head(path), self.first_commit)
+    def test__invalid_refresh_policy(self):
+        for policy in ("sometimes", "ttl=", "ttl=abc"):
+            with self.assertRaises(UsageException):
+                resources.GitResource(self.upstream, refresh=policy)
+    def test__cache_key(self):
+        self.assertEquals(resources.GitResource("git://a/b").get_cache_key(),
+                          dict(url="git://a/b", commit=None, branch=None, tag=None))
+        self.assertEquals(resources.GitResource("git://a/b", depth=1, filter="blob:none").get_cache_key(),
+                          dict(url="git://a/b", commit=None, branch=None, tag=None, depth=1, filter="blob:none"))
+    def _get_head(self, path):
+        return self._git(path, "rev-parse", "HEAD").strip()
+    def _commit(self, message):
+        self._git(self.upstream, "-c", "user.name=a", "-c", "user.email=a@b", "commit", "-q", "--allow-empty", "-m", message)
+        return self._get_head(self.upstream)
+    def _git(self, path, *args):
+        return subprocess.check_output(("git",) + args, cwd=path).decode("ascii")
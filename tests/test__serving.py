@@ -0,0 +1,84 @@
+import os
+import platform
+import signal
+import time
+from tempfile import mkdtemp
+from .test_utils import EnvironmentTestCase, use_host_root_as_root_image
+from dwight_chroot.include import Include
+from dwight_chroot.server import Server, get_mount_spec, get_mount_spec_hash, run_command_attached
+
+class MountSpecTest(EnvironmentTestCase):
+    def setUp(self):
+        super(MountSpecTest, self).setUp()
+        self.environment.config["ROOT_IMAGE"] = "/some/image.squashfs"
+        self.environment.config["INCLUDES"] = [Include("/a", "relative/path"), Include("/b", "git://server/repo", branch="x")]
+    def test__local_paths_are_absolute(self):
+        spec = get_mount_spec(self.environment.config)
+        self.assertEquals(spec["root_image"]["source"], "/some/image.squashfs")
+        self.assertEquals(spec["includes"][0]["source"], os.path.abspath("relative/path"))
+        self.assertEquals(spec["includes"][1], dict(dest="/b", source="git://server/repo", kwargs=dict(branch="x")))
+    def test__hash_changes_with_includes(self):
+        spec_hash = get_mount_spec_hash(get_mount_spec(self.environment.config))
+        self.assertEquals(spec_hash, get_mount_spec_hash(get_mount_spec(self.environment.config)))
+        self.environment.config["INCLUDES"][1].kwargs["branch"] = "y"
+        self.assertNotEquals(spec_hash, get_mount_spec_hash(get_mount_spec(self.environment.config)))
+
+class StopSignalTest(EnvironmentTestCase):
+    def test__stop_after_request(self):
+        server = Server(self.environment)
+        server._connection = object()
+        server.handle_stop_signal(signal.SIGTERM, None)
+        self.assertTrue(server._stop_requested)
+    def test__stop_while_idle(self):
+        with self.assertRaises(SystemExit):
+            Server(self.environment).handle_stop_signal(signal.SIGTERM, None)
+
+class AttachTest(EnvironmentTestCase):
+    def setUp(self):
+        super(AttachTest, self).setUp()
+        if os.getuid() != 0:
+            self.skipTest("Not root")
+        if platform.system() != "Linux":
+            self.skipTest("Not linux")
+        self.socket_path = os.path.join(mkdtemp(), "serve.sock")
+        self.dest = mkdtemp()
+        self.source = mkdtemp()
+        with open(os.path.join(self.source, "file"), "w") as f:
+            f.write("hello")
+        self.configure(self.environment)
+        self.server_pid = self.start_server()
+    def tearDown(self):
+        if getattr(self, "server_pid", None):
+            os.kill(self.server_pid, signal.SIGTERM)
+            os.waitpid(self.server_pid, 0)
+        super(AttachTest, self).tearDown()
+    def configure(self, environment, source=None):
+        use_host_root_as_root_image(environment)
+        environment.config["INCLUDES"] = [Include(self.dest, source or self.source)]
+    def start_server(self):
+        pid = os.fork()
+        if pid == 0:
+            try:
+                server = Server(self.environment, self.socket_path)
+                signal.signal(signal.SIGTERM, server.handle_stop_signal)
+                server.serve_forever()
+            finally:
+                os._exit(0)
+        for _ in range(100):
+            if os.path.exists(self.socket_path):
+                break
+            time.sleep(0.1)
+        return pid
+    def test__attach(self):
+        self.assertEquals(self.run_attached("test -f {0}/file".format(self.dest)), 0)
+        self.assertEquals(self.run_attached("test -f {0}/other_file".format(self.dest)), 1)
+        self.assertEquals(os.listdir(self.dest), [])
+    def test__configuration_change(self):
+        other_source = mkdtemp()
+        open(os.path.join(other_source, "other_file"), "w").close()
+        self.assertEquals(self.run_attached("test -f {0}/other_file".format(self.dest), source=other_source), 0)
+        self.assertEquals(self.run_attached("test -f {0}/file".format(self.dest)), 0)
+    def run_attached(self, cmd, source=None):
+        environment = type(self.environment)()
+        self.configure(environment, source)
+        return run_command_attached(environment, cmd, self.socket_path)
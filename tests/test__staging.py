@@ -0,0 +1,96 @@
+import os
+import platform
+import shutil
+import time
+from tempfile import mkdtemp
+from unittest import TestCase
+from .test_utils import EnvironmentTestCase
+from dwight_chroot.exceptions import InvalidConfiguration
+from dwight_chroot.include import Include
+from dwight_chroot.staging import StagingArea
+
+class StagingAreaTest(TestCase):
+    def setUp(self):
+        super(StagingAreaTest, self).setUp()
+        self.root = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.staging_area = StagingArea(os.path.join(self.root, "staging"), max_size=2500)
+    def test__hit_and_miss(self):
+        image_path = self.create_image("image.squashfs", 1000)
+        staged_path, hit = self.staging_area.stage(image_path)
+        self.assertFalse(hit)
+        self.assertNotEquals(staged_path, image_path)
+        with open(staged_path, "rb") as staged_file:
+            self.assertEquals(staged_file.read(), b"x" * 1000)
+        self.assertEquals(self.staging_area.stage(image_path), (staged_path, True))
+    def test__modified_image_staged_again(self):
+        image_path = self.create_image("image.squashfs", 1000)
+        self.staging_area.stage(image_path)
+        with open(image_path, "wb") as image_file:
+            image_file.write(b"y" * 1000)
+        os.utime(image_path, (time.time() + 10, time.time() + 10))
+        staged_path, hit = self.staging_area.stage(image_path)
+        self.assertFalse(hit)
+        self.assertEquals(self.staging_area.get_staged_paths(), [staged_path])
+        with open(staged_path, "rb") as staged_file:
+            self.assertEquals(staged_file.read(), b"y" * 1000)
+    def test__default_max_size(self):
+        staging_area = StagingArea(os.path.join(self.root, "unlimited"))
+        image_path = self.create_image("image.squashfs", 1000)
+        staging_area.stage(image_path)
+        fs_stat = os.statvfs(staging_area.path)
+        self.assertEquals(staging_area._get_max_size(), fs_stat.f_blocks * fs_stat.f_frsize // 2)
+    def test__lru_eviction(self):
+        staged_paths = []
+        for index in range(3):
+            staged_path, _ = self.staging_area.stage(self.create_image("image{0}.squashfs".format(index), 1000))
+            # mtime resolution of some filesystems is too coarse to tell the images apart
+            os.utime(staged_path, (index, index))
+            staged_paths.append(staged_path)
+        self.assertEquals(self.staging_area.get_staged_paths(), staged_paths[1:])
+        self.assertTrue(self.staging_area.stage(self.create_image("image1.squashfs", 1000))[1])
+        staged_path, _ = self.staging_area.stage(self.create_image("image3.squashfs", 1000))
+        self.assertEquals(self.staging_area.get_staged_paths(), [staged_paths[1], staged_path])
+    def test__too_large(self):
+        self.assertEquals(self.staging_area.stage(self.create_image("image.squashfs", 3000)), (None, False))
+    def create_image(self, name, size):
+        path = os.path.join(self.root, name)
+        if not os.path.exists(path):
+            with open(path, "wb") as f:
+                f.write(b"x" * size)
+        return path
+
+class EnvironmentStagingTest(EnvironmentTestCase):
+    def setUp(self):
+        super(EnvironmentStagingTest, self).setUp()
+        self.root = mkdtemp()
+        self.addCleanup(shutil.rmtree, self.root)
+        self.image_path = os.path.join(self.root, "image.squashfs")
+        with open(self.image_path, "wb") as f:
+            f.write(b"x" * 1000)
+        self.environment.config["STAGING_DIR"] = os.path.join(self.root, "staging")
+    def test__ram(self):
+        staged_path = self.environment._stage_image(self.image_path, "ram")
+        self.assertTrue(staged_path.startswith(self.environment.config["STAGING_DIR"]))
+        self.assertEquals(self.environment._stage_image(self.image_path, "ram"), staged_path)
+        self.assertEquals([record["args"]["hit"] for record in self.environment.timings.get_records()], [False, True])
+    def test__ram_falls_back_to_image(self):
+        self.environment.config["MAX_STAGING_SIZE"] = 10
+        self.assertEquals(self.environment._stage_image(self.image_path, "ram"), self.image_path)
+    def test__readahead(self):
+        if platform.system() != "Linux":
+            self.skipTest("Not linux")
+        self.assertEquals(self.environment._stage_image(self.image_path, "readahead"), self.image_path)
+        self.assertEquals([record["name"] for record in self.environment.timings.get_records()], ["stage.readahead"])
+    def test__not_staged(self):
+        self.assertEquals(self.environment._stage_image(self.image_path, None), self.image_path)
+        self.assertEquals(self.environment._stage_image(self.root, "ram"), self.root)
+        self.assertEquals(self.environment.timings.get_records(), [])
+    def test__invalid_stage(self):
+        self.environment.config["ROOT_IMAGE"] = Include("/", self.image_path, stage="disk")
+        with self.assertRaises(InvalidConfiguration):
+            self.environment.config.check()
+    def test__include_dict_keeps_stage(self):
+        include = Include.from_dict(Include("/mount", self.image_path, stage="ram").to_dict())
+        self.assertEquals(include.stage, "ram")
+        self.assertEquals(include.kwargs, {})
@@ -0,0 +1,58 @@
+import json
+import os
+import platform
+import time
+from tempfile import mkdtemp
+from unittest import TestCase
+from .test_utils import EnvironmentTestCase, use_host_root_as_root_image
+from dwight_chroot.include import Include
+from dwight_chroot.timing import Timings
+
+class TimingsTest(TestCase):
+    def setUp(self):
+        super(TimingsTest, self).setUp()
+        self.timings = Timings()
+        with self.timings.measure("outer", key="value"):
+            time.sleep(0.01)
+            with self.timings.measure("inner"):
+                pass
+    def test__records(self):
+        records = self.timings.get_records()
+        self.assertEquals([record["name"] for record in records], ["outer", "inner"])
+        self.assertEquals(records[0]["args"], dict(key="value"))
+        self.assertGreaterEqual(records[0]["duration"], 0.01)
+        self.assertGreaterEqual(records[0]["duration"], records[1]["duration"])
+    def test__save_json(self):
+        path = os.path.join(mkdtemp(), "timings.json")
+        self.timings.save(path)
+        with open(path) as f:
+            self.assertEquals(json.load(f), dict(timings=self.timings.get_records()))
+    def test__save_chrome_trace(self):
+        path = os.path.join(mkdtemp(), "trace.json")
+        self.timings.save(path, "chrome")
+        with open(path) as f:
+            events = json.load(f)["traceEvents"]
+        self.assertEquals([event["ph"] for event in events], ["X", "X"])
+        self.assertEquals(events[0]["dur"], int(self.timings.get_records()[0]["duration"] * 1000000))
+    def test__send_receive(self):
+        read_fd, write_fd = os.pipe()
+        self.timings.send(write_fd)
+        received = Timings()
+        received.receive(read_fd)
+        self.assertEquals(received.get_records(), self.timings.get_records())
+
+class EnvironmentTimingsTest(EnvironmentTestCase):
+    def setUp(self):
+        super(EnvironmentTimingsTest, self).setUp()
+        if os.getuid() != 0:
+            self.skipTest("Not root")
+        if platform.system() != "Linux":
+            self.skipTest("Not linux")
+        use_host_root_as_root_image(self.environment)
+        self.environment.config["INCLUDES"] = [Include(mkdtemp(), mkdtemp())]
+    def test__phases_recorded_in_child(self):
+        self.assertEquals(self.environment.run_command_in_chroot("true"), 0)
+        names = [record["name"] for record in self.environment.timings.get_records()]
+        for name in ["cache.cleanup", "mount", "chroot", "command"]:
+            self.assertIn(name, names)
+        self.assertEquals(names.count("mount"), 2)
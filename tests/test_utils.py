@@ -1,9 +1,110 @@
+from collections import namedtuple
+from contextlib import contextmanager
+from email.utils import formatdate
+import os
+import re
+import threading
 from unittest import TestCase
 
 from dwight_chroot import Environment
+from dwight_chroot.python_compat import PY3
+
+if PY3:
+    from http.server import HTTPServer, BaseHTTPRequestHandler
+    from socketserver import ThreadingMixIn
+else:
+    from BaseHTTPServer import HTTPServer, BaseHTTPRequestHandler
+    from SocketServer import ThreadingMixIn
 
 class EnvironmentTestCase(TestCase):
     def setUp(self):
         super(EnvironmentTestCase, self).setUp()
         self.environment = Environment()
-    
+
+def use_host_root_as_root_image(environment):
+    # the host root stands in for a root image, since building one needs squashfs support
+    environment._mount_squashfs = environment._bind_mount
+    environment.config["ROOT_IMAGE"] = "/"
+    environment.config["PWD"] = "/"
+
+_WRITE_SIZE = 64 * 1024
+
+RecordedRequest = namedtuple("RecordedRequest", ["client_address", "headers"])
+
+class _ThreadingHTTPServer(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+
+class FileHTTPRequestHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    def do_GET(self):
+        self.server.requests.append(RecordedRequest(self.client_address, self.headers))
+        path = os.path.join(self.server.root, self.path.lstrip("/"))
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        size = os.path.getsize(path)
+        mtime = int(os.path.getmtime(path))
+        etag = '"{0}-{1}"'.format(mtime, size)
+        last_modified = formatdate(mtime, usegmt=True)
+        if self.server.send_validators and (
+                self.headers.get("If-None-Match") == etag or self.headers.get("If-Modified-Since") == last_modified):
+            self.send_response(304)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        start, end = 0, size - 1
+        range_header = self.headers.get("Range")
+        if range_header is not None and self.server.support_ranges:
+            match = re.match(r"bytes=(\d+)-(\d*)$", range_header)
+            start = int(match.group(1))
+            if match.group(2):
+                end = min(int(match.group(2)), end)
+            if start >= size:
+                self.send_error(416)
+                return
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes {0}-{1}/{2}".format(start, end, size))
+        else:
+            self.send_response(200)
+        if self.server.support_ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if self.server.send_validators:
+            self.send_header("ETag", etag)
+            self.send_header("Last-Modified", last_modified)
+        self.send_header("Content-Length", str(end - start + 1))
+        self.end_headers()
+        with open(path, "rb") as f:
+            f.seek(start)
+            data = f.read(end - start + 1)
+        if self.server.fail_after is not None and start <= self.server.fail_after <= end:
+            data = data[:self.server.fail_after - start]
+            self.close_connection = True
+        try:
+            for offset in range(0, len(data), _WRITE_SIZE):
+                self.wfile.write(data[offset:offset + _WRITE_SIZE])
+        except (IOError, OSError):
+            # the client closed the connection without reading the whole body
+            self.close_connection = True
+            return
+        self.server.completed_responses.append((self.path, len(data)))
+    def log_message(self, *args):
+        pass
+
+@contextmanager
+def serving_directory(root, support_ranges=True, send_validators=True):
+    server = _ThreadingHTTPServer(("127.0.0.1", 0), FileHTTPRequestHandler)
+    server.root = root
+    server.support_ranges = support_ranges
+    server.send_validators = send_validators
+    server.fail_after = None
+    server.requests = []
+    server.completed_responses = []
+    server.url = "http://127.0.0.1:{0}".format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, kwargs=dict(poll_interval=0.05))
+    thread.daemon = True
+    thread.start()
+    try:
+        yield server
+    finally:
+        server.shutdown()
+        server.server_close()